@@ -0,0 +1,339 @@
+#This module generates synthetic wearable data and benchmarks the functions in sleep_analysis_lib.py. It is part of the project started
+#in the Stanford class BIODS 253: Software Engineering for Scientists by Stanford Bioengineering graduate student Scott Piper
+#(sjpiper@stanford.edu) in Winter quarter 2022.
+#The synthetic files use the same columns as the sleep and activity exports from the research paper: Li, X., Dunn, J., Salins, D.,
+#Zhou, G., Zhou, W., Rose, S. M. S. F., ... & Sonecha, R. (2017). Digital health: tracking physiomes and activity using wearable
+#biosensors reveals useful health-related information. PLoS biology, 15(1), e2001402
+
+#The benchmarks can be run from the command line. For example, 'python3 sleep_analysis_bench.py --rows 1000 100000 --output bench.json'
+#times and memory-profiles every stage of the analysis on synthetic participants with 1,000 and 100,000 rows. Run
+#'python3 sleep_analysis_bench.py -h' for more information.
+
+#-------------------------------------------------------------------------------------------------------------------------------------
+
+#Import necessary libraries and functions for the program
+
+from sleep_analysis_lib import read_data, sleep_processing, activity_processing, flight_effect_sleep, plot_data
+import numpy as np
+import pandas as pd
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import tempfile
+import time
+import tracemalloc
+import warnings
+
+#-------------------------------------------------------------------------------------------------------------------------------------
+
+#Set constants
+
+#Column order of the sleep and activity exports. The sleep export ends every line with a comma, which gives it an unnamed empty column.
+SLEEP_COLUMNS = ['local_start_time', 'local_end_time', 'heart_rate_avg', 'calories', 'actual_minutes', 'light_minutes', 'deep_minutes',
+                 'rem_minutes', 'interruption_minutes', 'unknown_minutes', 'interruptions', 'toss_and_turn', 'start_timestamp',
+                 'start_time_iso', 'start_time_timezone', 'start_time_offset', 'end_timestamp', 'end_time_iso', 'end_time_timezone',
+                 'end_time_offset', '']
+ACTIVITY_COLUMNS = ['Date', 'Activity', 'Group', 'Start', 'End', 'Duration', 'Distance', 'Steps', 'Calories']
+#First day of the synthetic recordings
+START_DATE = np.datetime64('2014-03-21', 'D')
+#Synthetic days must stay within four digit years so dates keep the YYYY-MM-DD format
+MAX_DAYS = int((np.datetime64('9999-12-31', 'D') - START_DATE).astype(np.int64))
+#Average number of sleeps per day, from the probabilities of one, two, or three sleeps on a day
+SLEEPS_PER_DAY = [1, 2, 3]
+SLEEPS_PER_DAY_P = [0.7, 0.2, 0.1]
+#Time zones the synthetic participants sleep in, with their offsets from GMT in minutes
+TIMEZONES = [('America/Los_Angeles', -420), ('America/New_York', -240), ('Europe/Berlin', 120)]
+#Ground activities with their typical speeds in miles/hour
+GROUND_ACTIVITIES = [('walking', 3), ('cycling', 12), ('running', 6), ('transport', 35)]
+GROUND_ACTIVITIES_P = [0.8, 0.05, 0.03, 0.12]
+#Stages timed by the benchmarks, in pipeline order
+STAGES = ['read_data', 'sleep_processing', 'activity_processing', 'flight_effect_sleep', 'plot_data']
+
+#-------------------------------------------------------------------------------------------------------------------------------------
+
+#Section 1: generate synthetic data
+
+def iso_times(seconds, suffix):
+    '''Formats epoch seconds as ISO 8601 time strings.
+
+    Arguments:
+    seconds = seconds since 1970-01-01, a numpy int64 array
+    suffix = time zone designator added to every string, such as 'Z' or '-07:00'
+
+    Returns:
+    times = a numpy array of strings in the format YYYY-MM-DDTHH:MM:SS followed by the suffix'''
+    return np.char.add(np.datetime_as_string(seconds.astype('datetime64[s]'), unit='s'), suffix)
+
+def synthetic_sleep(rng, n_rows, first_day):
+    '''Generates sleep rows in the format of the Basis watch sleep export. Each day has one main night of sleep and sometimes one or two
+    naps.
+
+    Arguments:
+    rng = numpy random generator
+    n_rows = number of sleep rows to generate, integer
+    first_day = day number (days after START_DATE) of the first row, integer
+
+    Returns:
+    sleep_data = a dataframe with the sleep export columns
+    next_day = day number after the last generated day, integer'''
+    #Spread the rows over days with one to three sleeps each
+    counts = rng.choice(SLEEPS_PER_DAY, size=n_rows, p=SLEEPS_PER_DAY_P)
+    day_idx = np.repeat(np.arange(n_rows), counts)[:n_rows]
+    sleep_number = np.arange(n_rows) - np.searchsorted(day_idx, day_idx)
+    days = first_day + day_idx
+    #The first sleep of the day is the night, starting around 06:00 GMT, and others are naps later in the day
+    is_night = sleep_number == 0
+    start_minute = np.where(is_night, rng.normal(360, 60, n_rows), 720 + 240 * sleep_number + rng.normal(0, 60, n_rows))
+    start_minute = np.clip(start_minute, 0, 1439).astype(np.int64)
+    actual_minutes = np.where(is_night, rng.normal(400, 90, n_rows), rng.normal(40, 15, n_rows))
+    actual_minutes = np.clip(actual_minutes, 10, 1000).astype(np.int64)
+    #Split the sleep into stages
+    deep_minutes = (actual_minutes * rng.uniform(0.05, 0.25, n_rows)).astype(np.int64) * is_night
+    rem_minutes = (actual_minutes * rng.uniform(0.1, 0.25, n_rows)).astype(np.int64) * is_night
+    light_minutes = actual_minutes - deep_minutes - rem_minutes
+    interruptions = rng.poisson(np.where(is_night, 2, 0.2))
+    interruption_minutes = interruptions * rng.integers(1, 10, n_rows)
+    total_minutes = actual_minutes + interruption_minutes
+    start_epoch = ((START_DATE + days).astype('datetime64[s]').astype(np.int64) + start_minute * 60)
+    end_epoch = start_epoch + total_minutes * 60
+    #Time zones and local times
+    zone = rng.integers(0, len(TIMEZONES), n_rows)
+    zone_names = np.array([name for name, _ in TIMEZONES])[zone]
+    offsets = np.array([offset for _, offset in TIMEZONES])[zone]
+    #The day is written without a leading zero. '%-d' only works with glibc, so the zero is stripped after formatting instead.
+    local_start = pd.Series(pd.to_datetime(start_epoch + offsets * 60, unit='s').strftime('%d %b %Y %H:%M:%S')).str.lstrip('0')
+    local_end = pd.Series(pd.to_datetime(end_epoch + offsets * 60, unit='s').strftime('%d %b %Y %H:%M:%S')).str.lstrip('0')
+    sleep_data = pd.DataFrame({'local_start_time': local_start, 'local_end_time': local_end,
+                               'heart_rate_avg': rng.normal(62, 6, n_rows), 'calories': actual_minutes * rng.uniform(0.8, 1.1, n_rows),
+                               'actual_minutes': actual_minutes, 'light_minutes': light_minutes, 'deep_minutes': deep_minutes,
+                               'rem_minutes': rem_minutes, 'interruption_minutes': interruption_minutes, 'unknown_minutes': 0,
+                               'interruptions': interruptions, 'toss_and_turn': rng.poisson(actual_minutes / 30),
+                               'start_timestamp': start_epoch, 'start_time_iso': iso_times(start_epoch, 'Z'),
+                               'start_time_timezone': zone_names, 'start_time_offset': offsets, 'end_timestamp': end_epoch,
+                               'end_time_iso': iso_times(end_epoch, 'Z'), 'end_time_timezone': zone_names, 'end_time_offset': offsets,
+                               '': ''}, columns=SLEEP_COLUMNS)
+    return sleep_data, int(days[-1]) + 1
+
+def synthetic_activities(rng, n_rows, first_day, n_days, flights_per_week):
+    '''Generates activity rows in the format of the activity export, spread evenly over a range of days. Flights are labeled either
+    airplane or transport, like in the real export.
+
+    Arguments:
+    rng = numpy random generator
+    n_rows = number of activity rows to generate, integer
+    first_day = day number (days after START_DATE) of the first row, integer
+    n_days = number of days the rows are spread over, integer
+    flights_per_week = average number of flights per week, number
+
+    Returns:
+    activity_data = a dataframe with the activity export columns'''
+    days = first_day + (np.arange(n_rows) * n_days) // max(n_rows, 1)
+    start_epoch = np.sort((START_DATE + days).astype('datetime64[s]').astype(np.int64) + rng.integers(0, 86400, n_rows))
+    #Ground activities
+    ground = rng.choice(len(GROUND_ACTIVITIES), size=n_rows, p=GROUND_ACTIVITIES_P)
+    activity = np.array([label for label, _ in GROUND_ACTIVITIES], dtype=object)[ground]
+    speed = np.array([speed for _, speed in GROUND_ACTIVITIES])[ground] * rng.uniform(0.5, 1.5, n_rows)
+    duration = rng.exponential(600, n_rows).astype(np.int64) + 5
+    #Flights, about two thirds of them labeled transport instead of airplane
+    flight_p = min(flights_per_week * n_days / 7 / max(n_rows, 1), 1)
+    is_flight = rng.random(n_rows) < flight_p
+    activity[is_flight] = np.where(rng.random(is_flight.sum()) < 0.35, 'airplane', 'transport')
+    speed[is_flight] = rng.uniform(250, 550, is_flight.sum())
+    duration[is_flight] = rng.uniform(0.3, 12, is_flight.sum()) * 3600
+    distance = np.round(speed * duration / 3600, 3)
+    group = np.where(activity == 'airplane', 'transport', activity)
+    steps = np.where(np.isin(activity, ['walking', 'running']), (distance * 2200).astype(np.int64), 0)
+    local_offset = -7 * 3600
+    #Dates are written as M/D/YYYY without leading zeros, built from the date parts so it works on every platform
+    local_dates = pd.Series(pd.to_datetime(start_epoch + local_offset, unit='s'))
+    dates = (local_dates.dt.month.astype(str) + '/' + local_dates.dt.day.astype(str) + '/' + local_dates.dt.year.astype(str)).to_numpy()
+    activity_data = pd.DataFrame({'Date': dates, 'Activity': activity, 'Group': group,
+                                  'Start': iso_times(start_epoch + local_offset, '-07:00'),
+                                  'End': iso_times(start_epoch + duration + local_offset, '-07:00'),
+                                  'Duration': duration, 'Distance': distance, 'Steps': steps,
+                                  'Calories': (duration / 60 * rng.uniform(1, 10, n_rows)).astype(np.int64)}, columns=ACTIVITY_COLUMNS)
+    return activity_data
+
+def write_synthetic_participant(sleep_csv, activity_csv, n_sleep_rows, n_activity_rows, seed=None, flights_per_week=1.0,
+                                chunk_rows=1000000):
+    '''Writes synthetic sleep and activity csv files for one participant a chunk at a time, so files larger than memory can be made.
+
+    Arguments:
+    sleep_csv = path of the sleep csv file to write, a string
+    activity_csv = path of the activity csv file to write, a string
+    n_sleep_rows = number of sleep rows, integer
+    n_activity_rows = number of activity rows, integer
+    seed = seed for the random numbers, integer or None
+    flights_per_week = average number of flights per week, number
+    chunk_rows = number of rows generated and written at a time, integer
+
+    Returns:
+    writes the two csv files'''
+    rng = np.random.default_rng(seed)
+    #The days spanned are set by the sleep rows, and the activities are spread over the same days
+    mean_sleeps_per_day = np.dot(SLEEPS_PER_DAY, SLEEPS_PER_DAY_P)
+    n_days = max(int(np.ceil(n_sleep_rows / mean_sleeps_per_day)), 1)
+    if n_days > MAX_DAYS:
+        raise ValueError('{} sleep rows span more than {} days, split them across more participants'.format(n_sleep_rows, MAX_DAYS))
+    day = 0
+    for start in range(0, n_sleep_rows, chunk_rows):
+        chunk, day = synthetic_sleep(rng, min(chunk_rows, n_sleep_rows - start), day)
+        chunk.to_csv(sleep_csv, mode='w' if start == 0 else 'a', header=start == 0, index=False)
+    n_days = max(day, 1)
+    for start in range(0, max(n_activity_rows, 1), chunk_rows):
+        n_rows = min(chunk_rows, n_activity_rows - start)
+        first_day = (start * n_days) // max(n_activity_rows, 1)
+        last_day = ((start + n_rows) * n_days) // max(n_activity_rows, 1)
+        chunk = synthetic_activities(rng, n_rows, first_day, max(last_day - first_day, 1), flights_per_week)
+        chunk.to_csv(activity_csv, mode='w' if start == 0 else 'a', header=start == 0, index=False)
+
+def write_synthetic_cohort(out_dir, n_participants, total_rows, activities_per_sleep=24, seed=None, flights_per_week=1.0):
+    '''Writes synthetic csv files for a cohort, named <participant>_sleep.csv and <participant>_activities.csv so they can be used with
+    the batch mode of the command line interface. The rows are split evenly between participants.
+
+    Arguments:
+    out_dir = folder to write the files to, a string
+    n_participants = number of participants, integer
+    total_rows = total number of sleep and activity rows across the cohort, integer
+    activities_per_sleep = number of activity rows per sleep row, number. The real participant has about 24.
+    seed = seed for the random numbers, integer or None
+    flights_per_week = average number of flights per week, number
+
+    Returns:
+    participants = a dataframe with columns participant, sleep_data_csv, and activity_data_csv'''
+    os.makedirs(out_dir, exist_ok=True)
+    rows_per_participant = total_rows // n_participants
+    n_sleep_rows = max(int(rows_per_participant / (1 + activities_per_sleep)), 1)
+    n_activity_rows = max(rows_per_participant - n_sleep_rows, 1)
+    seeds = np.random.SeedSequence(seed).spawn(n_participants)
+    rows = []
+    for i in range(n_participants):
+        participant = 'p{:05d}'.format(i)
+        sleep_csv = os.path.join(out_dir, participant + '_sleep.csv')
+        activity_csv = os.path.join(out_dir, participant + '_activities.csv')
+        write_synthetic_participant(sleep_csv, activity_csv, n_sleep_rows, n_activity_rows, seeds[i], flights_per_week)
+        rows.append({'participant': participant, 'sleep_data_csv': sleep_csv, 'activity_data_csv': activity_csv})
+    return pd.DataFrame(rows)
+
+#-------------------------------------------------------------------------------------------------------------------------------------
+
+#Section 2: benchmark the analysis stages
+
+def run_stages(sleep_csv, activity_csv, plot_file, date_string, decimals):
+    '''Runs every stage of the analysis once and yields after each one, so the caller can measure the stages separately.
+
+    Arguments:
+    sleep_csv = path of the sleep csv file, a string
+    activity_csv = path of the activity csv file, a string
+    plot_file = path of the image file plot_data saves the figure to, a string
+    Date_string = the number of characters to keep from the time columns to keep just the date in the format YYYY-MM-DD
+    Decimals = the number of decimals you want answers rounded to, integer
+
+    Returns:
+    yields (stage name, rows in, rows out) after each stage'''
+    sleep_data, activity_data = read_data(sleep_csv, activity_csv)
+    yield 'read_data', 0, len(sleep_data) + len(activity_data)
+    sleep_sum_data = sleep_processing(sleep_data, date_string, decimals)
+    yield 'sleep_processing', len(sleep_data), len(sleep_sum_data)
+    flights = activity_processing(activity_data, date_string, decimals)
+    yield 'activity_processing', len(activity_data), len(flights)
+    flight_sleeps, non_flight_sleeps = flight_effect_sleep(flights, sleep_sum_data, decimals)
+    yield 'flight_effect_sleep', len(flights) + len(sleep_sum_data), len(flight_sleeps) + len(non_flight_sleeps)
+    plot_data(sleep_sum_data, flights, flight_sleeps, non_flight_sleeps, np.arange(0, 20, 1), np.arange(0, 15, 1), plot_file)
+    yield 'plot_data', len(sleep_sum_data) + len(flights), 1
+
+def benchmark_stages(sleep_csv, activity_csv, repeats=3, date_string=10, decimals=2):
+    '''Times every stage of the analysis and measures its peak memory. Timing and memory are measured in separate runs, because
+    tracing memory slows the code down. The fastest of the timing runs is reported. One untimed run is done first so that the one-off
+    import of the plotting and statistics libraries is not counted in the stage times.
+
+    Arguments:
+    sleep_csv = path of the sleep csv file, a string
+    activity_csv = path of the activity csv file, a string
+    repeats = number of timing runs, integer
+    Date_string = the number of characters to keep from the time columns to keep just the date in the format YYYY-MM-DD
+    Decimals = the number of decimals you want answers rounded to, integer
+
+    Returns:
+    results = a list of dictionaries, one per stage, with stage, rows_in, rows_out, seconds, and peak_bytes (peak memory allocated by the
+    stage on top of the memory in use when it started)'''
+    results = {stage: {'stage': stage, 'seconds': float('inf')} for stage in STAGES}
+    with tempfile.TemporaryDirectory() as plot_dir, contextlib.redirect_stdout(io.StringIO()), warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        plot_file = os.path.join(plot_dir, 'bench.png')
+        for _ in run_stages(sleep_csv, activity_csv, plot_file, date_string, decimals):
+            pass
+        for _ in range(repeats):
+            start = time.perf_counter()
+            for stage, rows_in, rows_out in run_stages(sleep_csv, activity_csv, plot_file, date_string, decimals):
+                elapsed = time.perf_counter() - start
+                results[stage].update({'rows_in': rows_in, 'rows_out': rows_out, 'seconds': min(results[stage]['seconds'], elapsed)})
+                start = time.perf_counter()
+        #Peak memory of each stage is measured above the memory already held when the stage starts
+        tracemalloc.start()
+        held = 0
+        for stage, _, _ in run_stages(sleep_csv, activity_csv, plot_file, date_string, decimals):
+            current, peak = tracemalloc.get_traced_memory()
+            results[stage]['peak_bytes'] = peak - held
+            held = current
+            tracemalloc.reset_peak()
+        tracemalloc.stop()
+    return [results[stage] for stage in STAGES]
+
+def run_benchmarks(row_counts, output_json, repeats=3, seed=0, work_dir=None):
+    '''Benchmarks every stage of the analysis on synthetic participants of each size and saves the results as json, together with the
+    versions of python, numpy, and pandas used so results from different runs can be compared.
+
+    Arguments:
+    row_counts = total rows (sleep plus activity) of the synthetic participant for each benchmark, a list of integers
+    output_json = path of the json file to write, a string
+    repeats = number of timing runs per size, integer
+    seed = seed for the synthetic data, integer
+    work_dir = folder for the synthetic csv files, a string, or None to use a temporary folder
+
+    Returns:
+    report = the dictionary written to output_json'''
+    report = {'python': platform.python_version(), 'numpy': np.__version__, 'pandas': pd.__version__,
+              'machine': platform.machine(), 'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'results': []}
+    with tempfile.TemporaryDirectory(dir=work_dir) as data_dir:
+        for rows in row_counts:
+            participant = write_synthetic_cohort(data_dir, 1, rows, seed=seed).iloc[0]
+            for result in benchmark_stages(participant['sleep_data_csv'], participant['activity_data_csv'], repeats):
+                report['results'].append(dict(result, rows=rows))
+    with open(output_json, 'w') as file:
+        json.dump(report, file, indent=2)
+    return report
+
+#-------------------------------------------------------------------------------------------------------------------------------------
+
+#Create help statements and arguments for the command line interface, call the functions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate synthetic wearable data and benchmark each stage of the sleep analysis on it.')
+    parser.add_argument('--rows', type=int, nargs='+', default=[1000, 10000, 100000],
+                        help='total rows (sleep plus activity) of the synthetic participant for each benchmark')
+    parser.add_argument('--repeats', type=int, default=3,
+                        help='number of timing runs per size, the fastest is reported')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed for the synthetic data')
+    parser.add_argument('--output', default='bench_results.json',
+                        help='json file the benchmark results are written to')
+    parser.add_argument('--work_dir', default=None,
+                        help='folder for the synthetic csv files, defaults to the system temporary folder')
+    parser.add_argument('--generate_only',
+                        help='only write a synthetic cohort to this folder instead of running the benchmarks. With more than one --rows, each size is written to its own subfolder named rows_<rows>')
+    parser.add_argument('--participants', type=int, default=1,
+                        help='number of participants to generate with --generate_only, the rows are split between them')
+    args = parser.parse_args()
+    if args.generate_only:
+        for rows in args.rows:
+            #Each size gets its own folder, as the participant files of every size have the same names
+            out_dir = args.generate_only if len(args.rows) == 1 else os.path.join(args.generate_only, 'rows_{}'.format(rows))
+            write_synthetic_cohort(out_dir, args.participants, rows, seed=args.seed)
+    else:
+        report = run_benchmarks(args.rows, args.output, args.repeats, args.seed, args.work_dir)
+        for result in report['results']:
+            print('{rows:>12} rows  {stage:<20} {seconds:10.4f} s  {peak_bytes:>14,} bytes'.format(**result))
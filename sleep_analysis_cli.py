@@ -15,9 +15,11 @@
 
 #Import necessary libraries and functions for the program
 
-from sleep_analysis_lib import read_data, sleep_processing, activity_processing, flight_effect_sleep, plot_data
+from sleep_analysis_lib import CACHE_DIR, StageProfiler, read_data, read_data_chunked, clear_cache, load_flight_rules, rule_labels, run_pipeline, resample_effect, daily_series, dose_response, find_participants, read_manifest, run_batch, IngestStats, EffectResult, effect_text, sweep_parameters, new_running_state, load_running_state, update_running_state, save_running_state, running_effect
 import numpy as np
 import argparse
+import contextlib
+import os
 
 #-------------------------------------------------------------------------------------------------------------------------------------
 
@@ -40,20 +42,202 @@ if __name__ == '__main__':
     #Add description of what the program does.
     parser = argparse.ArgumentParser(description='Analyze wearable data to determine airplane travel\'s effect on sleep. Takes two input CSV files as arguments, \'sleep_data_csv\' and \'activity_data_csv\'.')
     #Add argument for sleep data input file
-    parser.add_argument('--sleep_data_csv', required=True,
+    parser.add_argument('--sleep_data_csv',
                         help='sleep data from wearable with columns \'start_time_iso\' with GMT date and time of sleep starting and \'actual_minutes\' with sleep duration in minutes')
     #Add argument for activity data input dfile
-    parser.add_argument('--activity_data_csv', required=True,
+    parser.add_argument('--activity_data_csv',
                         help='activity data from wearable with columns \'Start\' with GMT date and time of activity start, \'Duration\' with activity duration in seconds, \'Distance\' with distance travelled in miles, and \'Activity\' with activity type label ')
+    #Add arguments for the resampling tests of the flight effect
+    parser.add_argument('--resamples', type=int, default=0,
+                        help='number of permutation and bootstrap replicates used to test the flight effect, 0 (the default) skips resampling')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='seed for the permutation and bootstrap replicates so results can be reproduced')
+    #Add arguments for running without a plot window
+    plot_group = parser.add_mutually_exclusive_group()
+    plot_group.add_argument('--no_plot', action='store_true',
+                        help='skip plotting, only compute and print the statistics')
+    plot_group.add_argument('--plot_to',
+                        help='folder to save the figure to as \'sleep_analysis.png\' instead of showing it, does not need a display')
+    #Add argument for putting sleeps on their local day
+    parser.add_argument('--local_time', action='store_true',
+                        help='put each sleep on its local day using the \'start_time_offset\' column of the sleep data instead of its GMT day, single participant analysis only')
+    #Add argument for the after-flight window
+    parser.add_argument('--days_affected', type=int, default=3,
+                        help='number of days, including the day of the flight, counted as affected by a flight, defaults to 3')
+    #Add argument for custom flight definitions
+    parser.add_argument('--flight_rules', default=None,
+                        help='json file with the rules that define which activities are flights, replaces the default airplane and transport rules')
+    #Add argument for reading large input files in chunks
+    parser.add_argument('--chunksize', type=int, default=None,
+                        help='number of rows to read from the input files at a time, use for very large files to keep memory use bounded')
+    #Add arguments for the cache of parsed input files
+    parser.add_argument('--cache_dir', default=CACHE_DIR,
+                        help='folder where parsed input files are cached so that repeated runs on the same files skip csv parsing')
+    parser.add_argument('--no_cache', action='store_true',
+                        help='always parse the input csv files and do not read or write the cache')
+    parser.add_argument('--clear_cache', action='store_true',
+                        help='remove every entry from the cache before running, can be given without input files to only clear the cache')
+    #Add arguments for running a whole cohort at once instead of a single participant
+    batch_group = parser.add_mutually_exclusive_group()
+    batch_group.add_argument('--batch_manifest',
+                        help='csv file with columns \'participant\', \'sleep_data_csv\', and \'activity_data_csv\' listing the input files of each participant to analyze')
+    batch_group.add_argument('--batch_dir',
+                        help='directory with one \'<participant>_sleep.csv\' and one \'<participant>_activities.csv\' file per participant to analyze')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of worker processes used in batch mode and for resampling, defaults to the number of cores in batch mode and to 1 for resampling one participant')
+    parser.add_argument('--batch_output', default='batch_results.csv',
+                        help='file the batch results are written to as each participant finishes, as json lines if it ends in .jsonl and csv otherwise, defaults to \'batch_results.csv\'')
+    parser.add_argument('--prefetch', type=int, default=0,
+                        help='in batch mode, number of threads that read and decompress (.gz or .zst) the files of the next participants while the current one is analyzed, use for slow or network storage')
+    parser.add_argument('--max_inflight_mb', type=float, default=512,
+                        help='with --prefetch, the most megabytes of decompressed file contents read ahead at once, defaults to 512')
+    parser.add_argument('--plot_dir',
+                        help='in batch mode, also save the histograms of every participant to this folder as <participant>.png (or --plot_format)')
+    parser.add_argument('--plot_format', default='png', choices=['png', 'svg', 'pdf'],
+                        help='image format of the batch histograms, defaults to png')
+    parser.add_argument('--daily_store',
+                        help='in batch mode, also write the daily sleep hours and flight days of every participant to this memory-mapped store file for fast cohort queries')
+    #Add arguments for sweeping the analysis parameters to test how robust the flight effect is
+    parser.add_argument('--sweep_output',
+                        help='run a parameter sweep on the input files instead of the normal analysis and write one row per parameter combination to this csv file')
+    parser.add_argument('--sweep_days', type=int, nargs='+', default=None,
+                        help='numbers of days affected by a flight to try in the sweep, defaults to --days_affected')
+    parser.add_argument('--sweep_lower_speed', type=float, nargs='+', default=None,
+                        help='lower speed thresholds in miles/hour for transport flights to try in the sweep, defaults to 100, cannot be used with --flight_rules')
+    parser.add_argument('--sweep_upper_speed', type=float, nargs='+', default=None,
+                        help='upper speed thresholds in miles/hour for transport flights to try in the sweep, defaults to 700, cannot be used with --flight_rules')
+    parser.add_argument('--sweep_lower_duration', type=float, nargs='+', default=None,
+                        help='lower flight duration thresholds in hours to try in the sweep, defaults to 0.5, cannot be used with --flight_rules')
+    #Add arguments for relating the hours flown to sleep over the following days
+    parser.add_argument('--dose_response',
+                        help='csv file to write the relation between hours flown on a day and hours slept 0 to --max_lag days later to, with the recovery curve after flights')
+    parser.add_argument('--max_lag', type=int, default=7,
+                        help='largest number of days after a flight used with --dose_response, defaults to 7')
+    #Add argument for comparing every sleep quality metric of the export after flights and on other days
+    parser.add_argument('--sleep_metrics',
+                        help='csv file to write the flight effect on each daily sleep quality metric (sleep stage minutes, interruptions, toss and turns, and duration-weighted heart rate) to')
+    #Add argument for adding new data to a saved running state instead of analyzing the full history
+    parser.add_argument('--state',
+                        help='json file with the running state of a participant. The input files are treated as new rows that are added to the state (created if it does not exist), and the updated t test and Cohen\'s d are printed.')
+    #Add arguments for profiling the stages of the analysis
+    parser.add_argument('--profile',
+                        help='json file to write a report of the wall time, CPU time, peak memory, and rows in and out of each stage of the analysis to')
+    parser.add_argument('--cprofile_dir',
+                        help='with --profile, also save a cProfile stats file for each stage to this folder')
     #Create arguments
     args = parser.parse_args()
-    #Read in the data
-    sleep_data, activity_data = read_data(args.sleep_data_csv, args.activity_data_csv)
-    #Process the sleep data, get stats, and show histogram
-    sleep_sum_data = sleep_processing(sleep_data, DATE_STRING, DECIMALS)
-    #Process activity data
-    flights = activity_processing(activity_data, DATE_STRING, DECIMALS)
-    #Compare flight-effected sleeps vs non flight-effected sleeps
-    flight_sleeps, non_flight_sleeps = flight_effect_sleep(flights, sleep_sum_data, DECIMALS)
-    #Create plots
-    plot_data(sleep_sum_data, flights, flight_sleeps, non_flight_sleeps, sleep_bins, flight_bins)
\ No newline at end of file
+    #Local days are only supported by the single participant analysis
+    if args.local_time and (args.batch_manifest or args.batch_dir or args.sweep_output or args.state):
+        parser.error('--local_time can only be used for a single participant, not with --batch_manifest, --batch_dir, --sweep_output, or --state')
+    #The chunked reader keeps only the columns of the flight effect, so the sleep metrics need the whole sleep file read at once
+    if args.sleep_metrics and args.chunksize:
+        parser.error('--sleep_metrics cannot be used with --chunksize')
+    #Custom flight rules replace the default rules that the threshold grids of the sweep are made from
+    if args.flight_rules and (args.sweep_lower_speed or args.sweep_upper_speed or args.sweep_lower_duration):
+        parser.error('--sweep_lower_speed, --sweep_upper_speed, and --sweep_lower_duration cannot be used with --flight_rules')
+    rules = load_flight_rules(args.flight_rules) if args.flight_rules else None
+    #Set up the cache
+    if args.clear_cache:
+        clear_cache(args.cache_dir)
+        if not (args.sleep_data_csv or args.activity_data_csv or args.batch_manifest or args.batch_dir):
+            parser.exit(message='cleared cache ' + args.cache_dir + '\n')
+    cache_dir = None if args.no_cache else args.cache_dir
+    #Run every participant in the cohort and write one results table
+    if args.batch_manifest or args.batch_dir:
+        if args.batch_manifest:
+            participants = read_manifest(args.batch_manifest)
+        else:
+            participants = find_participants(args.batch_dir)
+        ingest_stats = IngestStats()
+        results = run_batch(participants, DATE_STRING, DECIMALS, days_affected_by_flight=args.days_affected, workers=args.workers, cache_dir=cache_dir,
+                            n_resamples=args.resamples, seed=args.seed, output=args.batch_output, prefetch=args.prefetch,
+                            max_inflight_bytes=int(args.max_inflight_mb * 1024 ** 2), ingest_stats=ingest_stats, store=args.daily_store,
+                            plot_dir=args.plot_dir, plot_format=args.plot_format, sleep_bins=sleep_bins, flight_bins=flight_bins, rules=rules)
+        failed = results.loc[results['error'].fillna('') != '', ['participant', 'error']]
+        print('analyzed', len(results), 'participants,', len(failed), 'failed, results written to', args.batch_output)
+        for participant, error in failed.itertuples(index=False, name=None):
+            print('  failed', participant + ':', error)
+        if args.daily_store:
+            print('daily sleep and flight days of', len(results) - len(failed), 'participants written to', args.daily_store)
+        if args.prefetch:
+            print('read', ingest_stats.files, 'files,', round(ingest_stats.bytes_read / 1024 ** 2, 1), 'MB on disk,',
+                  round(ingest_stats.bytes_decompressed / 1024 ** 2, 1), 'MB decompressed at', round(ingest_stats.throughput, 1),
+                  'MB/s, analysis waited', round(ingest_stats.wait_seconds, 2), 'seconds for files')
+        if args.plot_dir:
+            print('histograms of', len(results) - len(failed), 'participants written to', args.plot_dir)
+    elif args.state:
+        if not args.sleep_data_csv and not args.activity_data_csv:
+            parser.error('--state needs new rows from --sleep_data_csv, --activity_data_csv, or both')
+        if os.path.exists(args.state):
+            state = load_running_state(args.state)
+            #The saved moments are split by the window the state was started with, so a different window cannot be added to them
+            if state['days_affected_by_flight'] != args.days_affected:
+                parser.error('--state ' + args.state + ' was started with --days_affected ' + str(state['days_affected_by_flight']))
+            #Flight days already in the state were found with the rules it was started with
+            if state.get('rules') != rules:
+                parser.error('--state ' + args.state + ' was started with other --flight_rules')
+        else:
+            state = new_running_state(DATE_STRING, DECIMALS, args.days_affected, rules)
+        #Read in only the new rows given. New rows are usually small and read once, so they are not cached.
+        new_sleep_data, new_activity_data = read_data(args.sleep_data_csv, args.activity_data_csv)
+        update_running_state(state, new_sleep_data, new_activity_data)
+        save_running_state(state, args.state)
+        print(effect_text(EffectResult(**running_effect(state)), DECIMALS))
+    else:
+        if not args.sleep_data_csv or not args.activity_data_csv:
+            parser.error('--sleep_data_csv and --activity_data_csv are required unless --batch_manifest, --batch_dir, or --state is given')
+        #Read in the data
+        if args.sweep_output:
+            sleep_data, activity_data = read_data(args.sleep_data_csv, args.activity_data_csv, cache_dir)
+            sweep_days = args.sweep_days or [args.days_affected]
+            results = sweep_parameters(sleep_data, activity_data, DATE_STRING, DECIMALS, sweep_days, args.sweep_lower_speed or [100],
+                                       args.sweep_upper_speed or [700], args.sweep_lower_duration or [0.5], workers=args.workers,
+                                       rules=rules)
+            results.to_csv(args.sweep_output, index=False)
+            parser.exit(message='evaluated ' + str(len(results)) + ' parameter combinations, results written to ' + args.sweep_output + '\n')
+        #Profile the stages if asked, otherwise the profiler is not registered and adds no work
+        profiler = StageProfiler(args.cprofile_dir) if args.profile else contextlib.nullcontext()
+        with profiler:
+            #Run the analysis as a graph of stages. Stages whose inputs and parameters have not changed since an earlier run are
+            #reused from the cache instead of run again.
+            params = {'sleep_data_csv': args.sleep_data_csv, 'activity_data_csv': args.activity_data_csv, 'date_string': DATE_STRING,
+                      'decimals': DECIMALS, 'local_time': args.local_time, 'rules': rules, 'days_affected_by_flight': args.days_affected,
+                      'sleep_bins': sleep_bins, 'flight_bins': flight_bins, 'sleep_metrics': bool(args.sleep_metrics)}
+            given = {}
+            if args.chunksize:
+                labels = rule_labels(rules) if rules else None
+                given['sleep_data'], given['activity_data'] = read_data_chunked(args.sleep_data_csv, args.activity_data_csv, DATE_STRING,
+                                                                               args.chunksize, labels, args.local_time)
+            #With --sleep_metrics the sleep file is read once with the metric columns, and the metrics are made from that same read
+            targets = ['sleep_sum_data', 'flights', 'flight_effect'] + (['sleep_metric_effects'] if args.sleep_metrics else [])
+            outputs, report = run_pipeline(params, targets, cache_dir, given)
+            sleep_sum_data, flights = outputs['sleep_sum_data'], outputs['flights']
+            flight_sleeps, non_flight_sleeps = outputs['flight_effect']
+            #Test the flight effect with permutation and bootstrap replicates
+            if args.resamples > 0:
+                #One participant's replicates are quick, so a process pool is only used if --workers is given
+                resampled = resample_effect(flight_sleeps, non_flight_sleeps, args.resamples, seed=args.seed, workers=args.workers or 1)
+                print('permutation test p value =', round(float(resampled['permutation_p']), DECIMALS + 2))
+                print('95% bootstrap CI of difference in mean sleep =', [round(float(bound), DECIMALS) for bound in resampled['mean_diff_ci']], 'hours')
+                print('95% bootstrap CI of Cohen\'s d =', [round(float(bound), DECIMALS) for bound in resampled['cohens_d_ci']])
+            #Relate hours flown to sleep over the following days
+            if args.dose_response:
+                dose_response([daily_series(sleep_sum_data, flights)], args.max_lag).to_csv(args.dose_response, index=False)
+                print('dose-response for lags 0 to', args.max_lag, 'days written to', args.dose_response)
+            #Compare all the sleep quality metrics of the export in one pass over the sleeps
+            if args.sleep_metrics:
+                metric_effects = outputs['sleep_metric_effects']
+                metric_effects.to_csv(args.sleep_metrics)
+                print('flight effect on', len(metric_effects), 'sleep metrics written to', args.sleep_metrics)
+            #Create plots last. The stages before the plot were just run, so they are reused from memory without printing again.
+            if not args.no_plot:
+                if args.plot_to:
+                    os.makedirs(args.plot_to, exist_ok=True)
+                    params['plot_file'] = os.path.join(args.plot_to, 'sleep_analysis.png')
+                report['plot'] = run_pipeline(params, ['plot'], cache_dir, given, replay=False)[1]['plot']
+        reused = [name for name, how in report.items() if how in ('memory', 'disk')]
+        if reused:
+            print('reused cached results of', ', '.join(reused), '; ran', ', '.join(name for name, how in report.items() if how == 'run') or 'nothing')
+        if args.profile:
+            profiler.write_report(args.profile)
+            print('stage profile written to', args.profile)
\ No newline at end of file
@@ -15,36 +15,523 @@
 
 #Import necessary libraries and functions for the program
 
+import numpy as np
 from numpy import mean, var
 import pandas as pd
-import matplotlib.pyplot as plt
-import logging
-from datetime import timedelta
-from scipy import stats
+import os
+import io
+import contextlib
+import csv
+import hashlib
+import json
+import pickle
+import shutil
+import sys
+import tempfile
+import itertools
+import functools
+import time
+import tracemalloc
+import cProfile
+from concurrent.futures import ProcessPoolExecutor, as_completed, wait, FIRST_COMPLETED
 from math import sqrt
-from IPython.display import display
+#matplotlib.pyplot and scipy.stats are slow to import, so they are imported inside the functions that use them. This keeps start up fast
+#for runs that only need part of the analysis, such as batch runs that do not plot.
 
 #-------------------------------------------------------------------------------------------------------------------------------------
 
 #Section 0: Define necessary support functions to be used with the main analysis functions in the following sections. These include
 #reading in the data, calculating basic stats, plotting a histogram, and calculating cohen's d.
 
-def read_data(sleep_data_in, activity_data_in):
-    '''Reads input data from a csv into python.
+#Hooks that are told when each stage of the analysis starts and ends, see add_stage_hook. Empty unless profiling is turned on.
+STAGE_HOOKS = []
+
+def add_stage_hook(hook):
+    '''Registers a hook that is told when each stage of the analysis (read_data or read_data_chunked, sleep_processing,
+    activity_processing, flight_effect_sleep, and plot_data) starts and ends. A hook is an object with methods start_stage(name) and
+    end_stage(name, rows_in, rows_out), like StageProfiler. It may also have a method reused_stage(name, source), which run_pipeline
+    calls for each stage of PIPELINE_STAGES whose output it reused from 'memory' or 'disk' instead of running it.
+
+    Arguments:
+    hook = the hook to register'''
+    STAGE_HOOKS.append(hook)
+
+def remove_stage_hook(hook):
+    '''Unregisters a hook added with add_stage_hook.
+
+    Arguments:
+    hook = the hook to unregister'''
+    STAGE_HOOKS.remove(hook)
+
+def count_rows(values):
+    '''Counts the dataframe rows in a stage's arguments or results.
+
+    Arguments:
+    values = a list or tuple of arguments or results
+
+    Returns:
+    rows = total number of rows of the dataframes and series among the values, integer'''
+    return sum(len(value) for value in values if isinstance(value, (pd.DataFrame, pd.Series)))
+
+def pipeline_stage(function):
+    '''Decorator that reports each call of a pipeline stage to the registered stage hooks, with the number of rows the stage was
+    given and returned. When no hooks are registered the function is called directly, so the cost of instrumentation is one check.
+
+    Arguments:
+    function = the stage function to wrap
+
+    Returns:
+    wrapper = the wrapped function'''
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if not STAGE_HOOKS:
+            return function(*args, **kwargs)
+        name = function.__name__
+        #Count the rows given before the stage runs, in case it changes its arguments
+        rows_in = count_rows(list(args) + list(kwargs.values()))
+        hooks = list(STAGE_HOOKS)
+        for hook in hooks:
+            hook.start_stage(name)
+        rows_out = None
+        try:
+            result = function(*args, **kwargs)
+            rows_out = count_rows(result if isinstance(result, tuple) else (result,))
+        finally:
+            #The hooks are always told the stage ended, also when it raised (rows_out is None then), so they can clean up
+            for hook in reversed(hooks):
+                hook.end_stage(name, rows_in, rows_out)
+        return result
+    return wrapper
+
+class StageProfiler:
+    '''A stage hook that records the wall time, CPU time, peak memory, and rows in and out of every stage, and optionally saves a
+    cProfile of each stage. Peak memory is traced with tracemalloc and is measured above the memory in use when the stage starts.
+    Stages called from inside another stage (such as sleep_processing inside sweep_inputs) are part of the outer stage's
+    measurements and are not recorded separately, since tracemalloc and cProfile can only follow one stage at a time. A stage that
+    raises is recorded with rows_out None and 'failed' True.
+
+    Use it as a context manager around the stages to profile:
+        with StageProfiler() as profiler:
+            ...
+        profiler.write_report('profile.json')'''
+
+    def __init__(self, cprofile_dir=None):
+        '''Arguments:
+        cprofile_dir = folder to save a cProfile stats file per stage to, a string, or None to skip cProfile'''
+        self.cprofile_dir = cprofile_dir
+        self.stages = []
+        self.reused = []
+        self._open = []
+
+    def __enter__(self):
+        self._started_tracing = not tracemalloc.is_tracing()
+        if self._started_tracing:
+            tracemalloc.start()
+        add_stage_hook(self)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        remove_stage_hook(self)
+        if self._started_tracing:
+            tracemalloc.stop()
+
+    def start_stage(self, name):
+        '''Starts the clocks, memory tracing, and cProfile for a stage.
+
+        Arguments:
+        name = name of the stage, a string'''
+        #Only the outermost stage is measured. Nested stages are kept on the stack (as None) so their ends can be matched.
+        if self._open:
+            self._open.append(None)
+            return
+        tracemalloc.reset_peak()
+        profile = None
+        if self.cprofile_dir is not None:
+            profile = cProfile.Profile()
+            profile.enable()
+        self._open.append((name, time.perf_counter(), time.process_time(), tracemalloc.get_traced_memory()[0], profile))
+
+    def end_stage(self, name, rows_in, rows_out):
+        '''Records the measurements of a stage that has finished.
+
+        Arguments:
+        name = name of the stage, a string
+        rows_in = number of rows the stage was given, integer
+        rows_out = number of rows the stage returned, integer, or None if the stage raised'''
+        opened = self._open.pop()
+        if opened is None:
+            return
+        _, wall_start, cpu_start, memory_start, profile = opened
+        if profile is not None:
+            profile.disable()
+        record = {'stage': name, 'wall_seconds': time.perf_counter() - wall_start, 'cpu_seconds': time.process_time() - cpu_start,
+                  'peak_bytes': tracemalloc.get_traced_memory()[1] - memory_start, 'rows_in': rows_in, 'rows_out': rows_out,
+                  'failed': rows_out is None}
+        if profile is not None:
+            os.makedirs(self.cprofile_dir, exist_ok=True)
+            record['cprofile'] = os.path.join(self.cprofile_dir, '{:02d}_{}.prof'.format(len(self.stages), name))
+            profile.dump_stats(record['cprofile'])
+        self.stages.append(record)
+
+    def reused_stage(self, name, source):
+        '''Records a pipeline stage that was not run because its output was reused, so it is listed in the report without timings.
+
+        Arguments:
+        name = name of the pipeline stage, a string
+        source = where the output was reused from, 'memory' or 'disk', a string'''
+        self.reused.append({'stage': name, 'reused_from': source})
+
+    def report(self):
+        '''Returns:
+        report = a dictionary with the list of stage records, the total wall and CPU time, and the list of pipeline stages that were
+        reused instead of run and so have no measurements'''
+        return {'stages': self.stages, 'total_wall_seconds': sum(stage['wall_seconds'] for stage in self.stages),
+                'total_cpu_seconds': sum(stage['cpu_seconds'] for stage in self.stages), 'reused_stages': self.reused}
+
+    def write_report(self, path):
+        '''Saves the report as json.
+
+        Arguments:
+        path = path of the json file, a string'''
+        with open(path, 'w') as file:
+            json.dump(self.report(), file, indent=2)
+
+#Columns used by the analysis and the compact types they are read in as. Only these columns are parsed from the input files.
+#start_time_offset is optional and only used to put sleeps on their local day.
+#actual_minutes is a float so that blank values are read as NaN and skipped in the daily sums. Whole minutes are exact in float32.
+SLEEP_DTYPES = {'start_time_iso': str, 'actual_minutes': 'float32', 'start_time_offset': 'float32'}
+#Sleep stage, restlessness, and heart rate columns of the full export, read only for sleep_metrics. Any of them may be missing or empty.
+SLEEP_METRIC_DTYPES = {'light_minutes': 'float32', 'deep_minutes': 'float32', 'rem_minutes': 'float32', 'interruptions': 'float32',
+                       'toss_and_turn': 'float32', 'heart_rate_avg': 'float32'}
+#Device is optional and only used by per-device flight rules.
+#Duration and Distance stay float64, since the speed made from them is compared to strict thresholds and must not move across them.
+ACTIVITY_DTYPES = {'Start': str, 'Duration': 'float64', 'Distance': 'float64', 'Activity': 'category', 'Device': 'category'}
+#Activity labels that can be flights, used to drop all other activities early when streaming large files
+FLIGHT_CANDIDATE_LABELS = ['airplane', 'transport']
+
+#Default location and size limit of the on-disk cache of parsed input files. Bump CACHE_VERSION when the cache layout changes.
+CACHE_DIR = os.environ.get('SLEEP_ANALYSIS_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'sleep_analysis'))
+CACHE_MAX_BYTES = 1024 ** 3
+CACHE_VERSION = 2
+#Entries are written to temporary folders with this prefix and renamed into place. Eviction leaves them alone unless they are older than
+#CACHE_TMP_MAX_AGE seconds, which means the process writing them stopped before it finished.
+CACHE_TMP_PREFIX = 'tmp-'
+CACHE_TMP_MAX_AGE = 3600
+
+def file_hash(path):
+    '''Calculates the sha256 hash of a file's contents, reading it a block at a time.
+
+    Arguments:
+    path = path to the file, a string
+
+    Returns:
+    digest = the hex digest of the file contents, a string'''
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1024 * 1024), b''):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+def cache_key(path, dtypes):
+    '''Builds the cache key of a parsed csv file from the hash of its contents and the columns and types it is read with, so that
+    the cache entry changes whenever either one changes.
+
+    Arguments:
+    path = path to the csv file, a string, or the contents of the file, bytes
+    dtypes = dictionary of column names to the types they are read as
+
+    Returns:
+    key = the cache key, a string'''
+    spec = json.dumps({'version': CACHE_VERSION, 'columns': {column: str(dtype) for column, dtype in dtypes.items()}}, sort_keys=True)
+    digest = hashlib.sha256(path).hexdigest() if isinstance(path, bytes) else file_hash(path)
+    return hashlib.sha256((digest + spec).encode()).hexdigest()
+
+def csv_source(path):
+    '''Gives something pandas can read a csv from: the path itself, or a buffer over file contents that were already read into memory.
+
+    Arguments:
+    path = path to the csv file (compressed files such as .gz are read by pandas), a string, or the contents of the file, bytes
+
+    Returns:
+    source = the path or a bytes buffer'''
+    return io.BytesIO(path) if isinstance(path, bytes) else path
+
+def write_cache_entry(data, entry_dir):
+    '''Saves a dataframe as one .npy file per column. Categorical columns are saved as their integer codes plus their categories, and
+    text columns as fixed width unicode arrays with a mask of the missing values, so that every column can be memory-mapped when it is
+    loaded. The entry is written to a temporary folder and renamed into place so that a partly written entry is never read.
+
+    Arguments:
+    data = the dataframe to save
+    entry_dir = the folder of the cache entry, a string
+
+    Returns:
+    writes the cache entry folder'''
+    tmp_dir = tempfile.mkdtemp(prefix=CACHE_TMP_PREFIX, dir=os.path.dirname(entry_dir))
+    kinds = {}
+    for i, column in enumerate(data.columns):
+        values = data[column]
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            kinds[column] = 'category'
+            np.save(os.path.join(tmp_dir, '{}.npy'.format(i)), values.cat.codes.to_numpy())
+            np.save(os.path.join(tmp_dir, '{}.categories.npy'.format(i)), values.cat.categories.to_numpy(dtype=str))
+        elif pd.api.types.is_numeric_dtype(values.dtype):
+            kinds[column] = 'numeric'
+            np.save(os.path.join(tmp_dir, '{}.npy'.format(i)), values.to_numpy())
+        else:
+            kinds[column] = 'text'
+            #Missing values would be saved as the text 'nan', so they are saved as a mask and put back when the entry is read
+            missing = values.isna().to_numpy()
+            np.save(os.path.join(tmp_dir, '{}.npy'.format(i)), np.where(missing, '', values.to_numpy(dtype=object)).astype(str))
+            np.save(os.path.join(tmp_dir, '{}.missing.npy'.format(i)), missing)
+    with open(os.path.join(tmp_dir, 'columns.json'), 'w') as file:
+        json.dump({'columns': list(data.columns), 'kinds': kinds}, file)
+    try:
+        os.rename(tmp_dir, entry_dir)
+    except OSError:
+        #Another process already cached the same file
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+def read_cache_entry(entry_dir):
+    '''Loads a dataframe saved by write_cache_entry. Column files are memory-mapped rather than read into memory.
+
+    Arguments:
+    entry_dir = the folder of the cache entry, a string
+
+    Returns:
+    data = the cached dataframe'''
+    with open(os.path.join(entry_dir, 'columns.json')) as file:
+        layout = json.load(file)
+    columns = {}
+    for i, column in enumerate(layout['columns']):
+        #View the memory map as a plain array, the data stays on disk until it is used
+        values = np.load(os.path.join(entry_dir, '{}.npy'.format(i)), mmap_mode='r').view(np.ndarray)
+        if layout['kinds'][column] == 'category':
+            categories = np.load(os.path.join(entry_dir, '{}.categories.npy'.format(i)))
+            columns[column] = pd.Categorical.from_codes(values, categories=categories)
+        elif layout['kinds'][column] == 'text':
+            missing = np.load(os.path.join(entry_dir, '{}.missing.npy'.format(i)))
+            columns[column] = pd.Series(values, dtype=str).where(~missing)
+        else:
+            columns[column] = values
+    return pd.DataFrame(columns, columns=layout['columns'], copy=False)
+
+def cache_size(cache_dir):
+    '''Finds every entry in the cache with its size and last use time.
+
+    Arguments:
+    cache_dir = the cache folder, a string
+
+    Returns:
+    entries = a list of (last use time, size in bytes, entry folder) tuples, oldest first. Entries still being written by another
+    process are not listed.'''
+    entries = []
+    for name in os.listdir(cache_dir):
+        entry_dir = os.path.join(cache_dir, name)
+        try:
+            if name.startswith(CACHE_TMP_PREFIX) and time.time() - os.path.getmtime(entry_dir) < CACHE_TMP_MAX_AGE:
+                continue
+            size = sum(os.path.getsize(os.path.join(entry_dir, file_name)) for file_name in os.listdir(entry_dir))
+            entries.append((os.path.getmtime(entry_dir), size, entry_dir))
+        except OSError:
+            #The entry was removed by another process while we looked at it
+            continue
+    return sorted(entries)
+
+def evict_cache(cache_dir, max_bytes):
+    '''Removes the least recently used cache entries until the cache is no larger than max_bytes.
+
+    Arguments:
+    cache_dir = the cache folder, a string
+    max_bytes = the largest total size the cache may have, integer
+
+    Returns:
+    removes cache entry folders'''
+    entries = cache_size(cache_dir)
+    total = sum(size for _, size, _ in entries)
+    for _, size, entry_dir in entries:
+        if total <= max_bytes:
+            break
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        total -= size
+
+def clear_cache(cache_dir=CACHE_DIR):
+    '''Removes every entry from the cache.
+
+    Arguments:
+    cache_dir = the cache folder, a string
+
+    Returns:
+    removes the cache folder'''
+    shutil.rmtree(cache_dir, ignore_errors=True)
+
+def cached_read_csv(path, dtypes, cache_dir, max_bytes=CACHE_MAX_BYTES):
+    '''Reads the given columns of a csv file, using the cached copy if the same file has already been read with the same columns and
+    types. Otherwise the csv is parsed and added to the cache.
+
+    Arguments:
+    path = path to the csv file, a string, or the contents of the file, bytes
+    dtypes = dictionary of column names to the types they are read as
+    cache_dir = the cache folder, a string
+    max_bytes = the largest total size the cache may have, integer
+
+    Returns:
+    data = a pandas dataframe of the csv file'''
+    os.makedirs(cache_dir, exist_ok=True)
+    entry_dir = os.path.join(cache_dir, cache_key(path, dtypes))
+    if os.path.isdir(entry_dir):
+        #Mark the entry as recently used
+        os.utime(entry_dir)
+        return read_cache_entry(entry_dir)
+    data = pd.read_csv(csv_source(path), usecols=lambda column: column in dtypes, dtype=dtypes)
+    write_cache_entry(data, entry_dir)
+    evict_cache(cache_dir, max_bytes)
+    return data
+
+def read_csv_columns(path, dtypes, cache_dir=None):
+    '''Reads the given columns of a csv file with the given types, through the cache if a cache folder is given.
+
+    Arguments:
+    path = path to the csv file, a string, the contents of the file already read into memory (from fetch_input), bytes, or None
+    dtypes = dictionary of column names to the types they are read as
+    cache_dir = the cache folder, a string, or None to always parse the csv file
+
+    Returns:
+    data = a pandas dataframe of the csv file, or None if path is None'''
+    if path is None:
+        return None
+    if cache_dir is not None:
+        return cached_read_csv(path, dtypes, cache_dir)
+    return pd.read_csv(csv_source(path), usecols=lambda column: column in dtypes, dtype=dtypes)
+
+@pipeline_stage
+def read_data(sleep_data_in, activity_data_in, cache_dir=None, sleep_metrics=False):
+    '''Reads input data from a csv into python. Only the columns used by the analysis are read, with compact types. If a cache folder
+    is given, parsed files are kept there and files that have been read before are loaded from the cache instead of parsed again.
     
     Arguments:
-    sleep_data_in = a csv file with columns start_time_iso with GMT time and actual_minutes with sleep duration in minutes
-    activity_data_in = a csv file with columns Start with GMT time, Duration with activity duration in seconds, Distance with activity distance in miles, and Activity with activity label
+    sleep_data_in = a csv file with columns start_time_iso with GMT time and actual_minutes with sleep duration in minutes, or None
+    activity_data_in = a csv file with columns Start with GMT time, Duration with activity duration in seconds, Distance with activity distance in miles, and Activity with activity label, or None
+    cache_dir = the cache folder, a string, or None to always parse the csv files
+    sleep_metrics = if True, the SLEEP_METRIC_DTYPES columns are also read from the sleep file in the same pass, for sleep_metrics
+    Either file may also be given as its contents already read into memory, bytes, such as from prefetch_participants
     
     Returns:
-    sleep_data = a pandas dataframe of the sleep_data_in csv file
-    activity_data = a pandas dataframe of the activity_data_in csv file'''
+    sleep_data = a pandas dataframe of the sleep_data_in csv file (None if no file was given)
+    activity_data = a pandas dataframe of the activity_data_in csv file (None if no file was given)'''
     #read in the sleep data
-    sleep_data = pd.read_csv(sleep_data_in)
+    sleep_data = read_csv_columns(sleep_data_in, {**SLEEP_DTYPES, **SLEEP_METRIC_DTYPES} if sleep_metrics else SLEEP_DTYPES, cache_dir)
     #read in the activity data
-    activity_data = pd.read_csv(activity_data_in)
+    activity_data = read_csv_columns(activity_data_in, ACTIVITY_DTYPES, cache_dir)
+    return sleep_data, activity_data
+
+@pipeline_stage
+def read_data_chunked(sleep_data_in, activity_data_in, date_string, chunksize, labels=None, local_time=False):
+    '''Reads input data from a csv into python a chunk at a time so that very large files can be processed in bounded memory. Sleep is
+    summed per day within each chunk and the partial sums are combined at the end, and only activities that could be flights are kept. The outputs can be passed to sleep_processing and activity_processing just like the outputs of read_data.
+
+    Arguments:
+    sleep_data_in = a csv file with columns start_time_iso with GMT time and actual_minutes with sleep duration in minutes
+    activity_data_in = a csv file with columns Start with GMT time, Duration with activity duration in seconds, Distance with activity distance in miles, and Activity with activity label
+    Date_string = the number of characters to keep from the start_time_iso column to keep just the date in the format YYYY-MM-DD. No
+    longer used, the day is parsed from the full start time, but kept so existing calls still work.
+    Chunksize = the number of rows to read at a time, integer
+    Labels = the activity labels to keep, a list of strings. Defaults to airplane and transport, use rule_labels(rules) with custom
+    flight rules.
+    Local_time = if True, sum each sleep into its local day using the start_time_offset column (minutes from GMT) instead of the GMT day.
+    The days are already final in the output, so sleep_processing gives the same days with or without its own local_time.
+
+    Returns:
+    sleep_data = a pandas dataframe with columns start_time_iso with the date in the format YYYY-MM-DD and actual_minutes with the total sleep on that day
+    activity_data = a pandas dataframe of the flight candidate rows of the activity_data_in csv file'''
+    #Sum the sleep per day within each chunk. A day can be split across chunks, so the partial sums are added together at the end.
+    sleep_sums = []
+    for chunk in pd.read_csv(sleep_data_in, usecols=lambda column: column in SLEEP_DTYPES, dtype=SLEEP_DTYPES, chunksize=chunksize):
+        offset_minutes = chunk['start_time_offset'] if local_time and 'start_time_offset' in chunk.columns else None
+        days = timestamp_days(chunk['start_time_iso'], offset_minutes)
+        has_day = days != MISSING_DAY
+        sleep_sums.append(chunk.loc[has_day, 'actual_minutes'].astype(np.float64).groupby(days[has_day]).sum())
+    sleep_totals = pd.concat(sleep_sums).groupby(level=0).sum()
+    sleep_data = pd.DataFrame({'start_time_iso': day_strings(sleep_totals.index.to_numpy()), 'actual_minutes': sleep_totals.to_numpy()})
+    #Keep only the activities that could be flights from each chunk
+    if labels is None:
+        labels = FLIGHT_CANDIDATE_LABELS
+    activity_chunks = []
+    for chunk in pd.read_csv(activity_data_in, usecols=lambda column: column in ACTIVITY_DTYPES, dtype=ACTIVITY_DTYPES, chunksize=chunksize):
+        activity_chunks.append(chunk.loc[chunk['Activity'].isin(labels)])
+    activity_data = pd.concat(activity_chunks, ignore_index=True)
     return sleep_data, activity_data
 
+def offset_seconds(suffix):
+    '''Converts the time zone designator at the end of an ISO 8601 time string to seconds from GMT.
+
+    Arguments:
+    suffix = the end of the time string after the seconds, such as 'Z', '-07:00', or '.000+01:00'
+
+    Returns:
+    offset = seconds from GMT, integer (0 if there is no designator)'''
+    suffix = suffix.strip()
+    if len(suffix) >= 6 and suffix[-6] in '+-' and suffix[-3] == ':':
+        sign = -1 if suffix[-6] == '-' else 1
+        return sign * (int(suffix[-5:-3]) * 3600 + int(suffix[-2:]) * 60)
+    return 0
+
+#Day ordinal given to rows whose time is missing. These rows are left out of the daily sums and the flights, as blank days were before.
+MISSING_DAY = np.iinfo(np.int64).min
+
+def parse_timestamps(times):
+    '''Parses ISO 8601 time strings once into integers, so later steps can work with integer arithmetic instead of strings.
+
+    Arguments:
+    times = ISO 8601 time strings such as 2015-06-01T12:20:00Z or 2014-03-21T15:26:22-07:00, a single column of a dataframe or a list.
+    Missing times (NaN or None) are allowed.
+
+    Returns:
+    utc_seconds = seconds since 1970-01-01 GMT, a numpy int64 array (0 where the time is missing)
+    offsets = seconds from GMT of the time zone written in each string, a numpy int64 array (0 where the time is missing)
+    present = True where there is a time, a numpy boolean array'''
+    times = pd.Series(times, dtype=object).reset_index(drop=True)
+    present = times.notna().to_numpy()
+    utc_seconds, offsets = np.zeros(len(times), dtype=np.int64), np.zeros(len(times), dtype=np.int64)
+    if not present.any():
+        return utc_seconds, offsets, present
+    #Only the times that are there are parsed, numpy cannot convert a missing value
+    times = times[present].astype(str)
+    #numpy parses the date and time written in the string (or a date alone) in one vectorized step, which works the same with every
+    #supported version of pandas. The time zone designator after the seconds is converted separately.
+    local_seconds = np.array(times.str[:19].to_numpy(), dtype='datetime64[s]').astype(np.int64)
+    #Each file usually has only a few distinct time zone designators, so each distinct one is converted once
+    codes, suffixes = pd.factorize(times.str[19:])
+    offsets[present] = np.array([offset_seconds(suffix) for suffix in suffixes] + [0], dtype=np.int64)[codes]
+    utc_seconds[present] = local_seconds - offsets[present]
+    return utc_seconds, offsets, present
+
+def timestamp_days(times, offset_minutes=None):
+    '''Finds the day of each ISO 8601 time string as an integer day ordinal (days since 1970-01-01).
+
+    Arguments:
+    times = ISO 8601 time strings, a single column of a dataframe or a list
+    offset_minutes = minutes from GMT of the time zone to find the day in for each time, a single column of a dataframe or a list.
+    None uses the time zone written in each string, which gives the date written at the start of the string.
+
+    Returns:
+    days = a numpy int64 array with one day ordinal per time, MISSING_DAY where the time is missing'''
+    seconds_in_day = 86400
+    utc_seconds, offsets, present = parse_timestamps(times)
+    if offset_minutes is not None:
+        offsets = np.nan_to_num(np.asarray(offset_minutes, dtype=float)).astype(np.int64) * 60
+    return np.where(present, (utc_seconds + offsets) // seconds_in_day, MISSING_DAY)
+
+def day_strings(days):
+    '''Converts integer day ordinals back to dates in the format YYYY-MM-DD for output.
+
+    Arguments:
+    days = integer day ordinals, a numpy array
+
+    Returns:
+    dates = a numpy array of dates in the format YYYY-MM-DD'''
+    return np.datetime_as_string(np.asarray(days, dtype=np.int64).astype('datetime64[D]'), unit='D').astype(object)
+
 def basic_stats(data, label, decimals):
     '''Calculates the basic statistics of a dataset.
     
@@ -77,6 +564,51 @@ def basic_stats(data, label, decimals):
     print('maximum', label, '=', my_max, 'hours')
     return my_mean, my_median, my_std, my_min, my_max
 
+def histogram_counts(data, bins):
+    '''Counts the values of a dataset in each bin, so a histogram can be drawn (or sent to another process) without the raw data.
+
+    Arguments:
+    data = data to be counted, a single column of a dataframe, a list, or a numpy array
+    bins = bin edges, a numpy array
+
+    Returns:
+    panel = a dictionary with counts (values in each bin), edges (the bin edges), and mean (the mean of the data, NaN if empty)'''
+    values = np.asarray(data, dtype=float)
+    values = values[~np.isnan(values)]
+    counts, edges = np.histogram(values, bins=bins)
+    return {'counts': counts, 'edges': edges, 'mean': values.mean() if len(values) else np.nan}
+
+def draw_histogram(subplot, panel, title='', xlabel='', alpha=1, color='r', label=''):
+    '''Draws and annotates a histogram from precomputed bin counts, with a line at the mean. Only the given subplot is drawn on, no
+    pyplot state is used.
+
+    Arguments:
+    subplot = subplot in which to draw the histogram, a matplotlib Axes
+    panel = the bin counts from histogram_counts
+    title = title of the graph, a string
+    xlabel = x axis label, a string
+    alpha = opacity of the histogram, decimal between 0 and 1
+    color = color of the histogram, a string
+    label = label for the legend, a string
+
+    Returns:
+    draws a histogram on the subplot'''
+    #plot histogram
+    subplot.stairs(panel['counts'], panel['edges'], fill=True, alpha=alpha, label=label or None)
+    #add title, axis labels, and x ticks
+    if title:
+        subplot.set_title(title)
+    if xlabel:
+        subplot.set_xlabel(xlabel)
+    subplot.set_ylabel('count')
+    subplot.set_xticks(panel['edges'])
+    #add mean line
+    if not np.isnan(panel['mean']):
+        subplot.axvline(panel['mean'], color=color)
+    #add a legend if there are labels
+    if label:
+        subplot.legend()
+
 def histogram(subplot, data, bins, title='', xlabel='', alpha=1, color='r', label=''):
     '''Draws and annotates a histogram with a line at the mean
     
@@ -91,21 +623,8 @@ def histogram(subplot, data, bins, title='', xlabel='', alpha=1, color='r', labe
     label = label for the legend, a string
     
     Returns:
-    draws and displays a histogram'''
-    #plot histogram
-    hist = subplot.hist(data, bins=bins, alpha=alpha, label=label)
-    #add title, axis labels, and x ticks
-    plt.title(title)
-    plt.xlabel(xlabel)
-    plt.ylabel('count')
-    plt.xticks(bins)
-    #add mean line
-    plt.axvline(data.mean(), color=color)
-    #silence warning for if no legend is required, add a legend if there are labels
-    logging.getLogger().setLevel(logging.CRITICAL)
-    plt.legend()
-    #draw
-    plt.draw()
+    draws a histogram on the subplot'''
+    draw_histogram(subplot, histogram_counts(data, bins), title, xlabel, alpha, color, label)
 
 def cohend(d1, d2, decimals):
     '''Calculates Cohen's d for independent samples
@@ -129,56 +648,419 @@ def cohend(d1, d2, decimals):
     u1, u2 = mean(d1, axis=0), mean(d2, axis=0)
     #calculate the effect size
     eff_size = round(pd.to_numeric((u1 - u2) / s), decimals)
-    abs_eff_size = abs(eff_size)
     print('Cohen\'s d =', eff_size)
     #determine magnitude of effect size
-    if abs_eff_size < 0.2:
-        eff_string = 'Effect size is trivial'
-    elif abs_eff_size >= 0.2 and eff_size < 0.5:
-        eff_string = 'Effect size is small'
-    elif abs_eff_size >= 0.5 and eff_size < 0.8:
-        eff_string = 'Effect size is medium'
-    elif abs_eff_size >= 0.8:
-        eff_string = 'Effect size is large'
+    eff_string = effect_magnitude(eff_size)
     print(eff_string)
     return eff_size, eff_string   
 
+def effect_tests(d1, d2):
+    '''Calculates the Student's t test and Cohen's d for two independent samples at full precision, without printing anything.
+
+    Arguments:
+    d1 = the first sample of data, a numpy array
+    d2 = the second sample of data, a numpy array
+
+    Returns:
+    t_statistic = the t statistic of the Student's t test
+    p_value = the two sided p value of the Student's t test
+    eff_size = cohen's d, the effect size'''
+    from scipy import stats
+    n1, n2 = len(d1), len(d2)
+    if n1 < 2 or n2 < 2:
+        return np.nan, np.nan, np.nan
+    mean_diff = d1.mean() - d2.mean()
+    pooled_var = ((n1 - 1) * d1.var(ddof=1) + (n2 - 1) * d2.var(ddof=1)) / (n1 + n2 - 2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t_statistic = mean_diff / np.sqrt(pooled_var * (1 / n1 + 1 / n2))
+        eff_size = mean_diff / np.sqrt(pooled_var)
+    p_value = 2 * stats.t.sf(abs(t_statistic), n1 + n2 - 2)
+    return t_statistic, p_value, eff_size
+
+def effect_magnitude(eff_size):
+    '''Describes how large an effect is from its Cohen's d, with the same cut offs as cohend.
+
+    Arguments:
+    eff_size = cohen's d, a number
+
+    Returns:
+    eff_string = if the effect is trivial, small, medium, or large, a string'''
+    abs_eff_size = abs(eff_size)
+    if abs_eff_size < 0.2:
+        return 'Effect size is trivial'
+    elif abs_eff_size < 0.5:
+        return 'Effect size is small'
+    elif abs_eff_size < 0.8:
+        return 'Effect size is medium'
+    elif abs_eff_size >= 0.8:
+        return 'Effect size is large'
+    #Cohen's d is undefined if either sample has fewer than two values
+    return 'Effect size could not be calculated'
+
+class Result:
+    '''Base class of the result objects returned by the quiet analysis functions. Results hold numbers at full precision and do not
+    print anything, rounding and formatting is left to the reporting functions in section 11. Each subclass lists its fields in
+    __slots__, which keeps the objects small when thousands of them are collected.'''
+    __slots__ = ()
+
+    def __init__(self, **values):
+        for name in self.__slots__:
+            setattr(self, name, values.get(name))
+
+    def as_dict(self):
+        '''Returns the fields of the result as a dictionary.'''
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __repr__(self):
+        return '{}({})'.format(type(self).__name__, ', '.join('{}={!r}'.format(name, value) for name, value in self.as_dict().items()))
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.as_dict() == other.as_dict()
+
+class SummaryStats(Result):
+    '''The size, mean, median, standard deviation, minimum, and maximum of a dataset, from summary_stats.'''
+    __slots__ = ('label', 'n', 'mean', 'median', 'std', 'min', 'max')
+
+class EffectResult(Result):
+    '''The size and mean of the flight-affected and other sleep groups with the Student's t test and Cohen's d, from flight_effect.'''
+    __slots__ = ('n_flight_sleeps', 'n_non_flight_sleeps', 'mean_flight_sleep', 'mean_non_flight_sleep', 't_statistic', 'p_value',
+                 'cohens_d')
+
+    @property
+    def magnitude(self):
+        return effect_magnitude(self.cohens_d)
+
+class ParticipantResult(Result):
+    '''The analysis of one participant in a batch, from analyze_participant. effect is an EffectResult, resampled is the dictionary from
+    resample_effect (or None), error is the error message if the analysis or the plot failed (empty if both succeeded), series is the
+    daily series from daily_series when it was asked for (or None), and plot_file is the image the histograms were saved to (or None).'''
+    __slots__ = ('participant', 'n_flights', 'effect', 'resampled', 'error', 'series', 'plot_file')
+
+def summary_stats(data, label=''):
+    '''Calculates the basic statistics of a dataset at full precision without printing them. Use summary_text to report them.
+
+    Arguments:
+    data = a single column of a dataframe, a list, or a numpy array
+    label = the name of the data, a string
+
+    Returns:
+    stats = a SummaryStats result'''
+    values = np.asarray(data, dtype=float).ravel()
+    values = values[~np.isnan(values)]
+    if len(values) == 0:
+        return SummaryStats(label=label, n=0, mean=np.nan, median=np.nan, std=np.nan, min=np.nan, max=np.nan)
+    return SummaryStats(label=label, n=len(values), mean=values.mean(), median=np.median(values),
+                        std=values.std(ddof=1) if len(values) > 1 else np.nan, min=values.min(), max=values.max())
+
+def flight_effect(flight_sleeps, non_flight_sleeps):
+    '''Compares flight-affected and other sleep at full precision without printing anything. Use effect_text to report the result.
+
+    Arguments:
+    flight_sleeps = sleep durations affected by a flight, a dataframe with column sleep_duration (from flight_effect_sleep) or an array
+    non_flight_sleeps = sleep durations not affected by a flight, a dataframe with column sleep_duration or an array
+
+    Returns:
+    effect = an EffectResult'''
+    values = [np.asarray(sleeps['sleep_duration'] if isinstance(sleeps, pd.DataFrame) else sleeps, dtype=float)
+              for sleeps in (flight_sleeps, non_flight_sleeps)]
+    t_statistic, p_value, cohens_d = effect_tests(*values)
+    return EffectResult(n_flight_sleeps=len(values[0]), n_non_flight_sleeps=len(values[1]),
+                        mean_flight_sleep=values[0].mean() if len(values[0]) else np.nan,
+                        mean_non_flight_sleep=values[1].mean() if len(values[1]) else np.nan,
+                        t_statistic=t_statistic, p_value=p_value, cohens_d=cohens_d)
+
+def grouped_stats(table, keys=('participant', 'group'), value='value'):
+    '''Calculates the size, mean, median, standard deviation, minimum, and maximum of every group of a long table at full precision in
+    one pass. The rows are sorted once by group and value, then every statistic is a numpy reduction over the sorted values, so the
+    cost does not grow with the number of groups the way calling summary_stats once per group does.
+
+    Arguments:
+    table = a long dataframe with one row per value and the key columns naming its group, such as participant and group
+    keys = the columns that define a group, a list of strings
+    value = the column with the values, a string. Missing values are left out.
+
+    Returns:
+    stats = a dataframe indexed by the keys (sorted) with columns n, mean, median, std, min, and max. std is NaN for groups with one value.'''
+    keys = list(keys)
+    table = table.loc[table[value].notna(), keys + [value]]
+    #Number every combination of key values, then keep only the combinations that occur
+    key_codes, key_values = zip(*[pd.factorize(table[key], sort=True) for key in keys])
+    all_ids = np.ravel_multi_index(key_codes, [len(uniques) for uniques in key_values]) if len(table) else np.zeros(0, dtype=np.int64)
+    used_ids, group_ids = np.unique(all_ids, return_inverse=True)
+    groups = pd.MultiIndex.from_arrays([uniques.take(codes) for uniques, codes in
+                                        zip(key_values, np.unravel_index(used_ids, [len(uniques) for uniques in key_values]))], names=keys)
+    values = table[value].to_numpy(dtype=float)
+    #Sort by group, then by value within each group, so each group is one run of sorted values
+    order = np.lexsort((values, group_ids))
+    group_ids, values = group_ids[order], values[order]
+    n = np.bincount(group_ids, minlength=len(groups))
+    starts = np.concatenate([[0], np.cumsum(n)[:-1]]).astype(np.int64)
+    if len(values) == 0:
+        return pd.DataFrame({'n': n, 'mean': [], 'median': [], 'std': [], 'min': [], 'max': []}, index=groups)
+    mean_values = np.add.reduceat(values, starts) / n
+    #Sum of squared deviations from each group's own mean, which is more accurate than the sum of squares minus the squared sum
+    squared_deviations = np.add.reduceat((values - mean_values[group_ids]) ** 2, starts)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        std = np.where(n > 1, np.sqrt(squared_deviations / (n - 1)), np.nan)
+    median = (values[starts + (n - 1) // 2] + values[starts + n // 2]) / 2
+    return pd.DataFrame({'n': n, 'mean': mean_values, 'median': median, 'std': std, 'min': values[starts],
+                         'max': values[starts + n - 1]}, index=groups)
+
+def grouped_effects(table, group_a, group_b, participant='participant', group='group', value='value'):
+    '''Compares two groups of values for every participant of a long table at once: the summary statistics of each group, cohen's d,
+    and the Student's and Welch's t tests. All participants are computed together from grouped_stats with numpy array operations.
+
+    Arguments:
+    table = a long dataframe with columns participant, group, and value, one row per value
+    group_a = the name of the first group in the group column, such as 'flight'
+    group_b = the name of the second group, such as 'non_flight'
+    participant = the participant column, a string
+    group = the group column, a string
+    value = the value column, a string
+
+    Returns:
+    effects = a dataframe indexed by participant with columns n, mean, median, std, min, and max for each group (suffixed with the group
+    names), cohens_d, t_statistic, p_value (Student's t test), welch_t, welch_df, and welch_p. Values that need at least two values in
+    each group are NaN otherwise.'''
+    from scipy import stats
+    group_stats = grouped_stats(table, [participant, group], value)
+    participants = pd.Index(table[participant].unique()).sort_values()
+    #Line up the statistics of each group by participant, NaN for participants without values in that group
+    group_a_stats, group_b_stats = [group_stats.xs(name, level=1).reindex(participants)
+                                    if name in group_stats.index.get_level_values(1) else
+                                    pd.DataFrame(np.nan, index=participants, columns=group_stats.columns) for name in (group_a, group_b)]
+    n1 = group_a_stats['n'].fillna(0).to_numpy(dtype=float)
+    n2 = group_b_stats['n'].fillna(0).to_numpy(dtype=float)
+    mean1, mean2 = group_a_stats['mean'].to_numpy(dtype=float), group_b_stats['mean'].to_numpy(dtype=float)
+    var1, var2 = group_a_stats['std'].to_numpy(dtype=float) ** 2, group_b_stats['std'].to_numpy(dtype=float) ** 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        #Student's t test and cohen's d with the pooled variance
+        df = n1 + n2 - 2
+        pooled_var = ((n1 - 1) * var1 + (n2 - 1) * var2) / df
+        cohens_d = (mean1 - mean2) / np.sqrt(pooled_var)
+        t_statistic = (mean1 - mean2) / np.sqrt(pooled_var * (1 / n1 + 1 / n2))
+        #Welch's t test with the Welch-Satterthwaite degrees of freedom
+        se1, se2 = var1 / n1, var2 / n2
+        welch_t = (mean1 - mean2) / np.sqrt(se1 + se2)
+        welch_df = (se1 + se2) ** 2 / (se1 ** 2 / (n1 - 1) + se2 ** 2 / (n2 - 1))
+    effects = pd.concat([group_a_stats.add_suffix('_' + str(group_a)), group_b_stats.add_suffix('_' + str(group_b))], axis=1)
+    effects['n_' + str(group_a)] = n1.astype(int)
+    effects['n_' + str(group_b)] = n2.astype(int)
+    effects['cohens_d'] = cohens_d
+    effects['t_statistic'] = t_statistic
+    effects['p_value'] = 2 * stats.t.sf(np.abs(t_statistic), df)
+    effects['welch_t'] = welch_t
+    effects['welch_df'] = welch_df
+    effects['welch_p'] = 2 * stats.t.sf(np.abs(welch_t), welch_df)
+    effects.index.name = participant
+    return effects
+
 #-------------------------------------------------------------------------------------------------------------------------------------
 
 #Section 1: sleep duration processing and analysis
 
-def sleep_processing(sleep_data, date_string, decimals):
+@pipeline_stage
+def sleep_processing(sleep_data, date_string, decimals, local_time=False, verbose=True):
     '''The sleep data in this study was collected using a Basis Watch. Data from a basis watch includes GMT start and end times (start_time_iso, end_time_iso). 
     We want to use GMT start time to determine what day the sleep occurs on and actual_minutes to determine sleep duration. 
     
     Arguments:
     sleep_data = a pandas dataframe with columns start_time_iso with GMT time and actual_minutes with sleep duration in minutes
-    Date_string = the number of characters to keep from the start_time_iso column to keep just the date in the format YYYY-MM-DD
+    Date_string = the number of characters to keep from the start_time_iso column to keep just the date in the format YYYY-MM-DD. No
+    longer used, the day is parsed from the full start time, but kept so existing calls still work.
     Decimals = the number of decimals you want answers rounded to, integer
+    Local_time = if True, put each sleep on its local day using the start_time_offset column (minutes from GMT) instead of the GMT day
+    Verbose = if False, nothing is printed. Use summary_stats for the statistics instead.
 
     Returns:
-    sleep_sum_data = a dataframe with columns day with sleep start date in the format YYYY-MM-DD and actual_hours with sleep duration in hours
+    sleep_sum_data = a dataframe with columns day with sleep start date in the format YYYY-MM-DD, day_ordinal with the same date as an
+    integer day ordinal, and actual_hours with sleep duration in hours
     prints out the basic stats for the sleep data'''
-    #First, isolate the data we need for the histogram, just the start time and actual minutes
-    sleep_hist_data = sleep_data.loc[:, ['start_time_iso','actual_minutes']]
-    #The start_time_iso column contains the date as the first ten characters in a string in the format: YYYY-MM-DD
-    #Keep just the date of the start time string
-    sleep_hist_data['day'] = sleep_hist_data['start_time_iso'].str[:date_string]
+    #Parse the start times once into integer day ordinals
+    offset_minutes = sleep_data['start_time_offset'] if local_time and 'start_time_offset' in sleep_data.columns else None
+    days = timestamp_days(sleep_data['start_time_iso'], offset_minutes)
+    has_day = days != MISSING_DAY
     #On some days there are multiple sleeps. We want the total duration slept on each day.
-    #Use groupby to group the data by date and find the sum for each day of actual minutes of sleep.
-    sleep_sum_data = sleep_hist_data.groupby('day')['actual_minutes'].sum().reset_index(name ='actual_minutes')
+    #Use groupby to group the data by day and find the sum for each day of actual minutes of sleep. Sleeps without a start time are
+    #left out.
+    daily_minutes = sleep_data['actual_minutes'][has_day].astype(np.float64).groupby(days[has_day]).sum()
+    sleep_sum_data = pd.DataFrame({'day': day_strings(daily_minutes.index.to_numpy()), 'day_ordinal': daily_minutes.index.to_numpy(),
+                                   'actual_minutes': daily_minutes.to_numpy()})
     #Convert the time to hours in a new column
     min_in_hour = 60
     sleep_sum_data['actual_hours'] = sleep_sum_data['actual_minutes'].div(min_in_hour).round(decimals)
     #Run the basic stats function on the sleep data
-    basic_stats(sleep_sum_data['actual_hours'], 'daily sleep', decimals)
+    if verbose:
+        basic_stats(sleep_sum_data['actual_hours'], 'daily sleep', decimals)
     return sleep_sum_data
 
+#Daily sleep quality metrics made by sleep_metrics, in the order they are reported. Metrics whose input columns are missing are skipped.
+SLEEP_METRICS = ['actual_hours', 'light_minutes', 'deep_minutes', 'rem_minutes', 'interruptions', 'toss_and_turn', 'interruptions_per_hour',
+                 'toss_and_turn_per_hour', 'heart_rate_avg']
+
+def sleep_metrics(sleep_data, decimals, local_time=False):
+    '''Calculates every daily sleep quality metric of the full sleep export in one grouped pass over the sleeps: the minutes of each
+    sleep stage, interruptions, and toss and turns summed per day, the interruptions and toss and turns per hour slept, and the average
+    heart rate of the day weighted by the duration of each sleep. Read the export with read_data(..., sleep_metrics=True),
+    or read_csv_columns with {**SLEEP_DTYPES, **SLEEP_METRIC_DTYPES}, to get the columns.
+
+    Arguments:
+    sleep_data = a pandas dataframe with columns start_time_iso and actual_minutes, and any of light_minutes, deep_minutes, rem_minutes,
+    interruptions, toss_and_turn, and heart_rate_avg
+    Decimals = the number of decimals actual_hours is rounded to, integer, the same as sleep_processing
+    Local_time = if True, put each sleep on its local day using the start_time_offset column (minutes from GMT) instead of the GMT day
+
+    Returns:
+    sleep_metric_data = a dataframe with columns day, day_ordinal, and actual_minutes as from sleep_processing, and a column for each
+    metric in SLEEP_METRICS that the export has data for. Sums are NaN on days where none of the sleeps have a value, rates are NaN
+    on days without minutes slept, and the heart rate is NaN on days where no sleep with minutes slept has one.'''
+    offset_minutes = sleep_data['start_time_offset'] if local_time and 'start_time_offset' in sleep_data.columns else None
+    days = timestamp_days(sleep_data['start_time_iso'], offset_minutes)
+    minutes = sleep_data['actual_minutes'].to_numpy(dtype=float)
+    #Collect every column to sum per day, so all the metrics come out of a single groupby
+    sums = {'actual_minutes': minutes}
+    for column in ['light_minutes', 'deep_minutes', 'rem_minutes', 'interruptions', 'toss_and_turn']:
+        if column in sleep_data.columns:
+            sums[column] = sleep_data[column].to_numpy(dtype=float)
+    if 'heart_rate_avg' in sleep_data.columns:
+        #The duration weighted mean is the sum of heart rate times minutes over the sum of minutes, both over sleeps with a heart rate
+        heart_rate = sleep_data['heart_rate_avg'].to_numpy(dtype=float)
+        has_heart_rate = ~np.isnan(heart_rate) & (minutes > 0)
+        sums['heart_rate_minutes'] = np.where(has_heart_rate, heart_rate * minutes, np.nan)
+        sums['minutes_with_heart_rate'] = np.where(has_heart_rate, minutes, np.nan)
+    has_day = days != MISSING_DAY
+    daily = pd.DataFrame(sums)[has_day].groupby(days[has_day]).sum(min_count=1)
+    day_ordinal = daily.index.to_numpy()
+    sleep_metric_data = pd.DataFrame({'day': day_strings(day_ordinal), 'day_ordinal': day_ordinal,
+                                      'actual_minutes': daily['actual_minutes'].to_numpy()})
+    min_in_hour = 60
+    hours = daily['actual_minutes'].to_numpy() / min_in_hour
+    sleep_metric_data['actual_hours'] = np.round(hours, decimals)
+    for column in ['light_minutes', 'deep_minutes', 'rem_minutes', 'interruptions', 'toss_and_turn']:
+        if column in daily.columns:
+            sleep_metric_data[column] = daily[column].to_numpy()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for column in ['interruptions', 'toss_and_turn']:
+            if column in daily.columns:
+                sleep_metric_data[column + '_per_hour'] = np.where(hours > 0, daily[column].to_numpy() / hours, np.nan)
+        if 'heart_rate_minutes' in daily.columns:
+            sleep_metric_data['heart_rate_avg'] = (daily['heart_rate_minutes'] / daily['minutes_with_heart_rate']).to_numpy()
+    return sleep_metric_data
+
 #-------------------------------------------------------------------------------------------------------------------------------------
 
 #Section 2: flight duration processing and analysis
 
-def activity_processing(activity_data, date_string, decimals):
+#Keys a flight rule may have. A rule matches activities with any of its labels whose speed (miles/hour) and duration (hours) are
+#strictly inside the given ranges. Missing range keys are not checked.
+FLIGHT_RULE_KEYS = {'labels', 'min_speed', 'max_speed', 'min_duration', 'max_duration'}
+
+def flight_rules(lower_speed_threshold=100, upper_speed_threshold=700, lower_duration_threshold=0.5):
+    '''Builds the default flight rule set: an activity is a flight if it is labeled airplane, or labeled transport with a speed between
+    the speed thresholds, and in both cases is longer than the duration threshold.
+
+    Arguments:
+    Lower_speed_threshold = transport activities must be faster than this speed in miles/hour to count as flights
+    Upper_speed_threshold = transport activities must be slower than this speed in miles/hour to count as flights
+    Lower_duration_threshold = flights must be longer than this duration in hours
+
+    Returns:
+    rules = a rule set, a dictionary with a list of rules under 'rules' and per-device lists of rules under 'devices'
+    '''
+    return {'rules': [{'labels': ['airplane'], 'min_duration': lower_duration_threshold},
+                      {'labels': ['transport'], 'min_speed': lower_speed_threshold, 'max_speed': upper_speed_threshold,
+                       'min_duration': lower_duration_threshold}],
+            'devices': {}}
+
+def load_flight_rules(rules_json):
+    '''Reads a flight rule set from a json file, for example to add train or ferry rules without changing the code. The file holds a
+    dictionary with a list of rules under 'rules' and, optionally, per-device lists of rules under 'devices' that replace 'rules' for the
+    activities recorded by that device (from the Device column). Each rule is a dictionary with labels (a list of activity labels) and
+    optionally min_speed, max_speed, min_duration, and max_duration.
+
+    Arguments:
+    rules_json = path of the json file, a string
+
+    Returns:
+    rules = the rule set, a dictionary'''
+    with open(rules_json) as file:
+        return json.load(file)
+
+def rule_labels(rules):
+    '''Lists every activity label used by a rule set, which are the only activities that can be flights.
+
+    Arguments:
+    rules = a rule set from flight_rules or load_flight_rules
+
+    Returns:
+    labels = a sorted list of activity labels'''
+    rule_lists = [rules['rules']] + list(rules.get('devices', {}).values())
+    return sorted({label for rule_list in rule_lists for rule in rule_list for label in rule['labels']})
+
+def activity_columns(activity_data, device_column='Device'):
+    '''Computes the columns the flight rules are checked against, once, without changing or copying the activity dataframe.
+
+    Arguments:
+    activity_data = a pandas dataframe with columns Duration with activity duration in seconds, Distance with activity distance in miles, Activity with activity label, and optionally a device column
+    device_column = name of the column with the device that recorded each activity, a string
+
+    Returns:
+    columns = a dictionary with label and device (pandas Categoricals, device is None without a device column), and duration (hours)
+    and speed (miles/hour) as numpy arrays'''
+    seconds_in_hour = 3600
+    duration = activity_data['Duration'].to_numpy(dtype=float) / seconds_in_hour
+    with np.errstate(divide='ignore', invalid='ignore'):
+        speed = activity_data['Distance'].to_numpy() / duration
+    device = pd.Categorical(activity_data[device_column]) if device_column in activity_data.columns else None
+    return {'label': pd.Categorical(activity_data['Activity']), 'device': device, 'duration': duration, 'speed': speed}
+
+def compile_flight_rules(rules):
+    '''Checks a flight rule set and compiles it into a function that marks the flights among a set of activities. The function only
+    does array comparisons on the columns from activity_columns and combines them into one boolean mask, with no intermediate dataframes.
+
+    Arguments:
+    rules = a rule set from flight_rules or load_flight_rules
+
+    Returns:
+    classify = a function that takes the columns from activity_columns and returns a boolean numpy array, True for flights'''
+    for rule in [rule for rule_list in [rules['rules']] + list(rules.get('devices', {}).values()) for rule in rule_list]:
+        unknown = set(rule) - FLIGHT_RULE_KEYS
+        if unknown or 'labels' not in rule:
+            raise ValueError('flight rules need labels and may only have the keys {}, got {}'.format(sorted(FLIGHT_RULE_KEYS), rule))
+
+    def match(rule_list, columns):
+        #Labels are compared as integer category codes. Labels not in the data have no code (-1), which is also the code of a missing
+        #label, so they are dropped rather than matched against the activities without a label.
+        codes = columns['label'].codes
+        mask = np.zeros(len(codes), dtype=bool)
+        for rule in rule_list:
+            label_codes = columns['label'].categories.get_indexer(rule['labels'])
+            rule_mask = np.isin(codes, label_codes[label_codes >= 0])
+            for key, column, compare in [('min_speed', 'speed', np.greater), ('max_speed', 'speed', np.less),
+                                         ('min_duration', 'duration', np.greater), ('max_duration', 'duration', np.less)]:
+                if key in rule:
+                    rule_mask &= compare(columns[column], rule[key])
+            mask |= rule_mask
+        return mask
+
+    def classify(columns):
+        is_flight = match(rules['rules'], columns)
+        device = columns['device']
+        if device is not None:
+            for device_name, device_rules in rules.get('devices', {}).items():
+                device_code = device.categories.get_indexer([device_name])[0]
+                if device_code < 0:
+                    #No activities were recorded by this device, and -1 would match the activities without a device
+                    continue
+                on_device = device.codes == device_code
+                if on_device.any():
+                    is_flight = np.where(on_device, match(device_rules, columns), is_flight)
+        return is_flight
+    return classify
+
+@pipeline_stage
+def activity_processing(activity_data, date_string, decimals, lower_speed_threshold=100, upper_speed_threshold=700, lower_duration_threshold=0.5,
+                        rules=None, verbose=True):
     '''In this function we isolate all of the flights from activities data. As with a lot of wearable data, our labels are imperfect. Some 
     flights are labeled `airplane` in the `Activity` column and others are labelled `transport`. However, `transport` is also used for car 
     rides, train rides, etc. We will define a flight as an activity that is either (labeled `airplane`) OR (labeled `transport` AND has an 
@@ -189,47 +1071,79 @@ def activity_processing(activity_data, date_string, decimals):
     
     Arguments:
     activity_data = a pandas dataframe with columns Start with GMT time, Duration with activity duration in seconds, Distance with activity distance in miles, and Activity with activity label
-    Date_string = the number of characters to keep from the start_time_iso column to keep just the date in the format YYYY-MM-DD
+    Date_string = the number of characters to keep from the start_time_iso column to keep just the date in the format YYYY-MM-DD. No
+    longer used, the day is parsed from the full start time, but kept so existing calls still work.
     Decimals = the number of decimals you want answers rounded to, integer
+    Lower_speed_threshold = transport activities must be faster than this speed in miles/hour to count as flights
+    Upper_speed_threshold = transport activities must be slower than this speed in miles/hour to count as flights
+    Lower_duration_threshold = flights must be longer than this duration in hours
+    Rules = a flight rule set from flight_rules or load_flight_rules that replaces the definition above, or None to use it with the
+    thresholds given. activity_data is not changed.
+    Verbose = if False, nothing is printed. Use summary_stats for the statistics instead.
     
     Returns:
-    flights = a dataframe with columns day with flight date in the format YYYY-MM-DD and Duration with fligh duration in hours
+    flights = a dataframe with columns day with flight date in the format YYYY-MM-DD, day_ordinal with the same date as an integer day
+    ordinal, and Duration with fligh duration in hours
     prints out the number of flights taken and the basic stats for flight duration'''
-    #Keep just the date of the start string
-    activity_data['day'] = activity_data['Start'].str[:date_string]
-    #The duration of the activity is given in seconds. Convert duration to hours
-    seconds_in_hour = 3600
-    activity_data['Duration'] = activity_data['Duration'].div(seconds_in_hour)
-    #First, separate out the activities with the 'airplane' label
-    flights = activity_data.loc[activity_data['Activity'] == 'airplane']
-    #Calculate the speed of all the activities
-    activity_data['speed'] = activity_data['Distance'] / activity_data['Duration']
-    #Isolate activites with speeds over 100 mph and under 700 mph
-    lower_speed_threshold = 100
-    transport_flights = activity_data.loc[activity_data['speed'] > lower_speed_threshold]
-    upper_speed_threshold = 700
-    transport_flights = transport_flights.loc[transport_flights['speed'] < upper_speed_threshold]
-    #Isolate activities with speeds in the target range labeled 'transport
-    transport_flights = transport_flights.loc[transport_flights['Activity'] == 'transport']
-    #Add the transport flights to the airplane flights, drop columns besides day and duration, and sort the columns by date.
-    flights = pd.concat([flights, transport_flights], axis=0)
-    flights = flights.loc[:, ['day','Duration']]
-    flights = flights.sort_values(by = 'day')
-    #Remove flights with durations under 30 minutes, round duration
-    lower_duration_threshold = 0.5
-    flights = flights.loc[flights['Duration'] > lower_duration_threshold]
+    if rules is None:
+        rules = flight_rules(lower_speed_threshold, upper_speed_threshold, lower_duration_threshold)
+    #Convert duration to hours, calculate the speed of all the activities, and mark the flights with the rules in one pass
+    columns = activity_columns(activity_data)
+    #Activities without a start time have no day, so they cannot be flights
+    is_flight = compile_flight_rules(rules)(columns) & activity_data['Start'].notna().to_numpy()
+    #Find the day of each flight (the date written in the start time) as an integer day ordinal, keep just the day and duration, and
+    #sort the flights by date. Round duration.
+    day_ordinal = timestamp_days(activity_data['Start'][is_flight])
+    flights = pd.DataFrame({'day': day_strings(day_ordinal), 'day_ordinal': day_ordinal, 'Duration': columns['duration'][is_flight]},
+                           index=activity_data.index[is_flight])
+    flights = flights.sort_values(by = 'day_ordinal', kind = 'stable')
     flights['Duration'] = flights['Duration'].round(decimals)
-    #Print the total number of flights
-    print('participant took' , len(flights), 'flights')
-    #Run the basic stats function on the flight data
-    basic_stats(flights['Duration'], 'flight duration', decimals)
+    if verbose:
+        #Print the total number of flights
+        print('participant took' , len(flights), 'flights')
+        #Run the basic stats function on the flight data
+        basic_stats(flights['Duration'], 'flight duration', decimals)
     return flights
 
 #-------------------------------------------------------------------------------------------------------------------------------------
 
 #Section 3: flight's affect on sleep
 
-def flight_effect_sleep(flights, sleep_sum_data, decimals):
+def day_ordinals(days):
+    '''Converts dates in the format YYYY-MM-DD to integer day ordinals (days since 1970-01-01) so that dates can be compared
+    and offset with integer arithmetic instead of string or datetime operations.
+
+    Arguments:
+    days = a single column of a dataframe, a list, or an array of dates in the format YYYY-MM-DD
+
+    Returns:
+    ordinals = a numpy int64 array with one day ordinal per input date'''
+    return np.asarray(days, dtype='datetime64[D]').astype(np.int64)
+
+def in_flight_window(sleep_ordinals, flight_ordinals, days_affected_by_flight):
+    '''Determines which days fall within the after-flight window of any flight. A day is in the window if it falls on the day of a
+    flight or within the following (days_affected_by_flight - 1) days. Flight days are sorted once and every day is matched against them
+    with a single binary search, so the cost is O((sleep days + flight days) log flight days).
+
+    Arguments:
+    sleep_ordinals = integer day ordinals of the days to classify, a numpy array
+    flight_ordinals = integer day ordinals of the flight days, a numpy array
+    days_affected_by_flight = number of days, including the day of the flight, affected by a flight, integer
+
+    Returns:
+    mask = a boolean numpy array, True for the days affected by a flight'''
+    flight_ordinals = np.unique(flight_ordinals)
+    sleep_ordinals = np.asarray(sleep_ordinals, dtype=np.int64)
+    if len(flight_ordinals) == 0 or days_affected_by_flight <= 0:
+        return np.zeros(len(sleep_ordinals), dtype=bool)
+    #Find the most recent flight on or before each day, then check if it is close enough to affect that day
+    idx = np.searchsorted(flight_ordinals, sleep_ordinals, side='right') - 1
+    has_prior_flight = idx >= 0
+    days_since_flight = sleep_ordinals - flight_ordinals[np.maximum(idx, 0)]
+    return has_prior_flight & (days_since_flight < days_affected_by_flight)
+
+@pipeline_stage
+def flight_effect_sleep(flights, sleep_sum_data, decimals, days_affected_by_flight=3, series=None, verbose=True):
     ''' Now we know when the participant travelled and how long they slept each day. Let’s put them together. We want to compare the participant's sleep 
     after travelling to their usual sleep. Generate a set of dates within 3 days of flight. That is, if they travelled on 3/23/14, then 
     you should include 3/23/14, 3/24/14, and 3/25/14 as "after-flight" dates.
@@ -238,76 +1152,1558 @@ def flight_effect_sleep(flights, sleep_sum_data, decimals):
     flights = a dataframe with columns day with flight date in the format YYYY-MM-DD and Duration with fligh duration in hours
     sleep_sum_data = a dataframe with columns day with sleep start date in the format YYYY-MM-DD and actual_hours with sleep duration in hours
     Decimals = the number of decimals you want answers rounded to, integer
+    Days_affected_by_flight = number of days, including the day of the flight, counted as "after-flight" dates, integer
+    Series = a participant's daily series from a store (store_series) to use instead of flights and sleep_sum_data, which can then be
+    None, or None to use the dataframes
+    Verbose = if False, the t test and cohen's d are not calculated or printed. Use flight_effect on the groups for them instead.
     
     Returns:
     flight_sleeps = dataframe with column sleep_duration with sleep duration in hours, contains sleeps affected by airplane travel
     non_flight_sleeps = dataframe with column sleep_duration with sleep duration in hours, contains sleeps not affected by airplane travel
     prints results from t test, cohen's d, and a string of how large the effect size is'''
-    #Create new dataframe of just the flight dates and drop any duplicates.
-    flight_dates = flights['day']
-    flight_dates = flight_dates.to_frame()
-    flight_dates.columns = ['day']
-    flight_dates = flight_dates.drop_duplicates()
-    #Convert the values in the dataframe to datetime objects.
-    flight_dates['day'] = flight_dates['day'].astype('datetime64[ns]')
-    #Now we need to make the list of all after-flight days. We will create an empty list. Then, using nested for loops, we will
-    #add the days of and following a flight to the list of after-flight days.
-    all_flight_days = []
-    days_affected_by_flight = 3
-    for day in flight_dates['day']:
-        for offset in range(days_affected_by_flight):
-            a = day + timedelta(days = offset)
-            all_flight_days.append(a.strftime('%Y-%m-%d'))
-    #Change the list to a dataframe and drop duplicates. Then squeeze it into a series.
-    all_flight_days = pd.DataFrame(all_flight_days, columns = ['all flight days'])
-    all_flight_days = all_flight_days.drop_duplicates()
-    all_flight_days = all_flight_days.squeeze()
-    #initialize lists
-    flight_sleeps = []
-    non_flight_sleeps = []
-    #Go through each row in the sleep data. If the date from the sleep data is one affected by a flight, add sleep duration
-    #to corresponding list. Otherwise, add it to the other list.
-    for i, r in sleep_sum_data.iterrows():
-        if r['day'] in all_flight_days.unique():
-            flight_sleeps.append(r['actual_hours'])
-        else:
-            non_flight_sleeps.append(r['actual_hours'])
-    #convert lists to dfs
-    flight_sleeps = pd.DataFrame(flight_sleeps, columns = ['sleep_duration'])
-    non_flight_sleeps = pd.DataFrame(non_flight_sleeps, columns = ['sleep_duration'])
-    #perform ttest
-    res = stats.ttest_ind(flight_sleeps, non_flight_sleeps)
-    display(res)
-    #calculate cohen's d
-    cohend(flight_sleeps['sleep_duration'], non_flight_sleeps['sleep_duration'], decimals)
+    if series is not None:
+        #The store already has the days on a dense grid, so the after-flight days are found directly from the flight bitset
+        flight_hours, non_flight_hours = split_series_sleep(series, decimals, days_affected_by_flight)
+    else:
+        #Use the integer day ordinals of the flight and sleep dates so the after-flight windows can be matched with integer arithmetic.
+        #Dataframes made without them (only a day column) are converted here.
+        flight_ordinals = flights['day_ordinal'].to_numpy() if 'day_ordinal' in flights.columns else day_ordinals(flights['day'])
+        sleep_ordinals = sleep_sum_data['day_ordinal'].to_numpy() if 'day_ordinal' in sleep_sum_data.columns else day_ordinals(sleep_sum_data['day'])
+        #Mark each sleep day that falls on or within the days following a flight
+        is_flight_sleep = in_flight_window(sleep_ordinals, flight_ordinals, days_affected_by_flight)
+        #Split the daily sleep durations into the two groups, keeping the original day order
+        sleep_hours = sleep_sum_data['actual_hours'].to_numpy()
+        flight_hours, non_flight_hours = sleep_hours[is_flight_sleep], sleep_hours[~is_flight_sleep]
+    flight_sleeps = pd.DataFrame({'sleep_duration': flight_hours})
+    non_flight_sleeps = pd.DataFrame({'sleep_duration': non_flight_hours})
+    if verbose:
+        #perform ttest
+        from scipy import stats
+        res = stats.ttest_ind(flight_sleeps, non_flight_sleeps)
+        print(res)
+        #calculate cohen's d
+        cohend(flight_sleeps['sleep_duration'], non_flight_sleeps['sleep_duration'], decimals)
     return flight_sleeps, non_flight_sleeps
 
-#-------------------------------------------------------------------------------------------------------------------------------------
+def sleep_metric_effects(flights, sleep_metric_data, days_affected_by_flight=3, metrics=None):
+    '''Compares after-flight days to other days for every sleep quality metric at once. The after-flight days are found once, and all
+    metrics are tested together with grouped_effects, so adding metrics costs no extra passes over the days. Days without a value for
+    a metric are left out of that metric's comparison only.
 
-#Section 4: create plots
+    Arguments:
+    flights = a dataframe with column day_ordinal (or day) with the flight dates, from activity_processing
+    sleep_metric_data = a dataframe of daily metrics from sleep_metrics
+    Days_affected_by_flight = number of days, including the day of the flight, counted as "after-flight" dates, integer
+    Metrics = the metric columns to compare, a list of strings, or None for every column of SLEEP_METRICS in sleep_metric_data
+
+    Returns:
+    effects = a dataframe indexed by metric with the columns of grouped_effects for the groups 'flight' and 'non_flight': the size,
+    mean, median, std, min, and max of each group, cohens_d, t_statistic, p_value, welch_t, welch_df, and welch_p'''
+    if metrics is None:
+        metrics = [metric for metric in SLEEP_METRICS if metric in sleep_metric_data.columns]
+    flight_ordinals = flights['day_ordinal'].to_numpy() if 'day_ordinal' in flights.columns else day_ordinals(flights['day'])
+    sleep_ordinals = sleep_metric_data['day_ordinal'].to_numpy() if 'day_ordinal' in sleep_metric_data.columns else day_ordinals(sleep_metric_data['day'])
+    is_flight_sleep = in_flight_window(sleep_ordinals, flight_ordinals, days_affected_by_flight)
+    #Stack the metrics into one long table with a metric, group, and value per day, so every metric is tested in the same call
+    values = sleep_metric_data.loc[:, metrics].to_numpy(dtype=float)
+    n_days = len(sleep_metric_data)
+    table = pd.DataFrame({'metric': pd.Categorical.from_codes(np.repeat(np.arange(len(metrics)), n_days), categories=metrics),
+                          'group': pd.Categorical.from_codes(np.tile(np.where(is_flight_sleep, 0, 1), len(metrics)),
+                                                             categories=['flight', 'non_flight']),
+                          'value': values.T.ravel()})
+    table = table[~np.isnan(table['value'].to_numpy())]
+    effects = grouped_effects(table, 'flight', 'non_flight', participant='metric').reindex(metrics)
+    #Metrics without any values come back empty from the reindex, count them as having no days in either group
+    for column in ['n_flight', 'n_non_flight']:
+        effects[column] = effects[column].fillna(0).astype(int)
+    effects.index.name = 'metric'
+    return effects
+
+def resample_chunk(flight_values, non_flight_values, n_resamples, seed):
+    '''Runs one chunk of permutation and bootstrap replicates. Each replicate is one row of an index matrix, so the whole chunk is
+    computed with a few numpy operations instead of a python loop.
+
+    Arguments:
+    flight_values = sleep durations affected by a flight, a numpy array
+    non_flight_values = sleep durations not affected by a flight, a numpy array
+    n_resamples = number of replicates in this chunk, integer
+    seed = seed for this chunk's random numbers, a numpy SeedSequence
+
+    Returns:
+    perm_diffs = the difference in means for each permutation replicate, a numpy array
+    boot_diffs = the difference in means for each bootstrap replicate, a numpy array
+    boot_ds = cohen's d for each bootstrap replicate, a numpy array'''
+    rng = np.random.default_rng(seed)
+    n1, n2 = len(flight_values), len(non_flight_values)
+    pooled = np.concatenate([flight_values, non_flight_values])
+    #Permutation test: shuffle the group labels by taking the first n1 entries of a random ordering of the pooled data in every row.
+    #The second group mean follows from the pooled total, so only the first group needs to be gathered.
+    perm_idx = rng.random((n_resamples, n1 + n2)).argsort(axis=1)[:, :n1]
+    perm_sum1 = pooled[perm_idx].sum(axis=1)
+    perm_diffs = perm_sum1 / n1 - (pooled.sum() - perm_sum1) / n2
+    #Bootstrap: resample each group with replacement
+    boot1 = flight_values[rng.integers(0, n1, (n_resamples, n1))]
+    boot2 = non_flight_values[rng.integers(0, n2, (n_resamples, n2))]
+    boot_diffs = boot1.mean(axis=1) - boot2.mean(axis=1)
+    pooled_sd = np.sqrt(((n1 - 1) * boot1.var(axis=1, ddof=1) + (n2 - 1) * boot2.var(axis=1, ddof=1)) / (n1 + n2 - 2))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        boot_ds = boot_diffs / pooled_sd
+    return perm_diffs, boot_diffs, boot_ds
+
+def resample_effect(flight_sleeps, non_flight_sleeps, n_resamples=10000, confidence=0.95, seed=None, chunk_size=1000, workers=1):
+    '''Tests the difference between flight-affected and other sleeps with resampling, which does not assume the sleep durations are
+    normally distributed. A permutation test gives the p value, and bootstrapping gives confidence intervals for the difference in means
+    and for cohen's d. Replicates are computed in chunks of chunk_size to bound memory, and the chunks can be spread across processes.
+    Every chunk gets its own seed spawned from seed, so results are the same for any number of workers (but change with chunk_size).
+    Resampling needs at least two sleeps in each group, otherwise, or if n_resamples is below 1, every result is NaN.
 
-def plot_data(sleep_sum_data, flights, flight_sleeps, non_flight_sleeps, sleep_bins, flight_bins):
-    '''Plots histograms of the sleep data, the flight data, and a comparative histogram of the sleeps affected by airplane flight or not.
-    
     Arguments:
-    sleep_sum_data = a dataframe with columns day with sleep start date in the format YYYY-MM-DD and actual_hours with sleep duration in hours
-    flights = a dataframe with columns day with flight date in the format YYYY-MM-DD and Duration with fligh duration in hours
     flight_sleeps = dataframe with column sleep_duration with sleep duration in hours, contains sleeps affected by airplane travel
     non_flight_sleeps = dataframe with column sleep_duration with sleep duration in hours, contains sleeps not affected by airplane travel
-    Sleep_bins = bins to be used for plotting the sleep data, a numpy array
-    Flight_bins = bins to be used for plotting the  flight data, a numpy array
+    N_resamples = number of permutation and of bootstrap replicates, integer
+    Confidence = confidence level of the bootstrap intervals, decimal between 0 and 1
+    Seed = seed for the random numbers, integer, or None for a different result every run
+    Chunk_size = number of replicates computed at once, integer
+    Workers = number of worker processes, integer
 
     Returns:
-    draws and shows three histograms in one figure'''
-    #Create a subplot, then call the histogram function for the sleep data
-    fig1 = plt.figure()
-    ax1 = fig1.add_subplot(1, 3, 1)
-    histogram(subplot=ax1, data=sleep_sum_data['actual_hours'], bins=sleep_bins, title='Hours Slept Per Day', xlabel='hours slept')
-    #Create a subplot, then call the histogram function for the activity data
-    ax2 = fig1.add_subplot(1, 3, 2)
-    histogram(subplot=ax2, data=flights['Duration'], bins=flight_bins, title='Flight Durations', xlabel='flight duration (hours)')
-    #Create a subplot, then call the histogram function for botht the flight affected and non flight affected sleep
-    ax3 = fig1.add_subplot(1, 3, 3)
-    histogram(subplot=ax3, data=flight_sleeps['sleep_duration'], bins=sleep_bins, alpha=0.5, color='blue', label='flight sleeps')
-    histogram(subplot=ax3, data=non_flight_sleeps['sleep_duration'], bins=sleep_bins, title='Flight VS Non-Flight Sleeps', xlabel='hours slept', alpha=0.5, color='orange', label='non-flight sleeps')
-    plt.show()
\ No newline at end of file
+    results = a dictionary with mean_diff, cohens_d, permutation_p, mean_diff_ci, and cohens_d_ci (the intervals are (low, high) tuples)'''
+    flight_values = flight_sleeps['sleep_duration'].to_numpy(dtype=float)
+    non_flight_values = non_flight_sleeps['sleep_duration'].to_numpy(dtype=float)
+    if min(len(flight_values), len(non_flight_values)) < 2 or n_resamples < 1:
+        return {'mean_diff': np.nan, 'cohens_d': np.nan, 'permutation_p': np.nan, 'mean_diff_ci': (np.nan, np.nan),
+                'cohens_d_ci': (np.nan, np.nan)}
+    #Observed effect
+    mean_diff = flight_values.mean() - non_flight_values.mean()
+    cohens_d = effect_tests(flight_values, non_flight_values)[2]
+    #Split the replicates into chunks, each with its own seed
+    chunk_sizes = [min(chunk_size, n_resamples - start) for start in range(0, n_resamples, chunk_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(chunk_sizes))
+    jobs = [(flight_values, non_flight_values, size, chunk_seed) for size, chunk_seed in zip(chunk_sizes, seeds)]
+    if workers == 1:
+        chunks = [resample_chunk(*job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            chunks = list(executor.map(resample_chunk, *zip(*jobs)))
+    perm_diffs, boot_diffs, boot_ds = (np.concatenate(parts) for parts in zip(*chunks))
+    #Two sided permutation p value, counting the observed labelling as one of the permutations
+    permutation_p = (np.sum(np.abs(perm_diffs) >= abs(mean_diff) - 1e-12) + 1) / (n_resamples + 1)
+    #Percentile bootstrap confidence intervals
+    tail = (1 - confidence) / 2 * 100
+    mean_diff_ci = tuple(np.percentile(boot_diffs, [tail, 100 - tail]))
+    cohens_d_ci = tuple(np.nanpercentile(boot_ds, [tail, 100 - tail]))
+    return {'mean_diff': mean_diff, 'cohens_d': cohens_d, 'permutation_p': permutation_p,
+            'mean_diff_ci': mean_diff_ci, 'cohens_d_ci': cohens_d_ci}
+
+#-------------------------------------------------------------------------------------------------------------------------------------
+
+#Section 4: create plots
+
+def plot_panels(sleep_sum_data, flights, flight_sleeps, non_flight_sleeps, sleep_bins, flight_bins):
+    '''Precomputes the bin counts of the three histograms of plot_data. The result is small, so it can be sent to a worker process to be
+    drawn instead of the data.
+
+    Arguments:
+    sleep_sum_data = a dataframe with column actual_hours with sleep duration in hours
+    flights = a dataframe with column Duration with flight duration in hours
+    flight_sleeps = dataframe with column sleep_duration, contains sleeps affected by airplane travel
+    non_flight_sleeps = dataframe with column sleep_duration, contains sleeps not affected by airplane travel
+    Sleep_bins = bins to be used for plotting the sleep data, a numpy array
+    Flight_bins = bins to be used for plotting the flight data, a numpy array
+
+    Returns:
+    panels = a dictionary of histogram_counts results: sleep, flights, flight_sleeps, and non_flight_sleeps'''
+    return {'sleep': histogram_counts(sleep_sum_data['actual_hours'], sleep_bins),
+            'flights': histogram_counts(flights['Duration'], flight_bins),
+            'flight_sleeps': histogram_counts(flight_sleeps['sleep_duration'], sleep_bins),
+            'non_flight_sleeps': histogram_counts(non_flight_sleeps['sleep_duration'], sleep_bins)}
+
+def draw_panels(axes, panels, title=''):
+    '''Draws the three histograms of plot_data on three subplots.
+
+    Arguments:
+    axes = three matplotlib Axes
+    panels = the bin counts from plot_panels
+    title = title of the whole figure, such as the participant, a string
+
+    Returns:
+    draws on the subplots'''
+    draw_histogram(axes[0], panels['sleep'], title='Hours Slept Per Day', xlabel='hours slept')
+    draw_histogram(axes[1], panels['flights'], title='Flight Durations', xlabel='flight duration (hours)')
+    draw_histogram(axes[2], panels['flight_sleeps'], alpha=0.5, color='blue', label='flight sleeps')
+    draw_histogram(axes[2], panels['non_flight_sleeps'], title='Flight VS Non-Flight Sleeps', xlabel='hours slept', alpha=0.5,
+                   color='orange', label='non-flight sleeps')
+    axes[0].figure.suptitle(title)
+
+#The figure reused by render_panels in this process
+FIGURE_TEMPLATE = {}
+
+def render_panels(panels, plot_file, title=''):
+    '''Draws the histograms of plot_data into an image file with the object oriented Agg API, without pyplot or a display. One figure
+    is made per process and cleared and reused for every image, which saves setting up a new figure each time.
+
+    Arguments:
+    panels = the bin counts from plot_panels
+    plot_file = path of the image file, a string. The format is taken from the extension, such as .png or .svg.
+    title = title of the whole figure, such as the participant, a string
+
+    Returns:
+    writes the image file'''
+    if 'figure' not in FIGURE_TEMPLATE:
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        figure = Figure(figsize=(15, 5))
+        FigureCanvasAgg(figure)
+        FIGURE_TEMPLATE['figure'] = figure
+        FIGURE_TEMPLATE['axes'] = figure.subplots(1, 3)
+    figure, axes = FIGURE_TEMPLATE['figure'], FIGURE_TEMPLATE['axes']
+    for subplot in axes:
+        subplot.clear()
+    draw_panels(axes, panels, title)
+    figure.savefig(plot_file)
+
+@pipeline_stage
+def plot_data(sleep_sum_data, flights, flight_sleeps, non_flight_sleeps, sleep_bins, flight_bins, plot_file=None):
+    '''Plots histograms of the sleep data, the flight data, and a comparative histogram of the sleeps affected by airplane flight or not.
+    
+    Arguments:
+    sleep_sum_data = a dataframe with columns day with sleep start date in the format YYYY-MM-DD and actual_hours with sleep duration in hours
+    flights = a dataframe with columns day with flight date in the format YYYY-MM-DD and Duration with fligh duration in hours
+    flight_sleeps = dataframe with column sleep_duration with sleep duration in hours, contains sleeps affected by airplane travel
+    non_flight_sleeps = dataframe with column sleep_duration with sleep duration in hours, contains sleeps not affected by airplane travel
+    Sleep_bins = bins to be used for plotting the sleep data, a numpy array
+    Flight_bins = bins to be used for plotting the  flight data, a numpy array
+    Plot_file = path of an image file (such as .png or .svg) to save the figure to instead of showing it, a string. None shows the
+    figure in a window.
+
+    Returns:
+    draws and shows (or saves) three histograms in one figure'''
+    panels = plot_panels(sleep_sum_data, flights, flight_sleeps, non_flight_sleeps, sleep_bins, flight_bins)
+    if plot_file is not None:
+        #Saving does not need a window, so draw with Agg directly
+        render_panels(panels, plot_file)
+        return
+    import matplotlib.pyplot as plt
+    fig1 = plt.figure(figsize=(15, 5))
+    draw_panels(fig1.subplots(1, 3), panels)
+    plt.show()
+
+#-------------------------------------------------------------------------------------------------------------------------------------
+
+#Section 5: run the analysis for a whole cohort of participants
+
+def find_participants(batch_dir):
+    '''Finds the participant file pairs in a directory. Each participant should have a sleep file named <participant>_sleep.csv and an
+    activity file named <participant>_activities.csv. Compressed pairs named <participant>_sleep.csv.gz or .csv.zst (with the activity
+    file compressed the same way) are found too, for reading with prefetch_participants.
+
+    Arguments:
+    batch_dir = path to the directory containing the participant csv files, a string
+
+    Returns:
+    participants = a dataframe with columns participant, sleep_data_csv, and activity_data_csv, one row per participant sorted by participant'''
+    rows = []
+    for file_name in sorted(os.listdir(batch_dir)):
+        for compression in ('', '.gz', '.zst'):
+            sleep_suffix = '_sleep.csv' + compression
+            if file_name.endswith(sleep_suffix):
+                participant = file_name[:-len(sleep_suffix)]
+                rows.append({'participant': participant,
+                             'sleep_data_csv': os.path.join(batch_dir, file_name),
+                             'activity_data_csv': os.path.join(batch_dir, participant + '_activities.csv' + compression)})
+    return pd.DataFrame(rows, columns=['participant', 'sleep_data_csv', 'activity_data_csv'])
+
+def read_manifest(manifest_csv):
+    '''Reads a batch manifest listing the input files of each participant.
+
+    Arguments:
+    manifest_csv = a csv file with columns participant, sleep_data_csv, and activity_data_csv. Relative file paths are taken relative to
+    the folder the manifest is in.
+
+    Returns:
+    participants = a dataframe with columns participant, sleep_data_csv, and activity_data_csv'''
+    participants = pd.read_csv(manifest_csv, dtype=str)
+    manifest_dir = os.path.dirname(os.path.abspath(manifest_csv))
+    for column in ['sleep_data_csv', 'activity_data_csv']:
+        participants[column] = [os.path.join(manifest_dir, path) for path in participants[column]]
+    return participants.loc[:, ['participant', 'sleep_data_csv', 'activity_data_csv']]
+
+class IngestStats(Result):
+    '''Throughput of prefetch_participants: files and bytes read (on disk and after decompression), time spent reading summed over the
+    reader threads, wall time, and time the analysis spent waiting for files.'''
+    __slots__ = ('files', 'bytes_read', 'bytes_decompressed', 'read_seconds', 'wall_seconds', 'wait_seconds')
+
+    @property
+    def throughput(self):
+        '''Decompressed megabytes delivered per second of wall time.'''
+        return self.bytes_decompressed / 1024 ** 2 / self.wall_seconds if self.wall_seconds else np.nan
+
+def fetch_input(path):
+    '''Reads a whole input file into memory and decompresses it. Files ending in .gz are gzip files and files ending in .zst are
+    zstandard files, which needs the optional zstandard package.
+
+    Arguments:
+    path = path to the file, a string
+
+    Returns:
+    data = the decompressed contents of the file, bytes
+    n_read = the number of bytes read from disk, integer'''
+    with open(path, 'rb') as file:
+        raw = file.read()
+    if path.endswith('.gz'):
+        import gzip
+        return gzip.decompress(raw), len(raw)
+    if path.endswith('.zst'):
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError('reading .zst files needs the zstandard package, install it with pip install zstandard')
+        return zstandard.ZstdDecompressor().stream_reader(io.BytesIO(raw)).read(), len(raw)
+    return raw, len(raw)
+
+def fetch_participant(sleep_data_csv, activity_data_csv):
+    '''Reads both input files of one participant into memory with fetch_input and times it.
+
+    Arguments:
+    sleep_data_csv = path to the participant's sleep data csv, a string
+    activity_data_csv = path to the participant's activity data csv, a string
+
+    Returns:
+    files = (sleep file contents, activity file contents, bytes read from disk, seconds spent reading)'''
+    start = time.perf_counter()
+    sleep_bytes, sleep_read = fetch_input(sleep_data_csv)
+    activity_bytes, activity_read = fetch_input(activity_data_csv)
+    return sleep_bytes, activity_bytes, sleep_read + activity_read, time.perf_counter() - start
+
+def prefetch_participants(participants, threads=4, max_inflight_bytes=512 * 1024 ** 2, stats=None):
+    '''Reads and decompresses the input files of the upcoming participants in a pool of threads while the caller works on the current
+    one, so the analysis does not wait on slow (for example network mounted) storage. Participants are given back in order. Reading
+    ahead stops while the decompressed contents held but not yet given back would exceed max_inflight_bytes, so memory use stays
+    bounded; at least one participant is always read ahead. Files still being read are counted at their size on disk times the
+    decompression ratio seen so far, since their decompressed size is only known once they are read. A participant whose files cannot
+    be read is given back with the error instead of the contents.
+
+    Arguments:
+    participants = a dataframe with columns participant, sleep_data_csv, and activity_data_csv, from find_participants or read_manifest
+    threads = number of reader threads, integer
+    max_inflight_bytes = the largest total size of the decompressed file contents read ahead, integer
+    stats = an IngestStats to add the throughput of the reads to, or None
+
+    Returns:
+    yields (participant, sleep file contents, activity file contents, error) for each participant, with the contents as bytes (None
+    and the exception if the files could not be read)'''
+    from concurrent.futures import ThreadPoolExecutor
+    jobs = list(participants.loc[:, ['participant', 'sleep_data_csv', 'activity_data_csv']].itertuples(index=False, name=None))
+    if stats is None:
+        stats = IngestStats()
+    for name in IngestStats.__slots__:
+        if getattr(stats, name) is None:
+            setattr(stats, name, 0)
+
+    def file_size(job):
+        try:
+            return os.path.getsize(job[1]) + os.path.getsize(job[2])
+        except OSError:
+            return 0
+
+    def finished_reads():
+        #(decompressed bytes, bytes on disk) of the reads that are done but not given back yet
+        return [(len(future.result()[0]) + len(future.result()[1]), future.result()[2]) for _, _, future in pending
+                if future.done() and future.exception() is None]
+
+    def inflight_bytes(next_size):
+        #Memory held by the reads ahead, with reads still running (and the next one) estimated from the decompression ratio so far
+        done = finished_reads()
+        decompressed = stats.bytes_decompressed + sum(held for held, _ in done)
+        on_disk = stats.bytes_read + sum(read for _, read in done)
+        ratio = decompressed / on_disk if on_disk else 1
+        running = sum(size for _, size, future in pending if not future.done())
+        return sum(held for held, _ in done) + (running + next_size) * ratio
+
+    start = time.perf_counter()
+    pending = []
+    next_job = 0
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        while pending or next_job < len(jobs):
+            #Read ahead while there is room within the in-flight limit
+            while next_job < len(jobs) and (not pending or inflight_bytes(file_size(jobs[next_job])) <= max_inflight_bytes):
+                pending.append((jobs[next_job], file_size(jobs[next_job]), executor.submit(fetch_participant, *jobs[next_job][1:])))
+                next_job += 1
+            job, size, future = pending.pop(0)
+            wait_start = time.perf_counter()
+            try:
+                sleep_bytes, activity_bytes, n_read, seconds = future.result()
+            except Exception as error:
+                sleep_bytes, activity_bytes, error_found = None, None, error
+            else:
+                error_found = None
+                stats.files += 2
+                stats.bytes_read += n_read
+                stats.bytes_decompressed += len(sleep_bytes) + len(activity_bytes)
+                stats.read_seconds += seconds
+            stats.wait_seconds += time.perf_counter() - wait_start
+            yield job[0], sleep_bytes, activity_bytes, error_found
+            stats.wall_seconds = time.perf_counter() - start
+    stats.wall_seconds = time.perf_counter() - start
+
+def analyze_participant(participant, sleep_data_csv, activity_data_csv, date_string, decimals, days_affected_by_flight=3, cache_dir=None,
+                        n_resamples=0, seed=None, keep_series=False, rules=None, plot_file=None, sleep_bins=None, flight_bins=None):
+    '''Runs read_data, sleep_processing, activity_processing, and flight_effect_sleep for one participant without printing anything and
+    collects the results at full precision. Any error is caught and recorded in the result so that one bad participant does not stop
+    the rest of the cohort.
+
+    Arguments:
+    participant = participant identifier, a string
+    sleep_data_csv = path to the participant's sleep data csv, a string, or its contents already read into memory, bytes
+    activity_data_csv = path to the participant's activity data csv, a string, or its contents already read into memory, bytes
+    Date_string = the number of characters to keep from the time columns to keep just the date in the format YYYY-MM-DD
+    Decimals = the number of decimals daily sleep hours and flight durations are rounded to, integer
+    Days_affected_by_flight = number of days, including the day of the flight, counted as "after-flight" dates, integer
+    cache_dir = the cache folder passed to read_data, a string, or None to always parse the csv files
+    N_resamples = number of permutation and bootstrap replicates passed to resample_effect, integer. 0 skips resampling.
+    Seed = seed for resample_effect, integer or None
+    Keep_series = if True, the participant's daily series for a daily store is also made from the processed data, a boolean
+    Rules = a flight rule set from flight_rules or load_flight_rules passed to activity_processing, or None for the default rules
+    Plot_file = path of an image file to render the participant's histograms to from the processed data, a string, or None
+    Sleep_bins = with Plot_file, bins to be used for plotting the sleep data, a numpy array
+    Flight_bins = with Plot_file, bins to be used for plotting the flight data, a numpy array
+
+    Returns:
+    result = a ParticipantResult with the number of flights, the EffectResult, the resample_effect results when resampling, the daily
+    series and the image file when asked for, and an error message (empty if the analysis succeeded). If only the plot fails, the
+    results are kept and the error says the plot failed.'''
+    try:
+        sleep_data, activity_data = read_data(sleep_data_csv, activity_data_csv, cache_dir)
+        sleep_sum_data = sleep_processing(sleep_data, date_string, decimals, verbose=False)
+        flights = activity_processing(activity_data, date_string, decimals, rules=rules, verbose=False)
+        flight_sleeps, non_flight_sleeps = flight_effect_sleep(flights, sleep_sum_data, decimals, days_affected_by_flight, verbose=False)
+        effect = flight_effect(flight_sleeps, non_flight_sleeps)
+        resampled = resample_effect(flight_sleeps, non_flight_sleeps, n_resamples, seed=seed) if n_resamples > 0 else None
+        series = daily_series(sleep_sum_data, flights) if keep_series else None
+    except Exception as error:
+        return ParticipantResult(participant=participant, error='{}: {}'.format(type(error).__name__, error))
+    result = ParticipantResult(participant=participant, n_flights=len(flights), effect=effect, resampled=resampled, error='', series=series)
+    if plot_file is not None:
+        #Render from the bin counts of the data processed above, so plotting needs no second pass over the files
+        try:
+            render_panels(plot_panels(sleep_sum_data, flights, flight_sleeps, non_flight_sleeps, sleep_bins, flight_bins), plot_file,
+                          participant)
+            result.plot_file = plot_file
+        except Exception as error:
+            result.error = 'plot failed: {}: {}'.format(type(error).__name__, error)
+    return result
+
+def run_batch(participants, date_string, decimals, days_affected_by_flight=3, workers=None, cache_dir=None, n_resamples=0, seed=None,
+              output=None, prefetch=0, max_inflight_bytes=512 * 1024 ** 2, ingest_stats=None, store=None, plot_dir=None, plot_format='png',
+              sleep_bins=None, flight_bins=None, rules=None):
+    '''Runs the analysis for every participant in a cohort across a pool of worker processes and collects one results table. If an
+    output file is given, each participant's row is written to it as soon as that participant is done, so results are saved as the
+    batch goes and a stopped batch keeps the participants already finished. If a store file is given, the workers also return each
+    participant's daily series from the data they already processed, and they are written to the store at the end. If a plot folder is
+    given, the workers also render each participant's histograms there from the same data, without a display.
+
+    Arguments:
+    participants = a dataframe with columns participant, sleep_data_csv, and activity_data_csv, from find_participants or read_manifest
+    Date_string = the number of characters to keep from the time columns to keep just the date in the format YYYY-MM-DD
+    Decimals = the number of decimals daily sleep hours and flight durations are rounded to, integer
+    Days_affected_by_flight = number of days, including the day of the flight, counted as "after-flight" dates, integer
+    Workers = number of worker processes, integer. None uses every core, 1 runs every participant in this process.
+    cache_dir = the cache folder passed to read_data, a string, or None to always parse the csv files
+    N_resamples = number of permutation and bootstrap replicates per participant, integer. 0 skips resampling.
+    Seed = seed for resample_effect, integer or None
+    Output = a .csv or .jsonl file to stream the rows to as they finish (in the order they finish), a string, or None
+    Prefetch = number of threads in this process that read and decompress upcoming participants' files with prefetch_participants
+    while the current ones are analyzed, integer. The contents are handed to the workers, so the workers do not wait on the files.
+    0 lets each worker read its participant's files itself.
+    Max_inflight_bytes = with Prefetch, the largest total size of the decompressed file contents read ahead, integer
+    Ingest_stats = with Prefetch, an IngestStats that the read throughput is added to, or None
+    Store = path of a daily store file to write the daily series of every participant that was analyzed to, a string, or None.
+    Participants whose analysis failed are left out of the store, their errors are in the results.
+    Plot_dir = folder to save the histograms of every participant to as <participant>.<plot_format>, a string, or None. It is created
+    if needed.
+    Plot_format = the image format, such as 'png' or 'svg', a string
+    Sleep_bins = with Plot_dir, bins to be used for plotting the sleep data, a numpy array
+    Flight_bins = with Plot_dir, bins to be used for plotting the flight data, a numpy array
+    Rules = a flight rule set from flight_rules or load_flight_rules used for every participant, or None for the default rules
+
+    Returns:
+    results = a dataframe with one row per participant (in the order given) from result_row'''
+    jobs = list(participants.loc[:, ['participant', 'sleep_data_csv', 'activity_data_csv']].itertuples(index=False, name=None))
+    columns = BATCH_COLUMNS + (RESAMPLE_COLUMNS if n_resamples > 0 else [])
+    settings = (date_string, decimals, days_affected_by_flight, cache_dir, n_resamples, seed, store is not None, rules)
+    if plot_dir is not None:
+        os.makedirs(plot_dir, exist_ok=True)
+    plot_files = [None if plot_dir is None else os.path.join(plot_dir, '{}.{}'.format(job[0], plot_format)) for job in jobs]
+    plot_settings = (sleep_bins, flight_bins)
+    rows = [None] * len(jobs)
+    cohort_series = [None] * len(jobs)
+    #Each input is (index, participant, sleep file, activity file, read error), with the files as paths or prefetched contents
+    if prefetch > 0:
+        inputs = ((i,) + fetched for i, fetched in enumerate(prefetch_participants(participants, prefetch, max_inflight_bytes, ingest_stats)))
+    else:
+        inputs = ((i,) + job + (None,) for i, job in enumerate(jobs))
+
+    def failed(i, error):
+        return ParticipantResult(participant=jobs[i][0], error='{}: {}'.format(type(error).__name__, error))
+
+    with (ResultWriter(output, columns) if output else contextlib.nullcontext()) as writer:
+        def finish(i, result):
+            cohort_series[i] = result.series
+            rows[i] = result_row(result)
+            if writer is not None:
+                writer.write(rows[i])
+
+        if workers == 1:
+            for i, participant, sleep_data_csv, activity_data_csv, error in inputs:
+                finish(i, failed(i, error) if error is not None else
+                       analyze_participant(participant, sleep_data_csv, activity_data_csv, *settings, plot_files[i], *plot_settings))
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                #Only a few participants per worker are queued at once, so prefetched contents waiting for a worker stay bounded too
+                max_queued = 2 * (workers or os.cpu_count() or 1)
+                futures = {}
+
+                def collect(done):
+                    for future in done:
+                        i = futures.pop(future)
+                        #A worker that dies outright (rather than raising) is still recorded as a failed participant
+                        try:
+                            finish(i, future.result())
+                        except Exception as error:
+                            finish(i, failed(i, error))
+
+                for i, participant, sleep_data_csv, activity_data_csv, error in inputs:
+                    if error is not None:
+                        finish(i, failed(i, error))
+                        continue
+                    futures[executor.submit(analyze_participant, participant, sleep_data_csv, activity_data_csv, *settings, plot_files[i],
+                                            *plot_settings)] = i
+                    if len(futures) >= max_queued:
+                        collect(wait(futures, return_when=FIRST_COMPLETED)[0])
+                for future in as_completed(list(futures)):
+                    collect([future])
+    if store is not None:
+        write_daily_store(store, {job[0]: series for job, series in zip(jobs, cohort_series) if series is not None})
+    return pd.DataFrame(rows, columns=columns)
+
+def render_batch(participants, plot_dir, date_string, decimals, sleep_bins, flight_bins, plot_format='png', days_affected_by_flight=3,
+                 workers=None, cache_dir=None):
+    '''Renders the histograms of every participant in a cohort to one image file each, <participant>.<plot_format> in plot_dir,
+    across a pool of worker processes. No display is needed. This runs a batch only for the images, to get the results as well pass
+    plot_dir to run_batch instead, so the files are only processed once.
+
+    Arguments:
+    participants = a dataframe with columns participant, sleep_data_csv, and activity_data_csv, from find_participants or read_manifest
+    plot_dir = the folder to write the images to, a string. It is created if needed.
+    Date_string = the number of characters to keep from the time columns to keep just the date in the format YYYY-MM-DD
+    Decimals = the number of decimals daily sleep hours and flight durations are rounded to, integer
+    Sleep_bins = bins to be used for plotting the sleep data, a numpy array
+    Flight_bins = bins to be used for plotting the flight data, a numpy array
+    Plot_format = the image format, such as 'png' or 'svg', a string
+    Days_affected_by_flight = number of days, including the day of the flight, counted as "after-flight" dates, integer
+    Workers = number of worker processes, integer. None uses every core, 1 renders every participant in this process.
+    cache_dir = the cache folder passed to read_data, a string, or None to always parse the csv files
+
+    Returns:
+    results = a dataframe with columns participant, plot_file, and error (empty if the image was written), in the order given'''
+    results = run_batch(participants, date_string, decimals, days_affected_by_flight, workers, cache_dir, plot_dir=plot_dir,
+                        plot_format=plot_format, sleep_bins=sleep_bins, flight_bins=flight_bins)
+    plot_files = [os.path.join(plot_dir, '{}.{}'.format(participant, plot_format)) for participant in results['participant']]
+    return pd.DataFrame({'participant': results['participant'], 'plot_file': plot_files, 'error': results['error']})
+
+#-------------------------------------------------------------------------------------------------------------------------------------
+
+#Section 6: test how sensitive the flight effect is to the analysis parameters
+
+def sweep_inputs(sleep_data, activity_data, date_string, decimals, labels=FLIGHT_CANDIDATE_LABELS):
+    '''Computes the parts of the analysis that do not depend on the flight parameters once, so every combination of parameters in a
+    sweep can reuse them: the daily sleep totals and, for every activity that could be a flight, its day, duration, and speed.
+
+    Arguments:
+    sleep_data = a pandas dataframe with columns start_time_iso with GMT time and actual_minutes with sleep duration in minutes
+    activity_data = a pandas dataframe with columns Start with GMT time, Duration with activity duration in seconds, Distance with activity distance in miles, and Activity with activity label
+    Date_string = the number of characters to keep from the time columns to keep just the date in the format YYYY-MM-DD
+    Decimals = the number of decimals you want answers rounded to, integer
+    Labels = the activity labels that can be flights, a list of strings, such as rule_labels of a rule set
+
+    Returns:
+    inputs = a dictionary with numpy arrays sleep_days and sleep_hours for each day with sleep, activity_days for each activity with
+    one of the labels, and the activity_columns of those activities under columns'''
+    sleep_sum_data = sleep_processing(sleep_data, date_string, decimals, verbose=False)
+    candidates = activity_data.loc[activity_data['Activity'].isin(labels) & activity_data['Start'].notna()]
+    return {'sleep_days': sleep_sum_data['day_ordinal'].to_numpy(), 'sleep_hours': sleep_sum_data['actual_hours'].to_numpy(),
+            'activity_days': timestamp_days(candidates['Start']), 'columns': activity_columns(candidates)}
+
+def sweep_cell(inputs, lower_speed_threshold, upper_speed_threshold, lower_duration_threshold, days_affected_grid, rules=None):
+    '''Evaluates the flight effect for one set of flight thresholds and every window length. The flights are found once for the
+    thresholds and then reused for every window length.
+
+    Arguments:
+    inputs = the dictionary of arrays from sweep_inputs
+    Lower_speed_threshold = transport activities must be faster than this speed in miles/hour to count as flights
+    Upper_speed_threshold = transport activities must be slower than this speed in miles/hour to count as flights
+    Lower_duration_threshold = flights must be longer than this duration in hours
+    Days_affected_grid = the window lengths to evaluate, a list of integers
+    Rules = a flight rule set that replaces the thresholds, which are then None, or None to build the default rules from them
+
+    Returns:
+    rows = a list of dictionaries, one per window length, with the parameters and the resulting group sizes, t test, and cohen's d'''
+    if rules is None:
+        rules = flight_rules(lower_speed_threshold, upper_speed_threshold, lower_duration_threshold)
+    is_flight = compile_flight_rules(rules)(inputs['columns'])
+    flight_days = inputs['activity_days'][is_flight]
+    rows = []
+    for days_affected_by_flight in days_affected_grid:
+        is_flight_sleep = in_flight_window(inputs['sleep_days'], flight_days, days_affected_by_flight)
+        flight_values, non_flight_values = inputs['sleep_hours'][is_flight_sleep], inputs['sleep_hours'][~is_flight_sleep]
+        t_statistic, p_value, eff_size = effect_tests(flight_values, non_flight_values)
+        rows.append({'days_affected_by_flight': days_affected_by_flight, 'lower_speed_threshold': lower_speed_threshold,
+                     'upper_speed_threshold': upper_speed_threshold, 'lower_duration_threshold': lower_duration_threshold,
+                     'n_flights': int(is_flight.sum()), 'n_flight_sleeps': len(flight_values), 'n_non_flight_sleeps': len(non_flight_values),
+                     'cohens_d': eff_size, 't_statistic': t_statistic, 'p_value': p_value})
+    return rows
+
+def sweep_parameters(sleep_data, activity_data, date_string, decimals, days_affected_grid=(3,), lower_speed_grid=(100,),
+                     upper_speed_grid=(700,), lower_duration_grid=(0.5,), workers=1, rules=None):
+    '''Runs the flight effect analysis for every combination of the window length and flight thresholds in the given grids. The daily
+    sleep and per-activity speeds and durations are computed once and reused for every combination, so only the flight selection and
+    the after-flight split are redone for each one.
+
+    Arguments:
+    sleep_data = a pandas dataframe with columns start_time_iso with GMT time and actual_minutes with sleep duration in minutes
+    activity_data = a pandas dataframe with columns Start with GMT time, Duration with activity duration in seconds, Distance with activity distance in miles, and Activity with activity label
+    Date_string = the number of characters to keep from the time columns to keep just the date in the format YYYY-MM-DD
+    Decimals = the number of decimals you want answers rounded to, integer
+    Days_affected_grid = window lengths (days_affected_by_flight) to try, a list of integers
+    Lower_speed_grid = lower speed thresholds to try, a list of numbers
+    Upper_speed_grid = upper speed thresholds to try, a list of numbers
+    Lower_duration_grid = lower duration thresholds to try, a list of numbers
+    Workers = number of worker processes the threshold combinations are spread across, integer. 1 runs them in this process.
+    Rules = a flight rule set from load_flight_rules to find the flights with instead of the thresholds, or None. With rules, the
+    threshold grids are not used and only the window lengths are swept, with empty threshold columns.
+
+    Returns:
+    results = a dataframe with one row per combination of parameters with the group sizes, cohen's d, t statistic, and p value'''
+    if rules is None:
+        inputs = sweep_inputs(sleep_data, activity_data, date_string, decimals)
+        thresholds = list(itertools.product(lower_speed_grid, upper_speed_grid, lower_duration_grid))
+    else:
+        inputs = sweep_inputs(sleep_data, activity_data, date_string, decimals, rule_labels(rules))
+        thresholds = [(None, None, None)]
+    if workers == 1:
+        cells = [sweep_cell(inputs, *cell, days_affected_grid, rules) for cell in thresholds]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(sweep_cell, inputs, *cell, days_affected_grid, rules) for cell in thresholds]
+            cells = [future.result() for future in futures]
+    return pd.DataFrame([row for cell in cells for row in cell])
+
+#-------------------------------------------------------------------------------------------------------------------------------------
+
+#Section 7: update the flight effect incrementally as new data arrives
+
+def new_running_state(date_string, decimals, days_affected_by_flight=3, rules=None):
+    '''Creates an empty running state for one participant. The state holds the total minutes slept on each day, the set of flight days,
+    and the running count, mean, and sum of squared deviations (Welford's moments) of daily sleep hours for the flight-affected and the
+    other days, so that new data can be added without going back over the full history.
+
+    Arguments:
+    Date_string = the number of characters to keep from the time columns to keep just the date in the format YYYY-MM-DD
+    Decimals = the number of decimals daily sleep hours are rounded to, integer
+    Days_affected_by_flight = number of days, including the day of the flight, counted as "after-flight" dates, integer
+    Rules = a flight rule set from flight_rules or load_flight_rules that new activities are checked with, or None for the default rules
+
+    Returns:
+    state = a dictionary with the settings, sleep_minutes (day ordinal to minutes), flight_days (a set of day ordinals), and the moments
+    of the flight and non_flight groups as [count, mean, sum of squared deviations] lists'''
+    return {'date_string': date_string, 'decimals': decimals, 'days_affected_by_flight': days_affected_by_flight, 'rules': rules,
+            'sleep_minutes': {}, 'flight_days': set(), 'flight': [0, 0.0, 0.0], 'non_flight': [0, 0.0, 0.0]}
+
+def add_to_moments(moments, value):
+    '''Adds one value to running moments with Welford's method.
+
+    Arguments:
+    moments = [count, mean, sum of squared deviations], a list that is updated in place
+    value = the value to add, a number'''
+    moments[0] += 1
+    delta = value - moments[1]
+    moments[1] += delta / moments[0]
+    moments[2] += delta * (value - moments[1])
+
+def remove_from_moments(moments, value):
+    '''Removes one value that was previously added from running moments, reversing add_to_moments.
+
+    Arguments:
+    moments = [count, mean, sum of squared deviations], a list that is updated in place
+    value = the value to remove, a number'''
+    if moments[0] <= 1:
+        moments[:] = [0, 0.0, 0.0]
+        return
+    old_mean = moments[1]
+    moments[0] -= 1
+    moments[1] = (old_mean * (moments[0] + 1) - value) / moments[0]
+    moments[2] = max(moments[2] - (value - moments[1]) * (value - old_mean), 0.0)
+
+def is_flight_day(state, day):
+    '''Determines if a day falls on or within the days following any flight in the state.
+
+    Arguments:
+    state = a running state from new_running_state
+    day = the day ordinal to check, integer
+
+    Returns:
+    affected = True if the day is affected by a flight'''
+    return any(day - offset in state['flight_days'] for offset in range(state['days_affected_by_flight']))
+
+def daily_hours(state, day):
+    '''Converts the total sleep on a day from minutes to hours, rounded the same way as sleep_processing.
+
+    Arguments:
+    state = a running state from new_running_state
+    day = the day ordinal, integer
+
+    Returns:
+    hours = the hours slept on that day'''
+    min_in_hour = 60
+    return round(state['sleep_minutes'][day] / min_in_hour, state['decimals'])
+
+def update_running_state(state, sleep_data=None, activity_data=None):
+    '''Adds new sleep and activity rows to a running state. Only the days the new rows touch are re-summed, and only the days inside the
+    windows of new flights are moved between the flight and non-flight groups, so the cost depends on the size of the new data and not
+    on the size of the history.
+
+    Arguments:
+    state = a running state from new_running_state or load_running_state, updated in place
+    sleep_data = new sleep rows, a pandas dataframe with columns start_time_iso and actual_minutes, or None
+    activity_data = new activity rows, a pandas dataframe with columns Start, Duration, Distance, and Activity, or None
+
+    Returns:
+    state = the updated running state'''
+    date_string, decimals = state['date_string'], state['decimals']
+    #Add the new flights first and move the sleep days in their windows into the flight group
+    if activity_data is not None and len(activity_data) > 0:
+        #States saved before rules were kept in them use the default rules
+        flights = activity_processing(activity_data, date_string, decimals, rules=state.get('rules'), verbose=False)
+        for flight_day in np.unique(flights['day_ordinal']).tolist():
+            if flight_day in state['flight_days']:
+                continue
+            for day in range(flight_day, flight_day + state['days_affected_by_flight']):
+                if day in state['sleep_minutes'] and not is_flight_day(state, day):
+                    hours = daily_hours(state, day)
+                    remove_from_moments(state['non_flight'], hours)
+                    add_to_moments(state['flight'], hours)
+            state['flight_days'].add(flight_day)
+    #Then add the new sleep, replacing the old total of every day the new rows fall on
+    if sleep_data is not None and len(sleep_data) > 0:
+        days = timestamp_days(sleep_data['start_time_iso'])
+        has_day = days != MISSING_DAY
+        new_minutes = sleep_data['actual_minutes'][has_day].astype(np.float64).groupby(days[has_day]).sum()
+        for day, minutes in new_minutes.items():
+            group = state['flight'] if is_flight_day(state, day) else state['non_flight']
+            if day in state['sleep_minutes']:
+                remove_from_moments(group, daily_hours(state, day))
+            state['sleep_minutes'][day] = state['sleep_minutes'].get(day, 0) + int(minutes)
+            add_to_moments(group, daily_hours(state, day))
+    return state
+
+def running_effect(state):
+    '''Calculates the t test and cohen's d comparing flight-affected and other sleep from the running moments of a state.
+
+    Arguments:
+    state = a running state from new_running_state or load_running_state
+
+    Returns:
+    results = a dictionary with the size and mean of each group, t_statistic, p_value, and cohens_d'''
+    from scipy import stats
+    n1, mean1, m2_1 = state['flight']
+    n2, mean2, m2_2 = state['non_flight']
+    results = {'n_flight_sleeps': n1, 'n_non_flight_sleeps': n2, 'mean_flight_sleep': mean1, 'mean_non_flight_sleep': mean2,
+               't_statistic': np.nan, 'p_value': np.nan, 'cohens_d': np.nan}
+    if n1 < 2 or n2 < 2:
+        return results
+    pooled_var = (m2_1 + m2_2) / (n1 + n2 - 2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        results['t_statistic'] = (mean1 - mean2) / np.sqrt(pooled_var * (1 / n1 + 1 / n2))
+        results['cohens_d'] = (mean1 - mean2) / np.sqrt(pooled_var)
+    results['p_value'] = 2 * stats.t.sf(abs(results['t_statistic']), n1 + n2 - 2)
+    return results
+
+def save_running_state(state, path):
+    '''Saves a running state to a json file.
+
+    Arguments:
+    state = a running state from new_running_state or load_running_state
+    path = path of the json file, a string'''
+    saved = dict(state, sleep_minutes={str(day): minutes for day, minutes in state['sleep_minutes'].items()},
+                 flight_days=sorted(state['flight_days']))
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as file:
+        json.dump(saved, file)
+    os.replace(tmp_path, path)
+
+def load_running_state(path):
+    '''Loads a running state saved by save_running_state.
+
+    Arguments:
+    path = path of the json file, a string
+
+    Returns:
+    state = the running state'''
+    with open(path) as file:
+        state = json.load(file)
+    state['sleep_minutes'] = {int(day): minutes for day, minutes in state['sleep_minutes'].items()}
+    state['flight_days'] = set(state['flight_days'])
+    return state
+
+#-------------------------------------------------------------------------------------------------------------------------------------
+
+#Section 8: store the daily sleep and flight days of a cohort in one memory-mapped file
+
+#The store file starts with an 8 byte tag and the length of a json index, then the index, then one block of daily sleep hours (float32,
+#NaN on days without sleep) and one block of flight days (one bit per day) per participant. Every block starts on an 8 byte boundary.
+STORE_MAGIC = b'SLPSTOR1'
+STORE_ALIGN = 8
+
+def daily_series(sleep_sum_data, flights):
+    '''Puts a participant's daily sleep and flight days on one dense daily grid, covering every day from the first to the last day with
+    sleep or a flight.
+
+    Arguments:
+    sleep_sum_data = a dataframe from sleep_processing with columns day_ordinal (or day) and actual_hours
+    flights = a dataframe from activity_processing with column day_ordinal (or day)
+
+    Returns:
+    series = a dictionary with first_day (day ordinal of the first day of the grid), sleep_hours (a float32 numpy array with the hours
+    slept each day, NaN on days without sleep), flight_days (a boolean numpy array, True on days with a flight), and flight_hours (a
+    float32 numpy array with the total hours flown each day). flight_hours is not kept in a store.'''
+    sleep_ordinals = sleep_sum_data['day_ordinal'].to_numpy() if 'day_ordinal' in sleep_sum_data.columns else day_ordinals(sleep_sum_data['day'])
+    flight_ordinals = flights['day_ordinal'].to_numpy() if 'day_ordinal' in flights.columns else day_ordinals(flights['day'])
+    all_ordinals = np.concatenate([sleep_ordinals, flight_ordinals]).astype(np.int64)
+    if len(all_ordinals) == 0:
+        return {'first_day': 0, 'sleep_hours': np.zeros(0, dtype=np.float32), 'flight_days': np.zeros(0, dtype=bool),
+                'flight_hours': np.zeros(0, dtype=np.float32)}
+    first_day = int(all_ordinals.min())
+    n_days = int(all_ordinals.max()) - first_day + 1
+    sleep_hours = np.full(n_days, np.nan, dtype=np.float32)
+    sleep_hours[sleep_ordinals - first_day] = sleep_sum_data['actual_hours'].to_numpy()
+    flight_days = np.zeros(n_days, dtype=bool)
+    flight_days[flight_ordinals - first_day] = True
+    #Flights without a duration count as one hour each
+    durations = flights['Duration'].to_numpy(dtype=float) if 'Duration' in flights.columns else np.ones(len(flight_ordinals))
+    flight_hours = np.bincount(flight_ordinals - first_day, weights=durations, minlength=n_days).astype(np.float32)
+    return {'first_day': first_day, 'sleep_hours': sleep_hours, 'flight_days': flight_days, 'flight_hours': flight_hours}
+
+def aligned(n_bytes):
+    '''Rounds a number of bytes up to the next block boundary of the store.
+
+    Arguments:
+    n_bytes = number of bytes, integer
+
+    Returns:
+    n_aligned = the smallest multiple of STORE_ALIGN that is at least n_bytes'''
+    return -(-n_bytes // STORE_ALIGN) * STORE_ALIGN
+
+def write_daily_store(path, cohort_series):
+    '''Writes the daily series of a cohort to one store file. The file is written next to its final path and moved into place, so a
+    reader never sees a partly written store.
+
+    Arguments:
+    path = path of the store file, a string
+    cohort_series = a dictionary of participant identifier to the series from daily_series'''
+    #Lay out the blocks first so the index can give the offset of every block from the start of the data
+    index = {}
+    blocks = []
+    offset = 0
+    for participant, series in cohort_series.items():
+        sleep_block = np.ascontiguousarray(series['sleep_hours'], dtype='<f4').tobytes()
+        flight_block = np.packbits(np.asarray(series['flight_days'], dtype=bool)).tobytes()
+        index[participant] = {'first_day': int(series['first_day']), 'n_days': len(series['sleep_hours']),
+                              'sleep_offset': offset, 'flight_offset': offset + aligned(len(sleep_block))}
+        offset += aligned(len(sleep_block)) + aligned(len(flight_block))
+        blocks.append((sleep_block, flight_block))
+    index_bytes = json.dumps({'participants': index}).encode()
+    header_size = len(STORE_MAGIC) + 8
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as file:
+        file.write(STORE_MAGIC)
+        file.write(np.uint64(len(index_bytes)).tobytes())
+        file.write(index_bytes.ljust(aligned(header_size + len(index_bytes)) - header_size, b' '))
+        for sleep_block, flight_block in blocks:
+            file.write(sleep_block.ljust(aligned(len(sleep_block)), b'\0'))
+            file.write(flight_block.ljust(aligned(len(flight_block)), b'\0'))
+    os.replace(tmp_path, path)
+
+def open_daily_store(path):
+    '''Opens a store file written by write_daily_store. Only the index is read, the daily data is memory-mapped and read from disk as
+    it is used, so stores much larger than memory can be opened.
+
+    Arguments:
+    path = path of the store file, a string
+
+    Returns:
+    store = a dictionary with participants (participant identifier to first_day, n_days, and block offsets), data_offset, and data
+    (the memory-mapped file as a uint8 numpy array)'''
+    header_size = len(STORE_MAGIC) + 8
+    with open(path, 'rb') as file:
+        if file.read(len(STORE_MAGIC)) != STORE_MAGIC:
+            raise ValueError(path + ' is not a daily store file')
+        index_size = int(np.frombuffer(file.read(8), dtype=np.uint64)[0])
+        index = json.loads(file.read(index_size))
+    data = np.memmap(path, dtype=np.uint8, mode='r')
+    return {'participants': index['participants'], 'data_offset': aligned(header_size + index_size), 'data': data}
+
+def store_series(store, participant):
+    '''Gets the daily series of one participant from an open store. The sleep hours are a view into the memory-mapped file, no data is
+    copied.
+
+    Arguments:
+    store = an open store from open_daily_store
+    participant = participant identifier, a string
+
+    Returns:
+    series = a dictionary with first_day, sleep_hours, and flight_days like daily_series'''
+    entry = store['participants'][participant]
+    n_days = entry['n_days']
+    sleep_start = store['data_offset'] + entry['sleep_offset']
+    flight_start = store['data_offset'] + entry['flight_offset']
+    sleep_hours = store['data'][sleep_start:sleep_start + 4 * n_days].view('<f4').view(np.ndarray)
+    flight_bits = store['data'][flight_start:flight_start + (n_days + 7) // 8]
+    flight_days = np.unpackbits(flight_bits, count=n_days).astype(bool)
+    return {'first_day': entry['first_day'], 'sleep_hours': sleep_hours, 'flight_days': flight_days}
+
+def after_flight_days(flight_days, days_affected_by_flight):
+    '''Marks the days of a dense daily grid that fall on or within the days following a flight, the same days in_flight_window marks.
+    The number of flights in the window ending on each day is a difference of a running count of flights, so this is a single pass.
+
+    Arguments:
+    flight_days = a boolean numpy array, True on days with a flight
+    days_affected_by_flight = number of days, including the day of the flight, affected by a flight, integer
+
+    Returns:
+    mask = a boolean numpy array, True for the days affected by a flight'''
+    n_days = len(flight_days)
+    if days_affected_by_flight <= 0:
+        return np.zeros(n_days, dtype=bool)
+    flight_count = np.concatenate([[0], np.cumsum(flight_days)])
+    window_start = np.maximum(np.arange(n_days) + 1 - days_affected_by_flight, 0)
+    return flight_count[1:] > flight_count[window_start]
+
+def build_daily_store(participants, path, date_string, decimals, workers=None, cache_dir=None):
+    '''Processes every participant in a cohort across a pool of worker processes and writes their daily series to one store file,
+    without the rest of the batch results. Participants whose files cannot be processed are left out of the store. To write a store
+    as part of a batch, pass store to run_batch instead, so the files are only processed once.
+
+    Arguments:
+    participants = a dataframe with columns participant, sleep_data_csv, and activity_data_csv, from find_participants or read_manifest
+    path = path of the store file, a string
+    Date_string = the number of characters to keep from the time columns to keep just the date in the format YYYY-MM-DD
+    Decimals = the number of decimals you want answers rounded to, integer
+    Workers = number of worker processes, integer. None uses every core, 1 runs every participant in this process.
+    cache_dir = the cache folder passed to read_data, a string, or None to always parse the csv files
+
+    Returns:
+    failed = a dictionary of each participant left out of the store to its error message'''
+    results = run_batch(participants, date_string, decimals, workers=workers, cache_dir=cache_dir, store=path)
+    failed = results.loc[results['error'] != '', ['participant', 'error']]
+    return dict(zip(failed['participant'], failed['error']))
+
+def split_series_sleep(series, decimals, days_affected_by_flight=3):
+    '''Splits the days with sleep in a daily series into flight-affected and other days. The float32 hours are rounded back to the
+    decimals they were stored with, so they match the hours from sleep_processing exactly.
+
+    Arguments:
+    series = a daily series from daily_series or store_series
+    Decimals = the number of decimals daily sleep hours were rounded to, integer
+    Days_affected_by_flight = number of days, including the day of the flight, counted as "after-flight" dates, integer
+
+    Returns:
+    flight_sleeps = the hours slept on flight-affected days, a float64 numpy array in day order
+    non_flight_sleeps = the hours slept on the other days, a float64 numpy array in day order'''
+    sleep_hours = np.round(np.asarray(series['sleep_hours'], dtype=np.float64), decimals)
+    has_sleep = ~np.isnan(sleep_hours)
+    is_flight_sleep = after_flight_days(series['flight_days'], days_affected_by_flight)
+    return sleep_hours[has_sleep & is_flight_sleep], sleep_hours[has_sleep & ~is_flight_sleep]
+
+def store_days(store, participants=None):
+    '''Gathers the daily series of the participants in a store into flat arrays with a few numpy operations on the memory-mapped file,
+    without a python loop over the days. The arrays are in memory, so for a large store gather a block of participants at a time.
+
+    Arguments:
+    store = an open store from open_daily_store
+    participants = the participant identifiers to gather, a list of strings, or None for every participant in the store
+
+    Returns:
+    days = a dictionary with participants (the identifiers in the order given, or in store order), starts (the position of each
+    participant's first day in the flat arrays), n_days (the number of days of each participant), sleep_hours (float32, NaN on days
+    without sleep), and flight_days (boolean) for every day of every participant'''
+    participants = list(store['participants']) if participants is None else list(participants)
+    entries = [store['participants'][participant] for participant in participants]
+    n_days = np.array([entry['n_days'] for entry in entries], dtype=np.int64)
+    starts = np.concatenate([[0], np.cumsum(n_days)[:-1]]).astype(np.int64) if len(n_days) else np.zeros(0, dtype=np.int64)
+    #Position of each day within its participant's blocks
+    day_in_series = np.arange(n_days.sum()) - np.repeat(starts, n_days)
+    data = store['data'][store['data_offset']:]
+    #Blocks are aligned to STORE_ALIGN bytes, so every sleep block starts on a float32 boundary of the data
+    sleep_starts = np.array([entry['sleep_offset'] for entry in entries], dtype=np.int64) // 4
+    sleep_hours = data[:len(data) // 4 * 4].view('<f4')[np.repeat(sleep_starts, n_days) + day_in_series]
+    #Flight days are packed 8 to a byte, first day in the highest bit, as np.packbits writes them
+    flight_bytes = np.repeat(np.array([entry['flight_offset'] for entry in entries], dtype=np.int64), n_days) + day_in_series // 8
+    flight_days = (data[flight_bytes] >> (7 - day_in_series % 8).astype(np.uint8)) & 1
+    return {'participants': participants, 'starts': starts, 'n_days': n_days, 'sleep_hours': np.asarray(sleep_hours),
+            'flight_days': flight_days.astype(bool)}
+
+def store_long_table(store, decimals, days_affected_by_flight=3, days=None):
+    '''Lists every day with sleep of every participant in a store as one long table, with the group of the day. The table is built
+    from the flat arrays of store_days for all participants at once.
+
+    Arguments:
+    store = an open store from open_daily_store
+    Decimals = the number of decimals daily sleep hours were rounded to, integer
+    Days_affected_by_flight = number of days, including the day of the flight, counted as "after-flight" dates, integer
+    Days = the arrays from store_days if they were already gathered, such as for a block of participants, or None to gather every
+    participant in the store
+
+    Returns:
+    table = a dataframe with columns participant (categorical), group ('flight' or 'non_flight'), and value (hours slept), one row per
+    day with sleep, in day order within each participant'''
+    if days is None:
+        days = store_days(store)
+    n_days = days['n_days']
+    participant_codes = np.repeat(np.arange(len(n_days)), n_days)
+    #The after-flight window of after_flight_days over every participant at once: a running count of flights over the flat arrays,
+    #with each window cut off at the start of its participant
+    flight_count = np.concatenate([[0], np.cumsum(days['flight_days'])])
+    position = np.arange(len(participant_codes))
+    if days_affected_by_flight > 0:
+        window_start = np.maximum(position + 1 - days_affected_by_flight, days['starts'][participant_codes])
+        is_flight_sleep = flight_count[position + 1] > flight_count[window_start]
+    else:
+        is_flight_sleep = np.zeros(len(position), dtype=bool)
+    #The float32 hours are rounded back to the decimals they were stored with, like split_series_sleep
+    sleep_hours = np.round(days['sleep_hours'].astype(np.float64), decimals)
+    has_sleep = ~np.isnan(sleep_hours)
+    return pd.DataFrame({'participant': pd.Categorical.from_codes(participant_codes[has_sleep], categories=days['participants']),
+                         'group': pd.Categorical.from_codes(np.where(is_flight_sleep[has_sleep], 0, 1).astype(np.int8),
+                                                            categories=['flight', 'non_flight']),
+                         'value': sleep_hours[has_sleep]})
+
+#Participants are read from a store this many at a time, so the days of a whole cohort never need to be in memory at once
+STORE_BLOCK_SIZE = 256
+
+def cohort_flight_effect(store, decimals, days_affected_by_flight=3, block_size=STORE_BLOCK_SIZE):
+    '''Compares flight-affected and other sleep for every participant in a store, working only on the memory-mapped daily arrays. The
+    participants are taken a block at a time: the days of a block are gathered with store_days and compared at once with
+    grouped_effects, so memory use depends on the block size and not on the size of the cohort.
+
+    Arguments:
+    store = an open store from open_daily_store
+    Decimals = the number of decimals daily sleep hours were rounded to, integer
+    Days_affected_by_flight = number of days, including the day of the flight, counted as "after-flight" dates, integer
+    Block_size = the number of participants gathered into memory at a time, integer
+
+    Returns:
+    results = a dataframe with one row per participant with the number of flight days, size and mean of each sleep group, t statistic,
+    p value, and cohen's d'''
+    participants = list(store['participants'])
+    blocks = []
+    #Every participant's days are in a single block, so each block's results are final and only they are kept. An empty store is one
+    #empty block.
+    for block_start in range(0, max(len(participants), 1), block_size):
+        days = store_days(store, participants[block_start:block_start + block_size])
+        effects = grouped_effects(store_long_table(store, decimals, days_affected_by_flight, days), 'flight', 'non_flight')
+        #Flight days per participant with one reduceat over the flat flight days. Participants without days have no segment.
+        n_flight_days = np.zeros(len(days['participants']), dtype=np.int64)
+        has_days = days['n_days'] > 0
+        if has_days.any():
+            n_flight_days[has_days] = np.add.reduceat(days['flight_days'].astype(np.int64), days['starts'][has_days])
+        blocks.append((effects.reindex(days['participants']), n_flight_days))
+    effects = pd.concat([block[0] for block in blocks])
+    n_flight_days = np.concatenate([block[1] for block in blocks])
+    return pd.DataFrame({'participant': participants, 'n_flight_days': n_flight_days,
+                         'n_flight_sleeps': effects['n_flight'].fillna(0).astype(int).to_numpy(),
+                         'n_non_flight_sleeps': effects['n_non_flight'].fillna(0).astype(int).to_numpy(),
+                         'mean_flight_sleep': effects['mean_flight'].to_numpy(), 'mean_non_flight_sleep': effects['mean_non_flight'].to_numpy(),
+                         't_statistic': effects['t_statistic'].to_numpy(), 'p_value': effects['p_value'].to_numpy(),
+                         'cohens_d': effects['cohens_d'].to_numpy()})
+
+#-------------------------------------------------------------------------------------------------------------------------------------
+
+#Section 9: relate the hours flown each day to sleep on the same and following days
+
+#Participants are processed this many at a time, so the padded arrays of a cohort never need to fit in memory at once
+LAG_BATCH_SIZE = 256
+
+def lag_sums(sleep_hours, dose, flight_days, max_lag):
+    '''Calculates, for every lag from 0 to max_lag days at once, the sums needed to relate the dose on one day to the sleep that many
+    days later. Each sum over day pairs is a cross-correlation of two daily series, and all of them are computed together with one
+    batch of FFTs, so the cost is O(days log days) for all lags instead of one pass over the days per lag.
+
+    Arguments:
+    sleep_hours = the hours slept each day, a 2D numpy array with one row per participant, NaN on days without sleep
+    dose = the flight hours each day, a 2D numpy array of the same shape
+    flight_days = the flight days, a boolean 2D numpy array of the same shape
+    max_lag = the largest lag in days, integer
+
+    Returns:
+    sums = a dictionary of numpy arrays with one entry per lag, summed over the participants: n (pairs with sleep), x, xx, y, yy, xy for
+    dose x and sleep y, and n_after, y_after, yy_after for the sleep on days that many days after a flight'''
+    from scipy import fft
+    n_days = sleep_hours.shape[1]
+    has_sleep = ~np.isnan(sleep_hours)
+    sleep = np.where(has_sleep, sleep_hours, 0.0)
+    #Pad so that the circular cross-correlation does not wrap around for lags up to max_lag
+    fft_len = fft.next_fast_len(n_days + max_lag + 1, real=True)
+    #Series on the sleep day side and on the flight day side of each pair
+    sleep_side = fft.rfft(np.stack([has_sleep.astype(float), sleep, sleep ** 2]), fft_len, axis=-1)
+    dose = np.asarray(dose, dtype=float)
+    flight_side = fft.rfft(np.stack([np.ones_like(dose), dose, dose ** 2, np.asarray(flight_days, dtype=float)]), fft_len, axis=-1)
+    #cross[i, j, :, k] is the sum over days t of sleep_side[i][t] * flight_side[j][t - k]
+    cross = fft.irfft(sleep_side[:, None] * np.conj(flight_side[None]), fft_len, axis=-1)[..., :max_lag + 1].sum(axis=2)
+    count, total, squares = 0, 1, 2
+    ones, hours, hours_squared, flights = 0, 1, 2, 3
+    return {'n': np.rint(cross[count, ones]), 'x': cross[count, hours], 'xx': cross[count, hours_squared],
+            'y': cross[total, ones], 'yy': cross[squares, ones], 'xy': cross[total, hours],
+            'n_after': np.rint(cross[count, flights]), 'y_after': cross[total, flights], 'yy_after': cross[squares, flights]}
+
+def dose_response(cohort_series, max_lag=7, confidence=0.95):
+    '''Relates the hours flown on a day to the hours slept 0 to max_lag days later, pooling every participant's days. For each lag it
+    fits a least squares line of sleep on flight hours, and gives the recovery curve: the mean sleep on days that many days after a
+    flight compared to the mean of all sleep. Participants are batched by length and all lags are computed at once with lag_sums.
+
+    Arguments:
+    cohort_series = a list of daily series from daily_series or store_series. Series from a store have no flight hours, so each flight
+    day counts as one hour for them.
+    Max_lag = the largest lag in days, integer
+    Confidence = the confidence level of the confidence bands, a number between 0 and 1
+
+    Returns:
+    results = a dataframe with one row per lag with columns lag, n_days, slope (change in sleep hours per flight hour), slope_ci_low,
+    slope_ci_high, p_value, correlation, n_after_flight, mean_sleep_after_flight, recovery (mean sleep after flight minus mean sleep),
+    recovery_ci_low, and recovery_ci_high'''
+    from scipy import stats
+    sums = {key: np.zeros(max_lag + 1) for key in ['n', 'x', 'xx', 'y', 'yy', 'xy', 'n_after', 'y_after', 'yy_after']}
+    #Batch participants of similar length together to keep the padding small
+    cohort_series = sorted(cohort_series, key=lambda series: len(series['sleep_hours']))
+    for start in range(0, len(cohort_series), LAG_BATCH_SIZE):
+        batch = cohort_series[start:start + LAG_BATCH_SIZE]
+        n_days = max(len(series['sleep_hours']) for series in batch)
+        sleep_hours = np.full((len(batch), n_days), np.nan)
+        dose = np.zeros((len(batch), n_days))
+        flight_days = np.zeros((len(batch), n_days), dtype=bool)
+        for row, series in enumerate(batch):
+            days = len(series['sleep_hours'])
+            sleep_hours[row, :days] = series['sleep_hours']
+            flight_days[row, :days] = series['flight_days']
+            dose[row, :days] = series['flight_hours'] if 'flight_hours' in series else series['flight_days']
+        if n_days == 0:
+            continue
+        for key, value in lag_sums(sleep_hours, dose, flight_days, max_lag).items():
+            sums[key] += value
+    n = sums['n']
+    with np.errstate(divide='ignore', invalid='ignore'):
+        #Least squares line of sleep on flight hours at each lag
+        sxx = sums['xx'] - sums['x'] ** 2 / n
+        syy = sums['yy'] - sums['y'] ** 2 / n
+        sxy = sums['xy'] - sums['x'] * sums['y'] / n
+        slope = sxy / sxx
+        slope_se = np.sqrt(np.maximum(syy - slope * sxy, 0) / (n - 2) / sxx)
+        t_quantile = stats.t.ppf((1 + confidence) / 2, n - 2)
+        p_value = 2 * stats.t.sf(np.abs(slope / slope_se), n - 2)
+        correlation = sxy / np.sqrt(sxx * syy)
+        #Recovery curve: sleep k days after a flight compared to the mean of all sleep, with the standard error of the mean after flight
+        n_after = sums['n_after']
+        mean_after = sums['y_after'] / n_after
+        sd_after = np.sqrt(np.maximum(sums['yy_after'] - n_after * mean_after ** 2, 0) / (n_after - 1))
+        recovery = mean_after - sums['y'][0] / n[0]
+        recovery_half_width = stats.t.ppf((1 + confidence) / 2, n_after - 1) * sd_after / np.sqrt(n_after)
+    return pd.DataFrame({'lag': np.arange(max_lag + 1), 'n_days': n.astype(int), 'slope': slope,
+                         'slope_ci_low': slope - t_quantile * slope_se, 'slope_ci_high': slope + t_quantile * slope_se,
+                         'p_value': p_value, 'correlation': correlation, 'n_after_flight': n_after.astype(int),
+                         'mean_sleep_after_flight': mean_after, 'recovery': recovery,
+                         'recovery_ci_low': recovery - recovery_half_width, 'recovery_ci_high': recovery + recovery_half_width})
+
+#-------------------------------------------------------------------------------------------------------------------------------------
+
+#Section 10: run the analysis as a graph of memoized stages
+
+#Parameters of a pipeline run and their defaults. Each stage only depends on the parameters it lists in PIPELINE_STAGES.
+PIPELINE_DEFAULTS = {'sleep_data_csv': None, 'activity_data_csv': None, 'date_string': 10, 'decimals': 2, 'local_time': False,
+                     'lower_speed_threshold': 100, 'upper_speed_threshold': 700, 'lower_duration_threshold': 0.5, 'rules': None,
+                     'days_affected_by_flight': 3, 'sleep_bins': None, 'flight_bins': None, 'plot_file': None, 'sleep_metrics': False}
+
+#The stages of the analysis in the order they run. Each stage lists the stages whose outputs it takes, the parameters it uses (file
+#parameters are keyed by the file contents rather than the path), and whether its output is saved on disk. The parsed input files are
+#already kept in the column cache, so the read stages are only memoized in memory. With sleep_metrics, the sleep file is read once with
+#the metric columns as well, and both sleep_sum_data and sleep_metric_data are made from that one read. The plot is drawn again on
+#every run, since a saved image file may have been overwritten by another run since.
+PIPELINE_STAGES = {
+    'sleep_data': {'inputs': [], 'params': ['sleep_metrics'], 'files': ['sleep_data_csv'], 'disk': False,
+                   'run': lambda inputs, params, cache_dir: read_data(params['sleep_data_csv'], None, cache_dir, params['sleep_metrics'])[0]},
+    'activity_data': {'inputs': [], 'params': [], 'files': ['activity_data_csv'], 'disk': False,
+                      'run': lambda inputs, params, cache_dir: read_data(None, params['activity_data_csv'], cache_dir)[1]},
+    'sleep_sum_data': {'inputs': ['sleep_data'], 'params': ['date_string', 'decimals', 'local_time'], 'files': [], 'disk': True,
+                       'run': lambda inputs, params, cache_dir: sleep_processing(inputs[0], params['date_string'], params['decimals'],
+                                                                                 params['local_time'])},
+    'flights': {'inputs': ['activity_data'], 'files': [], 'disk': True,
+                'params': ['date_string', 'decimals', 'lower_speed_threshold', 'upper_speed_threshold', 'lower_duration_threshold', 'rules'],
+                'run': lambda inputs, params, cache_dir: activity_processing(inputs[0], params['date_string'], params['decimals'],
+                                                                             params['lower_speed_threshold'], params['upper_speed_threshold'],
+                                                                             params['lower_duration_threshold'], params['rules'])},
+    'flight_effect': {'inputs': ['flights', 'sleep_sum_data'], 'params': ['decimals', 'days_affected_by_flight'], 'files': [], 'disk': True,
+                      'run': lambda inputs, params, cache_dir: flight_effect_sleep(inputs[0], inputs[1], params['decimals'],
+                                                                                   params['days_affected_by_flight'])},
+    'sleep_metric_data': {'inputs': ['sleep_data'], 'params': ['decimals', 'local_time'], 'files': [], 'disk': True,
+                          'run': lambda inputs, params, cache_dir: sleep_metrics(inputs[0], params['decimals'], params['local_time'])},
+    'sleep_metric_effects': {'inputs': ['flights', 'sleep_metric_data'], 'params': ['days_affected_by_flight'], 'files': [], 'disk': True,
+                             'run': lambda inputs, params, cache_dir: sleep_metric_effects(inputs[0], inputs[1],
+                                                                                           params['days_affected_by_flight'])},
+    'plot': {'inputs': ['sleep_sum_data', 'flights', 'flight_effect'], 'params': ['sleep_bins', 'flight_bins', 'plot_file'], 'files': [],
+             'disk': False,
+             'run': lambda inputs, params, cache_dir: plot_data(inputs[0], inputs[1], *inputs[2], params['sleep_bins'], params['flight_bins'],
+                                                                params['plot_file'])},
+}
+
+#Outputs of the stages run in this process, keyed by stage key, most recently used last
+PIPELINE_MEMO = {}
+PIPELINE_MEMO_SIZE = 32
+
+def param_token(value):
+    '''Converts a parameter value to something json can write, so that equal values always give the same stage key.
+
+    Arguments:
+    value = the parameter value, such as a number, string, None, list, numpy array, or rule set dictionary
+
+    Returns:
+    token = the value with numpy arrays and numbers converted to lists and python numbers'''
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+def data_hash(data):
+    '''Calculates a hash of a dataframe's contents, used as the key of stage outputs that were given rather than computed.
+
+    Arguments:
+    data = a pandas dataframe
+
+    Returns:
+    digest = the hex digest of the dataframe contents, a string'''
+    hasher = hashlib.sha256(json.dumps(list(map(str, data.columns))).encode())
+    hasher.update(pd.util.hash_pandas_object(data, index=True).to_numpy().tobytes())
+    return hasher.hexdigest()
+
+def stage_key(name, input_keys, params, file_hashes):
+    '''Builds the key of a stage's output from the keys of the outputs it takes and the parameters it uses, so that the key changes
+    exactly when the stage would give a different output.
+
+    Arguments:
+    name = the stage name, a key of PIPELINE_STAGES
+    input_keys = the keys of the stage's inputs, a list of strings
+    params = the parameters of the run, a dictionary
+    file_hashes = dictionary of input file path to its content hash
+
+    Returns:
+    key = the stage key, a string'''
+    stage = PIPELINE_STAGES[name]
+    spec = {'version': CACHE_VERSION, 'stage': name, 'inputs': input_keys,
+            'params': {param: param_token(params[param]) for param in stage['params']},
+            'files': {param: file_hashes.get(params[param]) for param in stage['files']}}
+    return hashlib.sha256(json.dumps(spec, sort_keys=True, default=repr).encode()).hexdigest()
+
+def read_stage_entry(cache_dir, key):
+    '''Loads a stage output saved by write_stage_entry.
+
+    Arguments:
+    cache_dir = the cache folder, a string, or None
+    key = the stage key, a string
+
+    Returns:
+    entry = (output, printed text) of the stage, or None if it is not on disk'''
+    if cache_dir is None:
+        return None
+    entry_dir = os.path.join(cache_dir, 'stage-' + key)
+    try:
+        with open(os.path.join(entry_dir, 'output.pkl'), 'rb') as file:
+            entry = pickle.load(file)
+        os.utime(entry_dir)
+    except (OSError, pickle.UnpicklingError, EOFError):
+        return None
+    return entry
+
+def write_stage_entry(cache_dir, key, entry):
+    '''Saves a stage output in its own cache entry folder, next to the cached input files, so that it is evicted and cleared with them.
+    The entry is written to a temporary folder and renamed into place so that a partly written entry is never read.
+
+    Arguments:
+    cache_dir = the cache folder, a string
+    key = the stage key, a string
+    entry = (output, printed text) of the stage'''
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(prefix=CACHE_TMP_PREFIX, dir=cache_dir)
+    with open(os.path.join(tmp_dir, 'output.pkl'), 'wb') as file:
+        pickle.dump(entry, file, protocol=pickle.HIGHEST_PROTOCOL)
+    try:
+        os.rename(tmp_dir, os.path.join(cache_dir, 'stage-' + key))
+    except OSError:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    evict_cache(cache_dir, CACHE_MAX_BYTES)
+
+def stage_needs(targets):
+    '''Finds every stage the target stages depend on, in the order they run.
+
+    Arguments:
+    targets = names of the stages whose outputs are wanted, a list of strings
+
+    Returns:
+    names = the target stages and every stage upstream of them, in PIPELINE_STAGES order'''
+    needed = set()
+    todo = list(targets)
+    while todo:
+        name = todo.pop()
+        if name not in needed:
+            needed.add(name)
+            todo.extend(PIPELINE_STAGES[name]['inputs'])
+    return [name for name in PIPELINE_STAGES if name in needed]
+
+def run_pipeline(params, targets=('flight_effect',), cache_dir=None, given=None, memo=PIPELINE_MEMO, replay=True):
+    '''Runs the stages needed for the target stages, reusing any stage output that was already computed with the same upstream inputs
+    and parameters, from memory or from the cache folder. Only the stages whose inputs or parameters changed are run again, and stages
+    are not run at all if everything downstream of them can be reused. Text a stage
+    printed when it ran is printed again when its output is reused, so the printed results look the same either way. Reused outputs are
+    shared, so they should not be changed.
+
+    Arguments:
+    params = the parameters of the run, a dictionary with any of the keys of PIPELINE_DEFAULTS
+    targets = names of the stages whose outputs are wanted, a list of strings. Add 'plot' to also draw the histograms.
+    cache_dir = the cache folder for parsed input files and stage outputs, a string, or None to only memoize in memory
+    given = dictionary of stage name to an output to use for that stage instead of running it, such as data read with read_data_chunked
+    memo = the in-memory memo, a dictionary
+    replay = if False, text printed by reused stages is not printed again, a boolean
+
+    Returns:
+    outputs = dictionary of stage name to output for the targets and every stage that had to be used to get them
+    report = dictionary of stage name to 'given', 'memory' or 'disk' (reused), or 'run' (computed) for the same stages'''
+    params = dict(PIPELINE_DEFAULTS, **params)
+    given = given or {}
+    order = stage_needs(targets)
+    #Key every stage first. Keys only depend on the input files and parameters, not on any stage output.
+    file_hashes = {params[param]: file_hash(params[param]) for name in order if name not in given
+                   for param in PIPELINE_STAGES[name]['files'] if params[param] is not None}
+    keys = {}
+    for name in order:
+        if name in given:
+            keys[name] = 'given-' + data_hash(given[name])
+        else:
+            keys[name] = stage_key(name, [keys[upstream] for upstream in PIPELINE_STAGES[name]['inputs']], params, file_hashes)
+    #Walk back from the targets. A stage whose output can be reused does not need its inputs, so stages upstream of reused outputs
+    #(such as reading the input files) are skipped entirely.
+    found = {}
+    needed = set(targets)
+    for name in reversed(order):
+        if name not in needed:
+            continue
+        if name in given:
+            found[name] = (given[name], ''), 'given'
+            continue
+        #The plot is always drawn again, as a window has to be shown every time and a saved file may no longer hold this run's plot
+        if name != 'plot':
+            entry = memo.pop(keys[name], None)
+            if entry is not None:
+                found[name] = entry, 'memory'
+                continue
+            entry = read_stage_entry(cache_dir, keys[name]) if PIPELINE_STAGES[name]['disk'] else None
+            if entry is not None:
+                found[name] = entry, 'disk'
+                continue
+        needed.update(PIPELINE_STAGES[name]['inputs'])
+    #Run the stages that could not be reused in order
+    outputs, report = {}, {}
+    for name in order:
+        if name not in needed:
+            continue
+        stage = PIPELINE_STAGES[name]
+        if name in found:
+            entry, report[name] = found[name]
+        else:
+            printed = io.StringIO()
+            with contextlib.redirect_stdout(printed):
+                output = stage['run']([outputs[upstream] for upstream in stage['inputs']], params, cache_dir)
+            entry = (output, printed.getvalue())
+            report[name] = 'run'
+            if stage['disk'] and cache_dir is not None:
+                write_stage_entry(cache_dir, keys[name], entry)
+        if report[name] in ('memory', 'disk'):
+            #Reused stages do not run, so the stage hooks are not called for them. Tell the hooks that listen for it instead.
+            for hook in STAGE_HOOKS:
+                if hasattr(hook, 'reused_stage'):
+                    hook.reused_stage(name, report[name])
+        if report[name] == 'run' or replay:
+            sys.stdout.write(entry[1])
+        if name not in given:
+            memo[keys[name]] = entry
+            while len(memo) > PIPELINE_MEMO_SIZE:
+                memo.pop(next(iter(memo)))
+        outputs[name] = entry[0]
+    return outputs, report
+
+#-------------------------------------------------------------------------------------------------------------------------------------
+
+#Section 11: report results as text, json, or csv
+
+#Columns of the batch results table, in order. The resample columns are only added when resampling.
+BATCH_COLUMNS = ['participant', 'n_flights', 'n_flight_sleeps', 'n_non_flight_sleeps', 'mean_flight_sleep', 'mean_non_flight_sleep',
+                 't_statistic', 'p_value', 'cohens_d', 'error']
+RESAMPLE_COLUMNS = ['permutation_p', 'mean_diff_ci_low', 'mean_diff_ci_high', 'cohens_d_ci_low', 'cohens_d_ci_high']
+
+def summary_text(stats, decimals, unit='hours'):
+    '''Formats summary statistics the way basic_stats prints them.
+
+    Arguments:
+    stats = a SummaryStats result from summary_stats
+    Decimals = the number of decimals to round to, integer
+    unit = the unit of the data, a string
+
+    Returns:
+    text = one line per statistic, a string'''
+    names = [('mean', 'mean'), ('median', 'median'), ('standard deviation', 'std'), ('minimum', 'min'), ('maximum', 'max')]
+    return '\n'.join('{} {} = {} {}'.format(name, stats.label, round(float(getattr(stats, field)), decimals), unit) for name, field in names)
+
+def effect_text(effect, decimals):
+    '''Formats a flight effect for reading.
+
+    Arguments:
+    effect = an EffectResult from flight_effect
+    Decimals = the number of decimals to round to, integer
+
+    Returns:
+    text = the group sizes and means, t test, and cohen's d with how large the effect is, a string'''
+    return '\n'.join(['flight sleeps: {} days, mean = {} hours'.format(effect.n_flight_sleeps, round(float(effect.mean_flight_sleep), decimals)),
+                      'non-flight sleeps: {} days, mean = {} hours'.format(effect.n_non_flight_sleeps,
+                                                                           round(float(effect.mean_non_flight_sleep), decimals)),
+                      't statistic = {} , p value = {}'.format(round(float(effect.t_statistic), decimals),
+                                                               round(float(effect.p_value), decimals + 2)),
+                      'Cohen\'s d = {}'.format(round(float(effect.cohens_d), decimals)),
+                      effect_magnitude(round(float(effect.cohens_d), decimals))])
+
+def result_row(result):
+    '''Flattens a participant's result into one row of the batch results table.
+
+    Arguments:
+    result = a ParticipantResult from analyze_participant
+
+    Returns:
+    row = a dictionary with the BATCH_COLUMNS (and the RESAMPLE_COLUMNS if the participant was resampled), NaN where the analysis failed'''
+    row = dict.fromkeys(BATCH_COLUMNS, np.nan)
+    row.update({'participant': result.participant, 'error': result.error})
+    if result.effect is not None:
+        row['n_flights'] = result.n_flights
+        row.update({name: value for name, value in result.effect.as_dict().items() if name in row})
+    if result.resampled is not None:
+        row.update({'permutation_p': result.resampled['permutation_p'],
+                    'mean_diff_ci_low': result.resampled['mean_diff_ci'][0], 'mean_diff_ci_high': result.resampled['mean_diff_ci'][1],
+                    'cohens_d_ci_low': result.resampled['cohens_d_ci'][0], 'cohens_d_ci_high': result.resampled['cohens_d_ci'][1]})
+    return row
+
+def json_value(value):
+    '''Converts a value of a results row to a json value: numpy numbers to python numbers and NaN to null.
+
+    Arguments:
+    value = a value from a results row
+
+    Returns:
+    value = the value json can write'''
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and np.isnan(value):
+        return None
+    return value
+
+#Columns of the results table that hold text. Every other column is written to columnar files as float64, NaN where missing.
+RESULT_TEXT_COLUMNS = {'participant', 'error'}
+#Rows written to a parquet file at a time, each batch of rows is one row group
+RESULT_ROW_GROUP = 256
+
+class ResultWriter:
+    '''Writes rows of results to a file as they are made, so a long batch does not need to keep or format everything until the end.
+    Files ending in .jsonl get one json object per line and files ending in .parquet are columnar parquet files, written a row group
+    at a time, which needs the optional pyarrow package. Files ending in .npz are columnar numpy files with one array per column,
+    which only numpy is needed for, but they are written once at the end of the batch. Other files are written as csv with the given
+    columns.
+
+    Use as:
+    with ResultWriter(path, columns) as writer:
+        writer.write(row)'''
+
+    def __init__(self, path, columns):
+        self.path = path
+        self.columns = columns
+        self.file = None
+        self.writer = None
+        self.parquet = None
+        self.pending = []
+
+    def __enter__(self):
+        if self.path.endswith('.parquet'):
+            try:
+                import pyarrow
+                import pyarrow.parquet
+            except ImportError:
+                raise ImportError('writing .parquet files needs the pyarrow package, install it with pip install pyarrow, or write a '
+                                  '.npz file instead')
+            self.schema = pyarrow.schema([(column, pyarrow.string() if column in RESULT_TEXT_COLUMNS else pyarrow.float64())
+                                          for column in self.columns])
+            self.parquet = pyarrow.parquet.ParquetWriter(self.path, self.schema)
+            return self
+        if self.path.endswith('.npz'):
+            return self
+        self.file = open(self.path, 'w', newline='')
+        if not self.path.endswith('.jsonl'):
+            self.writer = csv.DictWriter(self.file, fieldnames=self.columns, extrasaction='ignore')
+            self.writer.writeheader()
+        return self
+
+    def write(self, row):
+        '''Writes one row, a dictionary with the writer's columns, and flushes it to the file. Rows of columnar files are kept until
+        a row group is full, or until the end for .npz files.'''
+        if self.file is None:
+            self.pending.append(row)
+            if self.parquet is not None and len(self.pending) >= RESULT_ROW_GROUP:
+                self.write_columns()
+            return
+        if self.writer is None:
+            self.file.write(json.dumps({column: json_value(row.get(column)) for column in self.columns}) + '\n')
+        else:
+            self.writer.writerow({column: '' if json_value(row.get(column)) is None else row.get(column) for column in self.columns})
+        self.file.flush()
+
+    def column_arrays(self):
+        '''Turns the kept rows into one numpy array per column: text columns as strings, the others as float64 with NaN for missing.'''
+        arrays = {}
+        for column in self.columns:
+            values = [row.get(column) for row in self.pending]
+            if column in RESULT_TEXT_COLUMNS:
+                arrays[column] = np.array(['' if value is None else str(value) for value in values], dtype=str)
+            else:
+                arrays[column] = np.array([np.nan if value is None else value for value in values], dtype=np.float64)
+        return arrays
+
+    def write_columns(self):
+        '''Writes the kept rows of a parquet file as one row group.'''
+        import pyarrow
+        arrays = self.column_arrays()
+        self.parquet.write_table(pyarrow.Table.from_arrays([pyarrow.array(arrays[column]) for column in self.columns], schema=self.schema))
+        self.pending = []
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.parquet is not None:
+            if self.pending:
+                self.write_columns()
+            self.parquet.close()
+        elif self.file is None:
+            #Written to a temporary name first, so a write that is cut off does not leave a broken file
+            tmp_path = self.path[:-len('.npz')] + '.tmp.npz'
+            np.savez(tmp_path, **self.column_arrays())
+            os.replace(tmp_path, self.path)
+        else:
+            self.file.close()
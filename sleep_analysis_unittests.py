@@ -15,11 +15,20 @@
 #Import necessary libraries and functions for the program
 
 from sleep_analysis_cli import DATE_STRING, DECIMALS
-from sleep_analysis_lib import basic_stats, cohend, sleep_processing, activity_processing, flight_effect_sleep
+from sleep_analysis_bench import write_synthetic_cohort, run_benchmarks, STAGES
+from sleep_analysis_lib import timestamp_days, day_strings, StageProfiler, STAGE_HOOKS, pipeline_stage, plot_data, read_data, read_data_chunked, cache_size, evict_cache, CACHE_TMP_PREFIX, basic_stats, cohend, summary_stats, summary_text, flight_effect, effect_magnitude, EffectResult, sleep_metrics, sleep_metric_effects, grouped_stats, grouped_effects, sleep_processing, flight_rules, activity_processing, flight_effect_sleep, resample_effect, find_participants, IngestStats, run_batch, render_batch, histogram_counts, daily_series, write_daily_store, open_daily_store, store_series, after_flight_days, in_flight_window, cohort_flight_effect, dose_response, run_pipeline, sweep_parameters, new_running_state, update_running_state, running_effect, save_running_state, load_running_state
 import unittest
 import pandas as pd
 import os
 import sys
+import shutil
+import subprocess
+import tempfile
+import numpy as np
+import json
+import gzip
+import io
+import contextlib
 
 #-------------------------------------------------------------------------------------------------------------------------------------
 
@@ -89,6 +98,100 @@ class TestSleepAnalysis(unittest.TestCase):
         expected_effs = [0.01, 'Effect size is trivial']
         self.assertEqual(actual_effs, expected_effs)
 
+    def test_effect_magnitude(self):
+        '''This test makes sure negative effects get the same magnitude label as positive effects of the same size. The original
+        labels compared a negative d to the small and medium cut offs without its absolute value, so every negative d of at least 0.2
+        in size was called small.'''
+        for eff_size, eff_string in [(0.1, 'Effect size is trivial'), (0.3, 'Effect size is small'), (0.6, 'Effect size is medium'),
+                                     (0.97, 'Effect size is large')]:
+            self.assertEqual(effect_magnitude(eff_size), eff_string)
+            self.assertEqual(effect_magnitude(-eff_size), eff_string)
+        with HiddenPrints():
+            self.assertEqual(cohend(np.array(self.cohen_test_2) - 10, self.cohen_test_1, DECIMALS)[1], 'Effect size is large')
+        self.assertEqual(effect_magnitude(np.nan), 'Effect size could not be calculated')
+
+    def test_quiet_results(self):
+        '''This test makes sure the quiet functions print nothing, return the same numbers as the printing ones at full precision, and
+        that the text report matches what basic_stats prints'''
+        printed = io.StringIO()
+        with contextlib.redirect_stdout(printed):
+            sleep_sum_data = sleep_processing(self.sleep_data_in, DATE_STRING, DECIMALS, verbose = False)
+            flights = activity_processing(self.activity_data_in, DATE_STRING, DECIMALS, verbose = False)
+            flight_sleeps, non_flight_sleeps = flight_effect_sleep(flights, sleep_sum_data, DECIMALS, verbose = False)
+            stats = summary_stats(self.stats_test_data, 'test')
+            effect = flight_effect(flight_sleeps, non_flight_sleeps)
+        self.assertEqual(printed.getvalue(), '')
+        self.assertEqual([stats.n, stats.mean, stats.median, stats.min, stats.max], [13, 5, 4, 1, 10])
+        self.assertAlmostEqual(stats.std, self.stats_test_data[0].std())
+        printed = io.StringIO()
+        with contextlib.redirect_stdout(printed):
+            basic_stats(self.stats_test_data[0].astype(float), 'test', DECIMALS)
+        self.assertEqual(printed.getvalue(), summary_text(stats, DECIMALS) + '\n')
+        self.assertEqual([effect.n_flight_sleeps, effect.n_non_flight_sleeps], [5, 3])
+        self.assertAlmostEqual(effect.mean_flight_sleep, 5.658)
+        self.assertEqual(round(effect.cohens_d, DECIMALS), -0.43)
+        self.assertEqual(effect.magnitude, 'Effect size is small')
+        self.assertEqual(EffectResult(**effect.as_dict()), effect)
+        with self.assertRaises(AttributeError):
+            effect.extra = 1
+
+    def test_sleep_metrics(self):
+        '''This test makes sure the daily metrics are summed, weighted by sleep duration, and turned into rates per hour correctly, and
+        that the flight effect of every metric is tested at once with the same result for sleep hours as flight_effect_sleep'''
+        sleep_data = self.sleep_data_in.copy()
+        n_sleeps = len(sleep_data)
+        sleep_data['deep_minutes'] = np.arange(n_sleeps, dtype = float)
+        sleep_data['interruptions'] = np.where(np.arange(n_sleeps) % 2 == 0, 1.0, np.nan)
+        sleep_data['heart_rate_avg'] = 50.0 + np.arange(n_sleeps)
+        sleep_data.loc[0, 'heart_rate_avg'] = np.nan
+        metric_data = sleep_metrics(sleep_data, DECIMALS)
+        with HiddenPrints():
+            sleep_sum_data = sleep_processing(self.sleep_data_in, DATE_STRING, DECIMALS)
+            flights = activity_processing(self.activity_data_in, DATE_STRING, DECIMALS)
+            flight_sleeps, non_flight_sleeps = flight_effect_sleep(flights, sleep_sum_data, DECIMALS)
+        pd.testing.assert_frame_equal(metric_data.loc[:, sleep_sum_data.columns], sleep_sum_data, check_dtype = False)
+        self.assertNotIn('rem_minutes', metric_data.columns)
+        #The first day has the first two sleeps: only the first has interruptions and only the second has a heart rate
+        first = sleep_data.iloc[:2]
+        self.assertEqual(metric_data['deep_minutes'].iloc[0], 1.0)
+        self.assertAlmostEqual(metric_data['heart_rate_avg'].iloc[0], 51.0)
+        self.assertAlmostEqual(metric_data['interruptions_per_hour'].iloc[0], 1 / (first['actual_minutes'].sum() / 60))
+        days = timestamp_days(sleep_data['start_time_iso'])
+        weights = sleep_data['actual_minutes'] * sleep_data['heart_rate_avg'].notna()
+        expected = (sleep_data['heart_rate_avg'].fillna(0) * weights).groupby(days).sum() / weights.groupby(days).sum()
+        np.testing.assert_allclose(metric_data['heart_rate_avg'], expected.to_numpy())
+        effects = sleep_metric_effects(flights, metric_data)
+        self.assertEqual(effects.index.tolist(), ['actual_hours', 'deep_minutes', 'interruptions', 'interruptions_per_hour', 'heart_rate_avg'])
+        effect = flight_effect(flight_sleeps['sleep_duration'], non_flight_sleeps['sleep_duration'])
+        self.assertAlmostEqual(effects.loc['actual_hours', 't_statistic'], effect.t_statistic)
+        self.assertAlmostEqual(effects.loc['actual_hours', 'cohens_d'], effect.cohens_d)
+        self.assertEqual(effects.loc['actual_hours', 'n_flight'], 5)
+        self.assertEqual(effects.loc['interruptions', 'n_flight'] + effects.loc['interruptions', 'n_non_flight'],
+                         metric_data['interruptions'].notna().sum())
+
+    def test_grouped_effects(self):
+        '''This test makes sure the grouped statistics of every participant match pandas and scipy computed one participant at a time'''
+        from scipy import stats
+        rng = np.random.default_rng(0)
+        table = pd.DataFrame({'participant': rng.integers(0, 4, 200), 'group': rng.choice(['flight', 'non_flight'], 200),
+                              'value': rng.normal(7, 1, 200)})
+        table.loc[(table['participant'] == 3) & (table['group'] == 'flight'), 'value'] = np.nan
+        expected = table.groupby(['participant', 'group'])['value'].agg(['count', 'mean', 'median', 'std', 'min', 'max']).query('count > 0')
+        np.testing.assert_allclose(grouped_stats(table).to_numpy(), expected.to_numpy())
+        effects = grouped_effects(table, 'flight', 'non_flight')
+        for participant in range(3):
+            flight = table['value'][(table['participant'] == participant) & (table['group'] == 'flight')]
+            non_flight = table['value'][(table['participant'] == participant) & (table['group'] == 'non_flight')]
+            student = stats.ttest_ind(flight, non_flight)
+            welch = stats.ttest_ind(flight, non_flight, equal_var = False)
+            self.assertAlmostEqual(effects.loc[participant, 't_statistic'], student.statistic)
+            self.assertAlmostEqual(effects.loc[participant, 'p_value'], student.pvalue)
+            self.assertAlmostEqual(effects.loc[participant, 'welch_p'], welch.pvalue)
+            with HiddenPrints():
+                self.assertEqual(round(effects.loc[participant, 'cohens_d'], DECIMALS), cohend(flight, non_flight, DECIMALS)[0])
+        self.assertEqual(effects.loc[3, 'n_flight'], 0)
+        self.assertTrue(np.isnan(effects.loc[3, 'cohens_d']))
+
     def test_sleep_processing(self):
         '''This test makes sure that dates are parsed correctly, grouped correctly, and that the sume of hours slept per day is calculated
         from minutes correctly'''
@@ -101,6 +204,58 @@ class TestSleepAnalysis(unittest.TestCase):
         self.assertEqual(actual_sleep_days, expected_sleep_days)
         self.assertEqual(actual_sleep_duration, expected_sleep_duration)
 
+    def test_sleep_processing_missing_time(self):
+        '''This test makes sure sleeps and activities without a start time are left out, and sleeps without minutes are skipped in the
+        daily sums, instead of stopping the analysis, when read directly, from the cache, and in chunks'''
+        with tempfile.TemporaryDirectory() as work_dir:
+            sleep_csv = os.path.join(work_dir, 'sleep.csv')
+            with open(sleep_csv, 'w') as file:
+                file.write('start_time_iso,actual_minutes\n2015-06-01T12:20:00Z,60\n,30\n2015-06-02T01:44:00Z,120\n2015-06-02T03:00:00Z,\n')
+            activity_csv = os.path.join(work_dir, 'activities.csv')
+            with open(activity_csv, 'w') as file:
+                file.write('Start,Duration,Distance,Activity\n2015-06-01T10:00:00Z,7200,1000,airplane\n,7200,1000,airplane\n')
+            cache_dir = os.path.join(work_dir, 'cache')
+            sleep_data, _ = read_data(sleep_csv, activity_csv, cache_dir)
+            cached_sleep_data, cached_activity_data = read_data(sleep_csv, activity_csv, cache_dir)
+            chunked_sleep_data, _ = read_data_chunked(sleep_csv, activity_csv, DATE_STRING, chunksize = 2)
+        self.assertTrue(cached_sleep_data['start_time_iso'].isna().iloc[1])
+        with HiddenPrints():
+            sleep_sum_data = sleep_processing(cached_sleep_data, DATE_STRING, DECIMALS)
+            pd.testing.assert_frame_equal(sleep_processing(sleep_data, DATE_STRING, DECIMALS), sleep_sum_data)
+            chunked_sleep_sum_data = sleep_processing(chunked_sleep_data, DATE_STRING, DECIMALS)
+            flights = activity_processing(cached_activity_data, DATE_STRING, DECIMALS)
+        self.assertEqual(sleep_sum_data['day'].tolist(), ['2015-06-01', '2015-06-02'])
+        self.assertEqual(sleep_sum_data['actual_hours'].tolist(), [1, 2])
+        pd.testing.assert_frame_equal(chunked_sleep_sum_data, sleep_sum_data, check_dtype = False)
+        self.assertEqual(flights['day'].tolist(), ['2015-06-01'])
+
+    def test_timestamp_days(self):
+        '''This test makes sure times with different time zone designators are put on the right day, either the date written in the
+        string or the local date at a given offset'''
+        times = ['2015-06-01T12:20:00Z', '2014-03-21T23:26:22-07:00', '2015-06-02T01:44:00Z', '2015-06-02T01:44:00.000+01:00']
+        self.assertEqual(day_strings(timestamp_days(times)).tolist(), ['2015-06-01', '2014-03-21', '2015-06-02', '2015-06-02'])
+        self.assertEqual(day_strings(timestamp_days(times, [0, 0, -240, 0])).tolist(), ['2015-06-01', '2014-03-22', '2015-06-01', '2015-06-02'])
+
+    def test_sleep_processing_local_time(self):
+        '''This test makes sure sleeps are grouped by local day when asked, also when the file is read in chunks'''
+        sleep_data = pd.DataFrame({'start_time_iso': ['2015-06-01T12:20:00Z', '2015-06-02T01:44:00Z', '2015-06-02T12:00:00Z'],
+                                   'actual_minutes': [60, 120, 180], 'start_time_offset': [-240, -240, -240]})
+        with HiddenPrints():
+            gmt_sleep_sum_data = sleep_processing(sleep_data, DATE_STRING, DECIMALS)
+            local_sleep_sum_data = sleep_processing(sleep_data, DATE_STRING, DECIMALS, local_time = True)
+        self.assertEqual(gmt_sleep_sum_data['day'].tolist(), ['2015-06-01', '2015-06-02'])
+        self.assertEqual(gmt_sleep_sum_data['actual_hours'].tolist(), [1, 5])
+        self.assertEqual(local_sleep_sum_data['day'].tolist(), ['2015-06-01', '2015-06-02'])
+        self.assertEqual(local_sleep_sum_data['actual_hours'].tolist(), [3, 3])
+        with tempfile.TemporaryDirectory() as work_dir:
+            sleep_csv = os.path.join(work_dir, 'sleep.csv')
+            sleep_data.to_csv(sleep_csv, index = False)
+            activity_csv = os.path.join('testdata', 'activity_test_data_in.csv')
+            chunked_sleep_data, _ = read_data_chunked(sleep_csv, activity_csv, DATE_STRING, chunksize = 2, local_time = True)
+        with HiddenPrints():
+            chunked_sleep_sum_data = sleep_processing(chunked_sleep_data, DATE_STRING, DECIMALS, local_time = True)
+        pd.testing.assert_frame_equal(chunked_sleep_sum_data, local_sleep_sum_data, check_dtype = False)
+
     def test_activity_processing(self):
         '''This test makes sure that dates are parsed correctly, and activities are filtered correctly'''
         with HiddenPrints():
@@ -112,6 +267,63 @@ class TestSleepAnalysis(unittest.TestCase):
         self.assertEqual(actual_flight_days, expected_flight_days)
         self.assertAlmostEqual(actual_flight_duration, expected_flight_duration)
 
+    def test_flight_rules(self):
+        '''This test makes sure that custom flight rules and per-device rules are applied, and that the activity data is not changed'''
+        activity_data = pd.DataFrame({'Start': ['2015-06-01T10:00:00Z', '2015-06-02T10:00:00Z', '2015-06-03T10:00:00Z', '2015-06-04T10:00:00Z'],
+                                      'Duration': [7200.0, 7200.0, 7200.0, 7200.0], 'Distance': [600.0, 200.0, 600.0, 1.0],
+                                      'Activity': ['airplane', 'train', 'transport', 'walking'], 'Device': ['a', 'a', 'b', 'b']})
+        original = activity_data.copy()
+        rules = flight_rules()
+        with HiddenPrints():
+            default_flights = activity_processing(activity_data, DATE_STRING, DECIMALS, rules=rules)
+            rules['rules'].append({'labels': ['train'], 'min_speed': 50, 'min_duration': 1})
+            train_flights = activity_processing(activity_data, DATE_STRING, DECIMALS, rules=rules)
+            rules['devices'] = {'b': [{'labels': ['transport'], 'min_speed': 400}]}
+            device_flights = activity_processing(activity_data, DATE_STRING, DECIMALS, rules=rules)
+        self.assertEqual(default_flights['day'].tolist(), ['2015-06-01', '2015-06-03'])
+        self.assertEqual(train_flights['day'].tolist(), ['2015-06-01', '2015-06-02', '2015-06-03'])
+        self.assertEqual(train_flights['Duration'].tolist(), [2, 2, 2])
+        self.assertEqual(device_flights['day'].tolist(), ['2015-06-01', '2015-06-02'])
+        pd.testing.assert_frame_equal(activity_data, original)
+        with self.assertRaises(ValueError):
+            activity_processing(activity_data, DATE_STRING, DECIMALS, rules={'rules': [{'labels': ['train'], 'speed': 50}]})
+
+    def test_flight_rules_missing_labels(self):
+        '''This test makes sure activities without a label or device are not matched by rules whose labels or devices are not in the data'''
+        activity_data = pd.DataFrame({'Start': ['2015-06-01T10:00:00Z', '2015-06-02T10:00:00Z'], 'Duration': [7200.0, 7200.0],
+                                      'Distance': [1200.0, 300.0], 'Activity': ['airplane', np.nan], 'Device': ['a', np.nan]})
+        rules = flight_rules()
+        rules['devices'] = {'c': [{'labels': ['car']}]}
+        with HiddenPrints():
+            flights = activity_processing(activity_data, DATE_STRING, DECIMALS, rules=rules)
+        self.assertEqual(flights['day'].tolist(), ['2015-06-01'])
+
+    def test_flight_rules_batch_sweep_state(self):
+        '''This test makes sure custom flight rules are used by the batch, the parameter sweep, and the running state, with the same
+        results as the single participant analysis'''
+        rules = flight_rules()
+        rules['rules'].append({'labels': ['cycling']})
+        sleep_file, activity_file = os.path.join('testdata', 'sleep_test_data_in.csv'), os.path.join('testdata', 'activity_test_data_in.csv')
+        sleep_data, activity_data = read_data(sleep_file, activity_file)
+        with HiddenPrints():
+            flights = activity_processing(activity_data, DATE_STRING, DECIMALS, rules = rules)
+            flight_sleeps, non_flight_sleeps = flight_effect_sleep(flights, sleep_processing(sleep_data, DATE_STRING, DECIMALS), DECIMALS)
+        self.assertEqual(len(flights), 3)
+        participants = pd.DataFrame({'participant': ['a'], 'sleep_data_csv': [sleep_file], 'activity_data_csv': [activity_file]})
+        batch = run_batch(participants, DATE_STRING, DECIMALS, workers = 2, rules = rules)
+        self.assertEqual(batch['n_flights'].tolist(), [3])
+        self.assertEqual(batch['n_flight_sleeps'].tolist(), [len(flight_sleeps)])
+        sweep = sweep_parameters(sleep_data, activity_data, DATE_STRING, DECIMALS, days_affected_grid = [3], rules = rules)
+        self.assertEqual(sweep['n_flights'].tolist(), [3])
+        self.assertEqual(sweep['n_flight_sleeps'].tolist(), [len(flight_sleeps)])
+        self.assertTrue(sweep['lower_speed_threshold'].isna().all())
+        with tempfile.TemporaryDirectory() as state_dir:
+            state_file = os.path.join(state_dir, 'state.json')
+            save_running_state(new_running_state(DATE_STRING, DECIMALS, rules = rules), state_file)
+            state = update_running_state(load_running_state(state_file), sleep_data, activity_data)
+        self.assertEqual(running_effect(state)['n_flight_sleeps'], len(flight_sleeps))
+        self.assertEqual(len(state['flight_days']), 3)
+
     def test_flight_effect_sleep(self):
         ''''This test makes sure dates are categorized correctly'''
         with HiddenPrints():
@@ -126,9 +338,416 @@ class TestSleepAnalysis(unittest.TestCase):
         self.assertEqual(actual_flight_sleeps, expected_flight_sleeps)
         self.assertEqual(actual_non_flight_sleeps, expected_non_flight_sleeps)
 
+    def test_flight_effect_window(self):
+        '''This test makes sure the after-flight window length can be changed'''
+        with HiddenPrints():
+            sleep_sum_data = sleep_processing(self.sleep_data_in, DATE_STRING, DECIMALS)
+            flights = activity_processing(self.activity_data_in, DATE_STRING, DECIMALS)
+            actual_flight_sleeps, actual_non_flight_sleeps = flight_effect_sleep(flights, sleep_sum_data, DECIMALS, days_affected_by_flight = 2)
+        self.assertEqual(actual_flight_sleeps['sleep_duration'].tolist(), [1, 8.47, 4.52])
+        self.assertEqual(actual_non_flight_sleeps['sleep_duration'].tolist(), [5.73, 8.57, 7.3, 6.55, 6.45])
+
+    def test_read_data(self):
+        '''This test makes sure only the columns used by the analysis are read, and that reading in chunks gives the same daily sleep
+        and flights as reading the whole files'''
+        sleep_csv = os.path.join('testdata', 'sleep_test_data_in.csv')
+        activity_csv = os.path.join('testdata', 'activity_test_data_in.csv')
+        sleep_data, activity_data = read_data(sleep_csv, activity_csv)
+        self.assertEqual(list(activity_data.columns), ['Start', 'Duration', 'Distance', 'Activity'])
+        self.assertEqual(str(activity_data['Activity'].dtype), 'category')
+        chunked_sleep_data, chunked_activity_data = read_data_chunked(sleep_csv, activity_csv, DATE_STRING, chunksize = 3)
+        with HiddenPrints():
+            sleep_sum_data = sleep_processing(sleep_data, DATE_STRING, DECIMALS)
+            chunked_sleep_sum_data = sleep_processing(chunked_sleep_data, DATE_STRING, DECIMALS)
+            flights = activity_processing(activity_data, DATE_STRING, DECIMALS)
+            chunked_flights = activity_processing(chunked_activity_data, DATE_STRING, DECIMALS)
+        self.assertEqual(chunked_sleep_sum_data['day'].tolist(), sleep_sum_data['day'].tolist())
+        self.assertEqual(chunked_sleep_sum_data['actual_hours'].tolist(), sleep_sum_data['actual_hours'].tolist())
+        self.assertEqual(chunked_flights['day'].tolist(), flights['day'].tolist())
+        self.assertEqual(chunked_flights['Duration'].tolist(), flights['Duration'].tolist())
+
+    def test_read_data_cache(self):
+        '''This test makes sure data read back from the cache matches the csv files, also for missing text, that a changed file is not
+        read from the cache, and that eviction leaves entries another process is still writing alone'''
+        with tempfile.TemporaryDirectory() as work_dir:
+            cache_dir = os.path.join(work_dir, 'cache')
+            sleep_csv = os.path.join(work_dir, 'sleep.csv')
+            activity_csv = os.path.join(work_dir, 'activities.csv')
+            shutil.copy(os.path.join('testdata', 'sleep_test_data_in.csv'), sleep_csv)
+            shutil.copy(os.path.join('testdata', 'activity_test_data_in.csv'), activity_csv)
+            sleep_data, activity_data = read_data(sleep_csv, activity_csv)
+            read_data(sleep_csv, activity_csv, cache_dir)
+            self.assertEqual(len(cache_size(cache_dir)), 2)
+            cached_sleep_data, cached_activity_data = read_data(sleep_csv, activity_csv, cache_dir)
+            pd.testing.assert_frame_equal(cached_sleep_data, sleep_data)
+            pd.testing.assert_frame_equal(cached_activity_data, activity_data)
+            with open(sleep_csv, 'a') as file:
+                file.write('2015-06-11T01:00:00Z,60\n')
+            changed_sleep_data, _ = read_data(sleep_csv, activity_csv, cache_dir)
+            self.assertEqual(len(changed_sleep_data), len(sleep_data) + 1)
+            self.assertEqual(len(cache_size(cache_dir)), 3)
+            with open(sleep_csv, 'a') as file:
+                file.write(',30\n')
+            missing_sleep_data, _ = read_data(sleep_csv, activity_csv)
+            read_data(sleep_csv, activity_csv, cache_dir)
+            cached_missing_sleep_data, _ = read_data(sleep_csv, activity_csv, cache_dir)
+            pd.testing.assert_frame_equal(cached_missing_sleep_data, missing_sleep_data)
+            self.assertTrue(cached_missing_sleep_data['start_time_iso'].isna().iloc[-1])
+            os.makedirs(os.path.join(cache_dir, CACHE_TMP_PREFIX + 'writing'))
+            evict_cache(cache_dir, 0)
+            self.assertEqual(os.listdir(cache_dir), [CACHE_TMP_PREFIX + 'writing'])
+
+    def test_resample_effect(self):
+        '''This test makes sure resampling is reproducible with a seed for any number of workers, also when the last chunk is smaller,
+        that the confidence intervals contain the observed effect, and that too few sleeps or replicates give NaN instead of an error'''
+        flight_sleeps = pd.DataFrame({'sleep_duration': self.cohen_test_1})
+        non_flight_sleeps = pd.DataFrame({'sleep_duration': self.cohen_test_2})
+        results = resample_effect(flight_sleeps, non_flight_sleeps, n_resamples = 2000, seed = 0, chunk_size = 500)
+        parallel_results = resample_effect(flight_sleeps, non_flight_sleeps, n_resamples = 2000, seed = 0, chunk_size = 500, workers = 2)
+        self.assertEqual(results, parallel_results)
+        uneven_results = resample_effect(flight_sleeps, non_flight_sleeps, n_resamples = 2000, seed = 0, chunk_size = 700)
+        self.assertEqual(uneven_results, resample_effect(flight_sleeps, non_flight_sleeps, n_resamples = 2000, seed = 0, chunk_size = 700,
+                                                         workers = 2))
+        for few_flight_sleeps, n_resamples in [(flight_sleeps.iloc[:0], 100), (flight_sleeps.iloc[:1], 100), (flight_sleeps, 0)]:
+            empty_results = resample_effect(few_flight_sleeps, non_flight_sleeps, n_resamples = n_resamples, seed = 0)
+            self.assertTrue(np.isnan(empty_results['permutation_p']))
+            self.assertTrue(np.isnan(empty_results['mean_diff_ci'][0]))
+        self.assertAlmostEqual(results['cohens_d'], 0.01, places = 2)
+        self.assertGreater(results['permutation_p'], 0.5)
+        self.assertLess(results['mean_diff_ci'][0], results['mean_diff'])
+        self.assertGreater(results['mean_diff_ci'][1], results['mean_diff'])
+        self.assertLess(results['cohens_d_ci'][0], results['cohens_d'])
+        self.assertGreater(results['cohens_d_ci'][1], results['cohens_d'])
+
+    def test_sweep_parameters(self):
+        '''This test makes sure every parameter combination is evaluated and that each one matches running the full analysis with the
+        same parameters'''
+        sleep_data, activity_data = read_data(os.path.join('testdata', 'sleep_test_data_in.csv'), os.path.join('testdata', 'activity_test_data_in.csv'))
+        results = sweep_parameters(sleep_data, activity_data, DATE_STRING, DECIMALS, days_affected_grid = [2, 3],
+                                   lower_speed_grid = [50, 100], lower_duration_grid = [0.3, 0.5])
+        self.assertEqual(len(results), 8)
+        for row in results.itertuples():
+            with HiddenPrints():
+                sleep_sum_data = sleep_processing(sleep_data, DATE_STRING, DECIMALS)
+                flights = activity_processing(activity_data.copy(), DATE_STRING, DECIMALS, row.lower_speed_threshold,
+                                              row.upper_speed_threshold, row.lower_duration_threshold)
+                flight_sleeps, non_flight_sleeps = flight_effect_sleep(flights, sleep_sum_data, DECIMALS, row.days_affected_by_flight)
+            self.assertEqual(row.n_flights, len(flights))
+            self.assertEqual(row.n_flight_sleeps, len(flight_sleeps))
+            self.assertEqual(row.n_non_flight_sleeps, len(non_flight_sleeps))
+
+    def test_running_state(self):
+        '''This test makes sure adding the data a few rows at a time, with a save and load in between, gives the same groups and the same
+        t test and cohen's d as analyzing all of the data at once'''
+        sleep_data, activity_data = read_data(os.path.join('testdata', 'sleep_test_data_in.csv'), os.path.join('testdata', 'activity_test_data_in.csv'))
+        state = new_running_state(DATE_STRING, DECIMALS)
+        with tempfile.TemporaryDirectory() as state_dir:
+            state_file = os.path.join(state_dir, 'state.json')
+            #Add the sleep before the flights so that later flights have to move days that were already added between groups
+            for start in range(0, len(sleep_data), 4):
+                update_running_state(state, sleep_data = sleep_data.iloc[start:start + 4])
+                save_running_state(state, state_file)
+                state = load_running_state(state_file)
+            for start in range(0, len(activity_data), 3):
+                update_running_state(state, activity_data = activity_data.iloc[start:start + 3])
+        results = running_effect(state)
+        expected_flight_sleeps = self.flight_effect_data_out['flight_sleeps']
+        expected_non_flight_sleeps = self.flight_effect_data_out['non_flight_sleeps'].dropna()
+        self.assertEqual(results['n_flight_sleeps'], len(expected_flight_sleeps))
+        self.assertEqual(results['n_non_flight_sleeps'], len(expected_non_flight_sleeps))
+        self.assertAlmostEqual(results['mean_flight_sleep'], expected_flight_sleeps.mean())
+        self.assertAlmostEqual(results['mean_non_flight_sleep'], expected_non_flight_sleeps.mean())
+        from scipy import stats
+        expected_t = stats.ttest_ind(expected_flight_sleeps, expected_non_flight_sleeps)
+        self.assertAlmostEqual(results['t_statistic'], expected_t.statistic)
+        self.assertAlmostEqual(results['p_value'], expected_t.pvalue)
+
+    def test_synthetic_data(self):
+        '''This test makes sure the synthetic data can be read and analyzed like the real data, and that the benchmark report has every
+        stage'''
+        with tempfile.TemporaryDirectory() as data_dir:
+            participants = write_synthetic_cohort(data_dir, 2, 4000, seed = 1)
+            self.assertEqual(participants['participant'].tolist(), ['p00000', 'p00001'])
+            results = run_batch(find_participants(data_dir), DATE_STRING, DECIMALS, workers = 1)
+            self.assertEqual(results['error'].tolist(), ['', ''])
+            self.assertTrue((results['n_flights'] > 0).all())
+            report_file = os.path.join(data_dir, 'bench.json')
+            run_benchmarks([500], report_file, repeats = 1, work_dir = data_dir)
+            with open(report_file) as file:
+                report = json.load(file)
+        self.assertEqual([result['stage'] for result in report['results']], STAGES)
+        self.assertTrue(all(result['seconds'] > 0 for result in report['results']))
+
+    def test_stage_profiler(self):
+        '''This test makes sure every stage run inside a StageProfiler is recorded with its rows in and out, and that the profiler is
+        unregistered afterwards'''
+        with tempfile.TemporaryDirectory() as cprofile_dir:
+            with StageProfiler(cprofile_dir) as profiler, HiddenPrints():
+                sleep_sum_data = sleep_processing(self.sleep_data_in, DATE_STRING, DECIMALS)
+                flights = activity_processing(self.activity_data_in, DATE_STRING, DECIMALS)
+                flight_effect_sleep(flights, sleep_sum_data, DECIMALS)
+            report = profiler.report()
+            self.assertEqual([stage['stage'] for stage in report['stages']], ['sleep_processing', 'activity_processing', 'flight_effect_sleep'])
+            self.assertEqual(report['stages'][0]['rows_in'], len(self.sleep_data_in))
+            self.assertEqual(report['stages'][0]['rows_out'], 8)
+            self.assertEqual(report['stages'][1]['rows_out'], 2)
+            self.assertEqual(report['stages'][2]['rows_in'], 10)
+            self.assertEqual(report['stages'][2]['rows_out'], 8)
+            self.assertTrue(all(os.path.exists(stage['cprofile']) for stage in report['stages']))
+        self.assertEqual(STAGE_HOOKS, [])
+
+    def test_stage_profiler_nested(self):
+        '''This test makes sure a stage that raises is recorded as failed and leaves the profiler ready for the next stage, and that a
+        stage called inside another is counted as part of the outer stage'''
+        @pipeline_stage
+        def outer_stage(sleep_data):
+            return sleep_processing(sleep_data, DATE_STRING, DECIMALS, verbose = False)
+
+        with tempfile.TemporaryDirectory() as cprofile_dir:
+            with StageProfiler(cprofile_dir) as profiler:
+                with self.assertRaises(KeyError):
+                    sleep_processing(self.sleep_data_in.drop(columns = 'actual_minutes'), DATE_STRING, DECIMALS)
+                outer_stage(self.sleep_data_in)
+            report = profiler.report()
+        self.assertEqual([stage['stage'] for stage in report['stages']], ['sleep_processing', 'outer_stage'])
+        self.assertTrue(report['stages'][0]['failed'])
+        self.assertIsNone(report['stages'][0]['rows_out'])
+        self.assertFalse(report['stages'][1]['failed'])
+        self.assertEqual(report['stages'][1]['rows_in'], len(self.sleep_data_in))
+        self.assertEqual(report['stages'][1]['rows_out'], 8)
+        self.assertEqual(STAGE_HOOKS, [])
+
+    def test_plot_to_file(self):
+        '''This test makes sure the figure can be saved to a file without showing a window'''
+        with HiddenPrints():
+            sleep_sum_data = sleep_processing(self.sleep_data_in, DATE_STRING, DECIMALS)
+            flights = activity_processing(self.activity_data_in, DATE_STRING, DECIMALS)
+            flight_sleeps, non_flight_sleeps = flight_effect_sleep(flights, sleep_sum_data, DECIMALS)
+        with tempfile.TemporaryDirectory() as plot_dir:
+            plot_file = os.path.join(plot_dir, 'sleep_analysis.png')
+            plot_data(sleep_sum_data, flights, flight_sleeps, non_flight_sleeps, np.arange(0, 20, 1), np.arange(0, 15, 1), plot_file)
+            self.assertTrue(os.path.getsize(plot_file) > 0)
+
+    def test_render_batch(self):
+        '''This test makes sure the precomputed histogram counts match numpy, and that an image is rendered for every participant in png
+        or svg while a participant with a missing file is reported as failed'''
+        panel = histogram_counts(pd.Series([1.5, 2.5, 2.7, np.nan, 30]), np.arange(0, 5, 1))
+        self.assertEqual(panel['counts'].tolist(), [0, 1, 2, 0])
+        self.assertAlmostEqual(panel['mean'], 36.7 / 4)
+        with tempfile.TemporaryDirectory() as batch_dir:
+            for participant in ['p1', 'p2']:
+                shutil.copy(os.path.join('testdata', 'sleep_test_data_in.csv'), os.path.join(batch_dir, participant + '_sleep.csv'))
+            shutil.copy(os.path.join('testdata', 'activity_test_data_in.csv'), os.path.join(batch_dir, 'p1_activities.csv'))
+            participants = find_participants(batch_dir)
+            plot_dir = os.path.join(batch_dir, 'plots')
+            results = render_batch(participants, plot_dir, DATE_STRING, DECIMALS, np.arange(0, 20, 1), np.arange(0, 15, 1), workers = 2)
+            svg_results = render_batch(participants.iloc[:1], plot_dir, DATE_STRING, DECIMALS, np.arange(0, 20, 1), np.arange(0, 15, 1),
+                                       plot_format = 'svg', workers = 1)
+            self.assertEqual(results['error'].iloc[0], '')
+            self.assertTrue(results['error'].iloc[1].startswith('FileNotFoundError'))
+            self.assertEqual(sorted(os.listdir(plot_dir)), ['p1.png', 'p1.svg'])
+            with open(svg_results['plot_file'].iloc[0]) as file:
+                self.assertIn('<svg', file.read())
+
+    def test_import_time(self):
+        '''This test makes sure importing the library does not import the plotting and statistics libraries, and that it adds less than
+        half a second on top of importing pandas'''
+        code = ('import sys, time; t0 = time.perf_counter(); import pandas; t1 = time.perf_counter(); import sleep_analysis_lib; '
+                't2 = time.perf_counter(); heavy = [m for m in (\'matplotlib.pyplot\', \'scipy.stats\', \'IPython\') if m in sys.modules]; '
+                'print(t2 - t1, len(heavy))')
+        output = subprocess.run([sys.executable, '-c', code], capture_output = True, text = True, check = True).stdout.split()
+        self.assertEqual(int(output[1]), 0)
+        self.assertLess(float(output[0]), 0.5)
+
+    def test_run_batch(self):
+        '''This test makes sure every participant in a batch directory is analyzed, that a participant with a missing file is
+        reported as failed without stopping the others, and that the daily store written in the same pass holds the analyzed ones'''
+        with tempfile.TemporaryDirectory() as batch_dir:
+            for participant in ['p1', 'p2']:
+                shutil.copy(os.path.join('testdata', 'sleep_test_data_in.csv'), os.path.join(batch_dir, participant + '_sleep.csv'))
+            shutil.copy(os.path.join('testdata', 'activity_test_data_in.csv'), os.path.join(batch_dir, 'p1_activities.csv'))
+            participants = find_participants(batch_dir)
+            results = run_batch(participants, DATE_STRING, DECIMALS, workers = 2, output = os.path.join(batch_dir, 'results.jsonl'),
+                                store = os.path.join(batch_dir, 'cohort.store'))
+            with open(os.path.join(batch_dir, 'results.jsonl')) as file:
+                streamed = sorted((json.loads(line) for line in file), key = lambda row: row['participant'])
+            store = open_daily_store(os.path.join(batch_dir, 'cohort.store'))
+            self.assertEqual(list(store['participants']), ['p1'])
+            self.assertEqual(int(store_series(store, 'p1')['flight_days'].sum()), 2)
+            del store
+        self.assertEqual([row['n_flights'] for row in streamed], [2, None])
+        self.assertEqual(streamed[0]['cohens_d'], results['cohens_d'].iloc[0])
+        self.assertEqual(results['participant'].tolist(), ['p1', 'p2'])
+        self.assertEqual(results['error'].iloc[0], '')
+        self.assertEqual(results['n_flights'].iloc[0], 2)
+        self.assertEqual(results['n_flight_sleeps'].iloc[0], 5)
+        self.assertEqual(results['n_non_flight_sleeps'].iloc[0], 3)
+        self.assertTrue(results['error'].iloc[1].startswith('FileNotFoundError'))
+
+    def test_columnar_results(self):
+        '''This test makes sure batch results written to a columnar .npz file, and to a .parquet file when pyarrow is installed, hold
+        the same values as the results table, one array per column'''
+        participants = pd.DataFrame({'participant': ['p1', 'p2'], 'sleep_data_csv': [os.path.join('testdata', 'sleep_test_data_in.csv')] * 2,
+                                     'activity_data_csv': [os.path.join('testdata', 'activity_test_data_in.csv'), 'missing.csv']})
+        with tempfile.TemporaryDirectory() as batch_dir:
+            results = run_batch(participants, DATE_STRING, DECIMALS, workers = 1, output = os.path.join(batch_dir, 'results.npz'))
+            with np.load(os.path.join(batch_dir, 'results.npz')) as columns:
+                columns = dict(columns)
+            try:
+                import pyarrow.parquet
+            except ImportError:
+                parquet = None
+            else:
+                run_batch(participants, DATE_STRING, DECIMALS, workers = 1, output = os.path.join(batch_dir, 'results.parquet'))
+                parquet = pyarrow.parquet.read_table(os.path.join(batch_dir, 'results.parquet')).to_pandas()
+        self.assertEqual(list(columns), list(results.columns))
+        self.assertEqual(columns['participant'].tolist(), ['p1', 'p2'])
+        self.assertEqual(columns['error'][0], '')
+        self.assertTrue(columns['error'][1].startswith('FileNotFoundError'))
+        np.testing.assert_array_equal(columns['cohens_d'], results['cohens_d'].to_numpy(dtype = float))
+        np.testing.assert_array_equal(columns['n_flights'], [2, np.nan])
+        if parquet is not None:
+            pd.testing.assert_frame_equal(parquet, results.astype({column: float for column in results.columns
+                                                                   if column not in ['participant', 'error']}))
+
+    def test_prefetch_batch(self):
+        '''This test makes sure prefetching gzip compressed files gives the same batch results as reading the plain files, that a
+        participant with a missing file is still reported as failed, and that the bytes read are counted'''
+        with open(os.path.join('testdata', 'sleep_test_data_in.csv'), 'rb') as file:
+            raw = file.read()
+        with open(os.path.join('testdata', 'activity_test_data_in.csv'), 'rb') as file:
+            activities = file.read()
+        with tempfile.TemporaryDirectory() as plain_dir, tempfile.TemporaryDirectory() as gzip_dir:
+            for participant in ['p1', 'p2']:
+                shutil.copy(os.path.join('testdata', 'sleep_test_data_in.csv'), os.path.join(plain_dir, participant + '_sleep.csv'))
+                with gzip.open(os.path.join(gzip_dir, participant + '_sleep.csv.gz'), 'wb') as file:
+                    file.write(raw)
+            shutil.copy(os.path.join('testdata', 'activity_test_data_in.csv'), os.path.join(plain_dir, 'p1_activities.csv'))
+            with gzip.open(os.path.join(gzip_dir, 'p1_activities.csv.gz'), 'wb') as file:
+                file.write(activities)
+            plain = run_batch(find_participants(plain_dir), DATE_STRING, DECIMALS, workers = 1)
+            stats = IngestStats()
+            results = run_batch(find_participants(gzip_dir), DATE_STRING, DECIMALS, workers = 1, prefetch = 2, max_inflight_bytes = 1,
+                                ingest_stats = stats)
+            pooled = run_batch(find_participants(gzip_dir), DATE_STRING, DECIMALS, workers = 2, prefetch = 2)
+        pd.testing.assert_frame_equal(results.drop(columns = 'error'), plain.drop(columns = 'error'))
+        pd.testing.assert_frame_equal(pooled, results)
+        self.assertEqual(results['error'].iloc[0], '')
+        self.assertTrue(results['error'].iloc[1].startswith('FileNotFoundError'))
+        self.assertEqual(stats.files, 2)
+        self.assertEqual(stats.bytes_decompressed, len(raw) + len(activities))
+        self.assertLess(stats.bytes_read, stats.bytes_decompressed)
+
+    def test_daily_store(self):
+        '''This test makes sure the daily store gives back the same series, that its after-flight days match the window matching, and
+        that flight_effect_sleep and cohort_flight_effect, one block of participants at a time, give the same groups from the store as
+        from the dataframes'''
+        with HiddenPrints():
+            sleep_sum_data = sleep_processing(self.sleep_data_in, DATE_STRING, DECIMALS)
+            flights = activity_processing(self.activity_data_in, DATE_STRING, DECIMALS)
+            flight_sleeps, non_flight_sleeps = flight_effect_sleep(flights, sleep_sum_data, DECIMALS)
+        series = daily_series(sleep_sum_data, flights)
+        with tempfile.TemporaryDirectory() as store_dir:
+            store_file = os.path.join(store_dir, 'cohort.store')
+            write_daily_store(store_file, {'p1': series, 'p2': daily_series(sleep_sum_data.iloc[:0], flights.iloc[:1])})
+            store = open_daily_store(store_file)
+            stored = store_series(store, 'p1')
+            np.testing.assert_array_equal(stored['sleep_hours'], series['sleep_hours'])
+            np.testing.assert_array_equal(stored['flight_days'], series['flight_days'])
+            self.assertEqual(store_series(store, 'p2')['flight_days'].tolist(), [True])
+            with HiddenPrints():
+                store_flight_sleeps, store_non_flight_sleeps = flight_effect_sleep(None, None, DECIMALS, series = stored)
+            pd.testing.assert_frame_equal(store_flight_sleeps, flight_sleeps)
+            pd.testing.assert_frame_equal(store_non_flight_sleeps, non_flight_sleeps)
+            results = cohort_flight_effect(store, DECIMALS)
+            self.assertEqual(results['n_flight_sleeps'].tolist(), [5, 0])
+            self.assertEqual(results['n_flight_days'].tolist(), [int(series['flight_days'].sum()), 1])
+            self.assertEqual(results['n_non_flight_sleeps'].tolist(), [len(non_flight_sleeps), 0])
+            pd.testing.assert_frame_equal(cohort_flight_effect(store, DECIMALS, block_size = 1), results)
+            del store, stored
+        all_days = np.arange(series['first_day'], series['first_day'] + len(series['flight_days']))
+        for days_affected in [0, 1, 2, 5]:
+            np.testing.assert_array_equal(after_flight_days(series['flight_days'], days_affected),
+                                          in_flight_window(all_days, all_days[series['flight_days']], days_affected))
+
+    def test_dose_response(self):
+        '''This test makes sure the slope and recovery curve at every lag match a direct calculation, and that pooling two copies of a
+        participant doubles the days without changing the estimates'''
+        with HiddenPrints():
+            sleep_sum_data = sleep_processing(self.sleep_data_in, DATE_STRING, DECIMALS)
+            flights = activity_processing(self.activity_data_in, DATE_STRING, DECIMALS)
+        series = daily_series(sleep_sum_data, flights)
+        results = dose_response([series], max_lag = 3)
+        pooled = dose_response([series, series], max_lag = 3)
+        sleep_hours = series['sleep_hours'].astype(float)
+        for lag in range(4):
+            sleep_after = sleep_hours[lag:]
+            hours_before = series['flight_hours'][:len(sleep_hours) - lag].astype(float)
+            has_sleep = ~np.isnan(sleep_after)
+            slope = np.polyfit(hours_before[has_sleep], sleep_after[has_sleep], 1)[0]
+            after_flight = sleep_after[has_sleep & series['flight_days'][:len(sleep_hours) - lag]]
+            self.assertEqual(results['n_days'][lag], has_sleep.sum())
+            self.assertAlmostEqual(results['slope'][lag], slope)
+            self.assertAlmostEqual(results['recovery'][lag], after_flight.mean() - np.nanmean(sleep_hours))
+            self.assertTrue(results['slope_ci_low'][lag] < slope < results['slope_ci_high'][lag])
+        self.assertEqual(pooled['n_days'].tolist(), (2 * results['n_days']).tolist())
+        np.testing.assert_allclose(pooled['slope'], results['slope'])
+
+    def test_run_pipeline(self):
+        '''This test makes sure the pipeline gives the same results as running the stages directly, and that only the stages affected by
+        a changed parameter are run again, from memory or from the cache folder, that a saved plot is always drawn again, and that a
+        profile lists the reused stages'''
+        params = {'sleep_data_csv': os.path.join('testdata', 'sleep_test_data_in.csv'), 'decimals': DECIMALS,
+                  'activity_data_csv': os.path.join('testdata', 'activity_test_data_in.csv'), 'date_string': DATE_STRING}
+        with HiddenPrints():
+            flight_sleeps, non_flight_sleeps = flight_effect_sleep(activity_processing(self.activity_data_in, DATE_STRING, DECIMALS),
+                                                                   sleep_processing(self.sleep_data_in, DATE_STRING, DECIMALS), DECIMALS)
+        with tempfile.TemporaryDirectory() as cache_dir, HiddenPrints():
+            memo = {}
+            outputs, first = run_pipeline(params, cache_dir = cache_dir, memo = memo)
+            _, second = run_pipeline(params, cache_dir = cache_dir, memo = memo)
+            _, window = run_pipeline(dict(params, days_affected_by_flight = 2), cache_dir = cache_dir, memo = memo)
+            _, on_disk = run_pipeline(params, cache_dir = cache_dir, memo = {})
+            with StageProfiler() as profiler:
+                run_pipeline(params, cache_dir = cache_dir, memo = memo)
+            plot_params = dict(params, plot_file = os.path.join(cache_dir, 'plot.png'), sleep_bins = 10, flight_bins = 10)
+            run_pipeline(plot_params, ['plot'], cache_dir = cache_dir, memo = memo)
+            _, replot = run_pipeline(plot_params, ['plot'], cache_dir = cache_dir, memo = memo)
+        pd.testing.assert_frame_equal(outputs['flight_effect'][0], flight_sleeps)
+        pd.testing.assert_frame_equal(outputs['flight_effect'][1], non_flight_sleeps)
+        self.assertEqual(set(first.values()), {'run'})
+        self.assertEqual(second, {'flight_effect': 'memory'})
+        self.assertEqual(window, {'sleep_sum_data': 'memory', 'flights': 'memory', 'flight_effect': 'run'})
+        self.assertEqual(on_disk, {'flight_effect': 'disk'})
+        self.assertEqual(profiler.report()['reused_stages'], [{'stage': 'flight_effect', 'reused_from': 'memory'}])
+        self.assertEqual(replot, {'sleep_sum_data': 'memory', 'flights': 'memory', 'flight_effect': 'memory', 'plot': 'run'})
+
+    def test_run_pipeline_sleep_metrics(self):
+        '''This test makes sure that with sleep_metrics the sleep file is read only once, with the metric columns, and that both the
+        daily sleep hours and the sleep metrics are made from that read with the same results as running them directly'''
+        sleep_data = self.sleep_data_in.copy()
+        sleep_data['deep_minutes'] = np.arange(len(sleep_data), dtype = float)
+        with HiddenPrints():
+            sleep_sum_data = sleep_processing(self.sleep_data_in, DATE_STRING, DECIMALS)
+            flights = activity_processing(self.activity_data_in, DATE_STRING, DECIMALS)
+        with tempfile.TemporaryDirectory() as cache_dir, HiddenPrints():
+            sleep_file = os.path.join(cache_dir, 'sleep.csv')
+            sleep_data.to_csv(sleep_file, index = False)
+            params = {'sleep_data_csv': sleep_file, 'activity_data_csv': os.path.join('testdata', 'activity_test_data_in.csv'),
+                      'date_string': DATE_STRING, 'decimals': DECIMALS, 'sleep_metrics': True}
+            with StageProfiler() as profiler:
+                outputs, report = run_pipeline(params, ['sleep_sum_data', 'flight_effect', 'sleep_metric_effects'], cache_dir = cache_dir,
+                                               memo = {})
+        self.assertEqual(report['sleep_data'], 'run')
+        #One read of the sleep file and one of the activity file
+        self.assertEqual(sum(stage['stage'] == 'read_data' for stage in profiler.report()['stages']), 2)
+        pd.testing.assert_frame_equal(outputs['sleep_sum_data'], sleep_sum_data, check_dtype = False)
+        pd.testing.assert_frame_equal(outputs['sleep_metric_effects'],
+                                      sleep_metric_effects(flights, sleep_metrics(sleep_data, DECIMALS)))
+
 #-------------------------------------------------------------------------------------------------------------------------------------
 
 #Run the tests
 
 if __name__ == '__main__':
-    unittest.main()
\ No newline at end of file
+    unittest.main()